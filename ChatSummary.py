@@ -5,15 +5,14 @@ import os
 import time
 import sqlite3
 import requests
-from urllib.parse import urlparse
-import hmac
-import base64
 import time
 import json
-from urllib.parse import urlparse
 from pathlib import Path
 import io
 import threading
+import atexit
+import re
+from concurrent.futures import ThreadPoolExecutor
 try:
     import schedule
 except ImportError:
@@ -27,6 +26,28 @@ from channel.chat_channel import check_contain, check_prefix
 from channel.chat_message import ChatMessage
 from common.log import logger
 from plugins import *
+from .storage.connection import ConnectionManager
+from .storage.ingest_queue import IngestQueue
+from .storage import schema
+from .storage.partition import SingleFileLayout, MonthlyPartitions
+from .storage.retention import RetentionPolicy
+from .storage.search import SearchIndex, drop_search_index
+from .storage.hot_cache import HotTailCache
+from .storage.compression import ContentCodec, ColdContentCompressor
+from .storage import analytics
+from .storage.keywords import KeywordIndex, make_segmenter, extract_keywords, word_cloud
+from .storage.summaries import BucketSummaryStore, MemoryBucketSummaryStore
+from .storage.result_cache import ResultCache, result_key
+from .llm.sessions import SessionPool
+from .llm.auth import ProviderAuth
+from .llm.streaming import read_chat_stream, StreamError, StreamMetrics, StreamingJSONObject, ParagraphSender
+from .llm.tokens import TokenizerService, pack_newest, fit_oldest
+from .llm.singleflight import SingleFlight
+from .llm.routing import ProviderRouter
+from .llm.mapreduce import MAP_PROMPT, MapReduceError, ChunkSummaryCache, split_chunks, chunk_key, map_chunks
+from .storage.backends.sqlite import SQLiteMessageStore
+from .storage.backends.memory import MemoryMessageStore
+from .storage.backends.duckdb import DuckDBMessageStore
 
 
 @plugins.register(
@@ -42,6 +63,11 @@ class ChatSummary(Plugin):
    
     max_tokens = 4000
     max_input_tokens = 8000  # 默认限制输入 8000 个 token
+    transcript_header = "\n\n以下是需要总结的群聊内容：\n"
+    _LINE_TIME = re.compile(r"\[(\d{2}-\d{2} \d{2}:\d{2})\]")
+    digest_header = "\n\n以下是按时间顺序排列的各段聊天要点：\n"
+    night_hours = analytics.NIGHT_HOURS  # 熬夜冠军统计的深夜时段 (本地小时)
+    line_format_version = 1  # 修改 _format_prefix 的输出格式时递增，已存储的前缀会在读取时重新生成
     prompt = '''你是一个专业的群聊记录总结助手，请按照以下规则和格式对群聊内容进行总结：
 
 规则要求：
@@ -102,7 +128,9 @@ class ChatSummary(Plugin):
             self.switch_commands = self.config.get('switch_model_commands', ["c切换总结模型", "c切换模型"])
             self.summarize_commands = self.config.get('summarize_commands', ["c总结"])
             self.image_summarize_commands = self.config.get('image_summarize_commands', ["c图片总结"])
+            self.search_commands = self.config.get('search_commands', ["c搜索"])
             self.default_summary_count = self.config.get('default_summary_count', 100)
+            self.read_page_size = self.config.get('read_page_size', 500)
 
             # Load model config
             self.bot_type = self.config.get('default_bot_type', 'zhipuai')
@@ -117,6 +145,81 @@ class ChatSummary(Plugin):
             else:
                  logger.error(f"[ChatSummary] 未找到默认文本模型 {self.bot_type} 的配置，请检查 config.json")
 
+            self.auth = ProviderAuth()
+            # 输入预算按当前模型的 tokenizer 计数 (未安装 tiktoken 时近似计数)
+            tokens_config = self.config.get("tokens", {})
+            self.tokenizers = TokenizerService(
+                mode=tokens_config.get("mode", "auto"),
+                encoding=tokens_config.get("encoding"),
+                cache_size=tokens_config.get("cache_size", 8192),
+            )
+            # 提前在后台加载各模型的编码表，有限等待；未就绪前按近似计数
+            self.tokenizers.preload([config.get('model') or name for name, config in self.models_config.items()],
+                                    tokens_config.get("preload_timeout_seconds", 3))
+            # 超出输入预算的窗口分块并发总结后再汇总 (map-reduce)
+            map_reduce_config = self.config.get("map_reduce", {})
+            self.map_reduce_enabled = map_reduce_config.get("enabled", True)
+            self.map_max_chunks = max(1, map_reduce_config.get("max_chunks", 8))
+            self.map_summary_chars = map_reduce_config.get("chunk_summary_chars", 600)
+            self.map_prompt = map_reduce_config.get("map_prompt", MAP_PROMPT)
+            self.chunk_cache = ChunkSummaryCache(map_reduce_config.get("cache_size", 256))
+            self.map_executor = ThreadPoolExecutor(max_workers=max(1, map_reduce_config.get("workers", 4)),
+                                                   thread_name_prefix="ChatSummaryMap")
+            # 同一会话中相同命令和窗口的并发总结只执行一次，后到的请求共享结果
+            coalescing_config = self.config.get("coalescing", {})
+            self.single_flight = None
+            if coalescing_config.get("enabled", True):
+                self.single_flight = SingleFlight(
+                    join_window=coalescing_config.get("join_window_seconds", 60),
+                    wait_timeout=coalescing_config.get("wait_timeout_seconds", 600),
+                )
+            # 相同 Prompt 的总结结果缓存 (内存 LRU + SQLite 文件)，命令末尾加 bypass_args 中的词可跳过
+            result_cache_config = self.config.get("result_cache", {})
+            self.result_cache = None
+            self.cache_bypass_args = result_cache_config.get("bypass_args", ["刷新", "nocache"])
+            if result_cache_config.get("enabled", True):
+                self.result_cache = ResultCache(
+                    path=curdir / result_cache_config.get("path", "summary_cache.db") if result_cache_config.get("persistent", True) else None,
+                    ttl=result_cache_config.get("ttl_seconds", 3600),
+                    max_entries=result_cache_config.get("max_entries", 128),
+                    max_persistent_entries=result_cache_config.get("max_persistent_entries", 1000),
+                )
+            # 流式输出：边生成边解析图片总结的 JSON，文本总结可按段落提前回复
+            streaming_config = self.config.get("streaming", {})
+            self.llm_streaming = streaming_config.get("enabled", True)
+            self.stream_metrics = StreamMetrics()
+            # 启用 failover 时当前模型出错或超时改用其他已配置的模型，可选按延迟 p95 对冲请求
+            routing_config = self.config.get("routing", {})
+            hedging_config = routing_config.get("hedging", {})
+            self.route_executor = None
+            if routing_config.get("failover", False) and hedging_config.get("enabled", False):
+                self.route_executor = ThreadPoolExecutor(max_workers=max(2, hedging_config.get("workers", 8)),
+                                                         thread_name_prefix="ChatSummaryRoute")
+            self.router = ProviderRouter(
+                routing_config.get("providers") or [name for name, config in self.models_config.items() if config.get('api_key')],
+                call=self._call_provider,
+                failed=lambda text: not text or text.startswith("总结失败："),
+                executor=self.route_executor,
+                failover=routing_config.get("failover", False),
+                streaming=self.llm_streaming,
+                failure_threshold=routing_config.get("failure_threshold", 3),
+                cooldown=routing_config.get("cooldown_seconds", 60),
+                hedge_quantile=hedging_config.get("quantile", 0.95),
+                hedge_min_samples=hedging_config.get("min_samples", 20),
+                hedge_initial_delay=hedging_config.get("initial_delay_seconds"),
+                hedge_min_delay=hedging_config.get("min_delay_seconds", 1.0),
+            )
+
+            # 每个模型一个长连接 Session，总结请求复用 keep-alive 连接
+            http_config = self.config.get("http", {})
+            self.http_pool = SessionPool(
+                pool_connections=http_config.get("pool_connections", 4),
+                pool_maxsize=http_config.get("pool_maxsize", 8),
+                keep_alive=http_config.get("keep_alive", True),
+                connect_timeout=http_config.get("connect_timeout", 10),
+                read_timeout=http_config.get("read_timeout", 180),
+            )
+
             # +++ Load GeweChat API Config +++
             gewechat_config = self.config.get("gewechat_api", {})
             self.gewechat_enabled = gewechat_config.get("enabled", False)
@@ -151,10 +254,93 @@ class ChatSummary(Plugin):
                 logger.error("[ChatSummary] 图片总结功能将不可用。")
                 self.image_summarize_enabled = False
 
-            # Init DB
-            db_path = curdir / "chat.db"
-            self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
-            self._init_database()
+            # Init storage backend
+            storage_config = self.config.get("storage", {})
+            self.storage_backend = storage_config.get("backend", "sqlite")
+            # 分片、压缩、全文搜索、保留策略只在 SQLite 后端下可用
+            self.db = None
+            self.layout = None
+            self.session_names = None
+            self.user_names = None
+            self.content_codec = None
+            self.cold_compressor = None
+            self.search_index = None
+            self.keyword_index = None
+            # 按固定时间桶保存的分段要点，重叠窗口的重复总结复用已结束的桶
+            partial_config = self.config.get("partial_summaries", {})
+            self.partial_summaries_enabled = partial_config.get("enabled", True)
+            self.bucket_seconds = max(60, int(partial_config.get("bucket_minutes", 120) * 60))
+            self.bucket_close_grace = partial_config.get("close_grace_seconds", 300)
+            self.bucket_min_window_tokens = partial_config.get("min_window_tokens", 8000)
+            self.bucket_raw_tokens = partial_config.get("raw_tokens", 400)
+            self.bucket_summary_chars = partial_config.get("summary_chars", 300)
+            self.bucket_summaries = None
+            # 词云由本地 TF-IDF 生成，不再要求模型输出
+            keywords_config = self.config.get("keywords", {})
+            self.keyword_segmenter = None
+            if keywords_config.get("enabled", True):
+                try:
+                    self.keyword_segmenter = make_segmenter(keywords_config.get("segmenter", "auto"))
+                except ImportError as e:
+                    logger.warning(f"[ChatSummary] {e} Falling back to the ngram segmenter.")
+                    self.keyword_segmenter = make_segmenter("ngram")
+            if self.storage_backend == "memory":
+                self.store = MemoryMessageStore()
+                logger.warning("[ChatSummary] Using the in-memory storage backend, chat history is lost on restart.")
+            elif self.storage_backend == "duckdb":
+                self.store = DuckDBMessageStore(curdir / storage_config.get("duckdb_path", "chat.duckdb"),
+                                                page_size=self.read_page_size)
+            else:
+                if self.storage_backend != "sqlite":
+                    logger.warning(f"[ChatSummary] Unknown storage backend '{self.storage_backend}', falling back to sqlite.")
+                    self.storage_backend = "sqlite"
+                self._init_sqlite_store(curdir)
+            if self.partial_summaries_enabled and self.bucket_summaries is None:
+                self.bucket_summaries = MemoryBucketSummaryStore(partial_config.get("memory_max_entries", 2048))
+            logger.info(f"[ChatSummary] Storage backend: {self.storage_backend}")
+
+            # 最近消息的内存缓存：常见的默认条数 / 短时间窗口总结不必访问数据库
+            hot_cache_config = self.config.get("hot_cache", {})
+            self.hot_cache = None
+            if hot_cache_config.get("enabled", True):
+                self.hot_cache = HotTailCache(
+                    max_messages=hot_cache_config.get("max_messages_per_session", 500),
+                    max_sessions=hot_cache_config.get("max_sessions", 200),
+                )
+
+            retention_config = self.config.get("retention", {})
+            self.retention = None
+            if self.storage_backend == "sqlite" and retention_config.get("enabled", False):
+                self.retention = RetentionPolicy(
+                    self.db,
+                    self.layout,
+                    max_age_days=retention_config.get("max_age_days", 0),
+                    max_rows=retention_config.get("max_rows", 0),
+                    session_policies=retention_config.get("sessions", {}),
+                    batch_size=retention_config.get("batch_size", 500),
+                    pause_ms=retention_config.get("pause_ms", 20),
+                    vacuum_pages=retention_config.get("vacuum_pages", 1000),
+                )
+                self.retention.delete_hooks.append(self.store.rollup.refresh_deleted)
+                if self.search_index is not None:
+                    self.retention.delete_hooks.append(self.search_index.delete_keys)
+                if self.bucket_summaries is not None:
+                    self.retention.delete_hooks.append(self.bucket_summaries.delete_keys)
+                if self.hot_cache is not None:
+                    self.retention.delete_hooks.append(
+                        lambda conn, sid, keys: self.hot_cache.invalidate(self.session_names.name_of(conn, sid)))
+
+            # 写入队列：消息线程只入队，由写线程批量提交
+            ingest_config = self.config.get("ingest_queue", {})
+            self.ingest_queue = None
+            if ingest_config.get("enabled", True):
+                self.ingest_queue = IngestQueue(
+                    self._write_records,
+                    max_size=ingest_config.get("max_size", 10000),
+                    batch_size=ingest_config.get("batch_size", 200),
+                    flush_interval_ms=ingest_config.get("flush_interval_ms", 200),
+                )
+            atexit.register(self._shutdown)
 
             # Check image summary prompt
             if not self.image_summary_prompt_path.is_file():
@@ -232,109 +418,124 @@ class ChatSummary(Plugin):
             logger.error(f"[ChatSummary] 保存配置失败: {e}")
             # 保存失败不应阻止程序运行，但要记录错误
 
-    def _prepare_api_request(self, content):
-        """根据当前 bot_type 准备 API 请求的 headers 和 payload"""
-        headers = {'Content-Type': 'application/json'}
+    def _provider_settings(self, bot_type):
+        """返回模型的 (api_base, api_key, model)，当前模型使用已加载的配置"""
+        if bot_type == self.bot_type:
+            return self.api_base, self.api_key, self.model
+        config = self.models_config.get(bot_type, {})
+        return config.get('api_base', ''), config.get('api_key', ''), config.get('model', '')
+
+    def _prepare_api_request(self, content, bot_type=None):
+        """根据 bot_type (默认当前模型) 准备 API 请求的 headers 和 payload"""
+        bot_type = bot_type or self.bot_type
+        api_base, api_key, _ = self._provider_settings(bot_type)
+        # 鉴权请求头 (包括智谱的 JWT) 由 ProviderAuth 缓存，过期前不重复签名
+        try:
+            headers = self.auth.headers(bot_type, api_key, api_base)
+        except Exception as e:
+            logger.error(f"[ChatSummary] 生成 {bot_type} API 鉴权信息失败: {e}")
+            raise ValueError(f"生成 {bot_type} API 鉴权信息失败: {e}")
+
+        # 确保返回三个值
+        return headers, self._build_payload(content, bot_type), api_base # 返回 api_base
+
+    def _build_payload(self, content, bot_type=None):
+        """根据 bot_type (默认当前模型) 生成请求体"""
+        bot_type = bot_type or self.bot_type
+        model = self._provider_settings(bot_type)[2]
         messages = [{"role": "user", "content": content}]
         payload = {}
-
-        if self.bot_type == 'zhipuai':
+        if bot_type == 'zhipuai':
             # 智谱 API 特殊处理
-            try:
-
-
-                api_key_list = self.api_key.split('.')
-                if len(api_key_list) != 2:
-                    raise ValueError("Invalid API key format for zhipuai")
-
-                key_id, key = api_key_list
-                now = int(time.time())
-                exp = now + 3600  # 1小时后过期
-
-                jwt_payload = {"api_key": key_id, "exp": exp, "timestamp": now}
-                jwt_header = {"alg": "HS256", "sign_type": "SIGN"}
-
-                header_str = base64.b64encode(json.dumps(jwt_header).encode('utf-8')).decode('utf-8').replace('=', '')
-                payload_str = base64.b64encode(json.dumps(jwt_payload).encode('utf-8')).decode('utf-8').replace('=', '')
-
-                signature = hmac.new(
-                    key.encode('utf-8'),
-                    f"{header_str}.{payload_str}".encode('utf-8'),
-                    'sha256'
-                ).digest()
-
-                jwt_token = f"{header_str}.{payload_str}.{base64.b64encode(signature).decode('utf-8').replace('=', '')}"
-                headers['Authorization'] = f"Bearer {jwt_token}"
-
-                payload = {
-                    'model': self.model,
-                    'messages': messages,
-                    'stream': False,
-                    'temperature': 0.7,
-                    'top_p': 0.7,
-                    'max_tokens': self.max_tokens,
-                    'tools': [],
-                    'request_id': f'summary_{int(time.time())}'
-                }
-            except Exception as e:
-                logger.error(f"[ChatSummary] 生成智谱 API Token 失败: {e}")
-                raise ValueError(f"生成智谱 API Token 失败: {e}")
-
-        elif self.bot_type == 'deepseek':
-            headers['Authorization'] = f"Bearer {self.api_key}"
-            headers['Host'] = urlparse(self.api_base).netloc
             payload = {
-                'model': self.model,
+                'model': model,
+                'messages': messages,
+                'stream': False,
+                'temperature': 0.7,
+                'top_p': 0.7,
+                'max_tokens': self.max_tokens,
+                'tools': [],
+                'request_id': f'summary_{int(time.time())}'
+            }
+        elif bot_type == 'deepseek':
+            payload = {
+                'model': model,
                 'messages': messages,
                 'max_tokens': self.max_tokens
             }
-        elif self.bot_type == 'siliconflow':
-             headers['Authorization'] = f"Bearer {self.api_key}"
-
+        elif bot_type == 'siliconflow':
              payload = {
-                 'model': self.model,
+                 'model': model,
                  'messages': messages,
                  'max_tokens': self.max_tokens
              }
         else:
              # 默认使用 OpenAI 兼容格式
-             headers['Authorization'] = f"Bearer {self.api_key}"
              payload = {
-                 'model': self.model,
+                 'model': model,
                  'messages': messages,
                  'max_tokens': self.max_tokens
              }
-
-        # 确保返回三个值
-        return headers, payload, self.api_base # 返回 api_base
+        return payload
 
     def _insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered = 0):
-        """将记录插入到数据库"""
+        """将记录放入写入队列 (未启用队列时直接写入数据库)"""
+        try:
+            record = (str(session_id), int(msg_id), str(user), str(content), str(msg_type), int(timestamp), int(is_triggered))
+        except (TypeError, ValueError) as e:
+            logger.error(f"[ChatSummary] Invalid record skipped: {e} | Data: session={session_id}, msg={msg_id}, user={user}, type={msg_type}, ts={timestamp}, trig={is_triggered}")
+            return
+        # 总结行的前缀 (时间、用户) 在接收时计算一次，随记录一起存储
+        line_prefix = None
+        if schema.is_summarizable(schema.type_code(record[4]), record[3]):
+            line_prefix = self._format_prefix(record[2], record[5])
+        record += (line_prefix,)
+        logger.debug(f"[ChatSummary] Queueing record: sessionid={session_id}, msgid={msg_id}, user={user}, content_len={len(content) if content else 0}, type={msg_type}, ts={timestamp}, triggered={is_triggered}")
+        if self.ingest_queue is not None:
+            self.ingest_queue.put(record)
+            return
         try:
-            c = self.conn.cursor()
-            logger.debug(f"[ChatSummary] Attempting to insert record: sessionid={session_id}, msgid={msg_id}, user={user}, content_len={len(content) if content else 0}, type={msg_type}, ts={timestamp}, triggered={is_triggered}")
-            c.execute("INSERT OR REPLACE INTO chat_records VALUES (?,?,?,?,?,?,?)",
-                      (str(session_id), int(msg_id), str(user), str(content), str(msg_type), int(timestamp), int(is_triggered)))
-            self.conn.commit()
-            logger.debug(f"[ChatSummary] Record inserted successfully for session {session_id}, msgid {msg_id}")
+            self._write_records([record])
         except sqlite3.Error as e:
-            logger.error(f"[ChatSummary] Database error occurred during insert: {e} | Data: session={session_id}, msg={msg_id}, user={user}, content={content[:50]}..., type={msg_type}, ts={timestamp}, trig={is_triggered}")
+            logger.error(f"[ChatSummary] Database error occurred during insert: {e} | Data: session={session_id}, msg={msg_id}, user={user}, content={str(content)[:50]}..., type={msg_type}, ts={timestamp}, trig={is_triggered}")
         except Exception as e:
             logger.error(f"[ChatSummary] Unexpected error during insert: {e}", exc_info=True)
 
-    def _get_records(self, session_id, start_timestamp=0, limit=9999):
-        """从数据库获取记录 (只获取文本类型)"""
-        c = self.conn.cursor()
-        target_type = str(ContextType.TEXT)
+    def _write_records(self, records):
+        """在一个事务内批量写入记录 (由写入队列的写线程调用)，提交成功后再放入内存缓存"""
+        self.store.append(records)
+        logger.debug(f"[ChatSummary] {len(records)} records committed.")
+        if self.hot_cache is not None:
+            for record in records:
+                if record[7] is not None:
+                    self.hot_cache.add(record[0], record[1], record[5], record[7] + record[3].strip())
+
+    def _shutdown(self):
+        """进程退出时刷新写入队列，保证已接收的消息全部落盘"""
+        if self.ingest_queue is not None:
+            self.ingest_queue.close()
+        self.store.close()
+        self.map_executor.shutdown(wait=False)
+        if self.route_executor is not None:
+            self.route_executor.shutdown(wait=False)
+        if self.result_cache is not None:
+            self.result_cache.close()
+        self.http_pool.close()
+
+    def _iter_records(self, session_id, start_timestamp=0, limit=None):
+        """
+        按时间从新到旧逐条产出可总结的记录 (文本、非空、不以 # 开头)，
+        元组为 (sessionid, msgid, user, content, type, timestamp, is_triggered, line_prefix)。
+
+        记录由存储后端按页读取，limit 为 None 时读完整个时间窗口。
+        """
+        if self.ingest_queue is not None:
+            # 保证命令到达之前入队的消息都已提交，对读可见
+            self.ingest_queue.flush()
         # 确保start_timestamp是整数，避免浮点数比较问题
         start_timestamp = int(start_timestamp)
-        logger.debug(f"[ChatSummary PANDA_DEBUG] _get_records called with session_id='{session_id}', start_timestamp={start_timestamp}, target_type='{target_type}', limit={limit}")
-        query = "SELECT * FROM chat_records WHERE sessionid=? and timestamp>? AND type=? ORDER BY timestamp DESC LIMIT ?"
-        logger.debug(f"[ChatSummary PANDA_DEBUG] _get_records SQL query: {query} with params ({session_id}, {start_timestamp}, {target_type}, {limit})")
-        c.execute(query, (session_id, start_timestamp, target_type, limit))
-        results = c.fetchall()
-        logger.debug(f"[ChatSummary PANDA_DEBUG] _get_records query returned {len(results) if results else 'None'} records.")
-        return results
+        logger.debug(f"[ChatSummary PANDA_DEBUG] _iter_records called with session_id='{session_id}', start_timestamp={start_timestamp}, limit={limit}")
+        yield from self.store.range_scan(str(session_id), start_timestamp, None, limit)
 
     def on_receive_message(self, e_context: EventContext):
         """处理接收到的消息，存储到数据库"""
@@ -378,7 +579,7 @@ class ChatSummary(Plugin):
 
         is_triggered = False
         is_plugin_command = False
-        all_commands = self.print_commands + self.switch_commands + self.summarize_commands + self.image_summarize_commands
+        all_commands = self.print_commands + self.switch_commands + self.summarize_commands + self.image_summarize_commands + self.search_commands
         for cmd in all_commands:
             if content == cmd or content.startswith(cmd + " "):
                 is_plugin_command = True
@@ -407,6 +608,7 @@ class ChatSummary(Plugin):
         args = []
         command_type = None
         summary_type = None
+        use_cache = True
 
         if content in self.print_commands:
             command_found = True
@@ -417,7 +619,7 @@ class ChatSummary(Plugin):
                 if content == cmd or content.startswith(cmd + " "):
                     command_found = True
                     command_type = "summarize"
-                    remaining = content[len(cmd):].strip()
+                    remaining, use_cache = self._strip_cache_bypass(content[len(cmd):].strip())
                     summary_type, args = self._parse_summary_args(remaining)
                     break
             if not command_found:
@@ -425,9 +627,16 @@ class ChatSummary(Plugin):
                     if content == cmd or content.startswith(cmd + " "):
                         command_found = True
                         command_type = "image_summary"
-                        remaining = content[len(cmd):].strip()
+                        remaining, use_cache = self._strip_cache_bypass(content[len(cmd):].strip())
                         summary_type, args = self._parse_summary_args(remaining)
                         break
+            if not command_found:
+                for cmd in self.search_commands:
+                    if content.startswith(cmd + " "):
+                        command_found = True
+                        command_type = "search"
+                        args = [content[len(cmd):].strip()]
+                        break
             if not command_found:
                 for cmd in self.switch_commands:
                      if content.startswith(cmd + " "):
@@ -442,13 +651,24 @@ class ChatSummary(Plugin):
             action = EventAction.BREAK_PASS
 
             if command_type == "summarize":
-                reply_content = self._handle_summarize(args, e_context, summary_type)
+                reply_content = self._run_coalesced(e_context, command_type, summary_type, args, use_cache,
+                                                    lambda: self._handle_summarize(args, e_context, summary_type, use_cache))
                 logger.debug(f"[ChatSummary] _handle_summarize returned: '{reply_content[:100]}...' (type: {type(reply_content)})")
                 if reply_content:
                     reply = Reply(ReplyType.TEXT, reply_content)
             elif command_type == "image_summary":
-                self._handle_text_summary_to_image(args, e_context, summary_type)
+                result = self._run_coalesced(e_context, command_type, summary_type, args, use_cache,
+                                             lambda: self._image_summary_result(args, e_context, summary_type, use_cache))
+                if result is not None:
+                    # 图片内容按请求各自包装为 BytesIO，共享同一结果的回复互不影响读取位置
+                    reply_type, content = result
+                    e_context["reply"] = Reply(reply_type, io.BytesIO(content) if reply_type == ReplyType.IMAGE else content)
+                e_context.action = EventAction.BREAK_PASS
                 return
+            elif command_type == "search":
+                reply_content = self._handle_search(args[0], e_context)
+                if reply_content:
+                    reply = Reply(ReplyType.TEXT, reply_content)
             elif command_type == "print" or command_type == "switch":
                 reply_content = self._handle_model_command(args, e_context, command_type)
                 if reply_content:
@@ -473,6 +693,43 @@ class ChatSummary(Plugin):
             logger.debug(f"[ChatSummary] 未匹配到任何已知命令: '{content}'")
             e_context.action = EventAction.CONTINUE
 
+    def _run_coalesced(self, e_context: EventContext, command_type, summary_type, args, use_cache, handler):
+        """
+        同一会话中 (命令, 窗口) 相同的并发请求只执行一次 handler，join_window 内到达的请求等待并共享其结果。
+
+        键中包含 use_cache：带刷新参数的请求只与其它刷新请求合并，不会拿到可能来自缓存的结果。
+        """
+        if self.single_flight is None:
+            return handler()
+        context = e_context['context']
+        msg = context['msg']
+        session_id = msg.other_user_id if context.get("isgroup", False) and msg.other_user_id else msg.from_user_id
+        result, shared = self.single_flight.do((str(session_id), command_type, summary_type, tuple(args), use_cache),
+                                               handler)
+        if shared:
+            logger.info(f"[ChatSummary] Joined an in-flight {command_type} ({summary_type} {args}) for session {session_id}, "
+                        f"reusing its result.")
+        return result
+
+    def _image_summary_result(self, args, e_context: EventContext, summary_type, use_cache):
+        """执行图片总结并返回可共享的 (回复类型, 内容)，图片内容为 bytes；没有回复时返回 None"""
+        self._handle_text_summary_to_image(args, e_context, summary_type, use_cache)
+        try:
+            reply = e_context["reply"]
+        except KeyError:
+            return None
+        if reply is None:
+            return None
+        content = reply.content.getvalue() if isinstance(reply.content, io.BytesIO) else reply.content
+        return reply.type, content
+
+    def _strip_cache_bypass(self, remaining: str) -> tuple[str, bool]:
+        """去掉命令末尾跳过结果缓存的参数 (如 "c总结 12h 刷新")，返回 (其余参数, 是否使用缓存)"""
+        parts = remaining.split()
+        if parts and parts[-1].lower() in (arg.lower() for arg in self.cache_bypass_args):
+            return " ".join(parts[:-1]), False
+        return remaining, True
+
     def _parse_summary_args(self, remaining: str) -> tuple[str, list[str]]:
         """解析总结命令的参数 (数量或时间)"""
         if not remaining:
@@ -536,6 +793,8 @@ class ChatSummary(Plugin):
                     self._set_current_model_config() # 会验证新模型的 key
                     self.config['default_bot_type'] = target_bot_type
                     self._save_config()
+                    # 旧模型的连接在在途请求结束后关闭，切回时重新建立
+                    self.http_pool.reset(old_bot_type)
                     return f"✅已切换文本总结模型: {target_bot_type} ({model_info.get(target_bot_type, '?')})"
                 except Exception as e:
                     logger.error(f"[ChatSummary] 切换到文本模型 {target_bot_type} 失败: {e}")
@@ -550,7 +809,7 @@ class ChatSummary(Plugin):
             logger.error(f"[ChatSummary] 处理模型命令时发生错误: {e}", exc_info=True)
             return f"处理命令时发生错误: {e}"
 
-    def _handle_summarize(self, args, e_context: EventContext, summary_type="count"):
+    def _handle_summarize(self, args, e_context: EventContext, summary_type="count", use_cache=True):
         """处理文本总结命令"""
         try:
             msg = e_context['context']['msg']
@@ -564,6 +823,13 @@ class ChatSummary(Plugin):
 
             messages, actual_count = "", 0
             time_info = ""
+            # 读取时即按输入预算截断，只保留能放入 max_input_tokens 的最新消息
+            tokenizer = self._tokenizer()
+            budget_tokens = self.max_input_tokens - tokenizer.count(self.prompt + self.transcript_header)
+            if budget_tokens <= 0:
+                return f"总结失败：Prompt 已超出输入上限 ({self.max_input_tokens} tokens)，请调大 max_input_tokens。"
+            read_budget = self._read_budget(budget_tokens)
+            started = time.perf_counter()
 
             if summary_type == "time":
                 hours = int(args[0])
@@ -571,11 +837,11 @@ class ChatSummary(Plugin):
                 current_timestamp = int(time.time())
                 start_timestamp = current_timestamp - (hours * 3600)
                 logger.debug(f"[ChatSummary] 计算时间范围: 当前时间戳={current_timestamp}, 开始时间戳={start_timestamp}, 时间范围={hours}小时")
-                messages, actual_count = self._get_chat_messages_by_time(session_id, start_timestamp)
+                messages, actual_count = self._get_chat_messages_by_time(session_id, start_timestamp, read_budget)
                 time_info = f"过去{hours}小时内"
             else: # count
                 requested_count = int(args[0])
-                messages, actual_count = self._get_chat_messages_by_count(session_id, requested_count)
+                messages, actual_count = self._get_chat_messages_by_count(session_id, requested_count, read_budget)
                 time_info = f"最近{actual_count}"
             
             logger.debug(f"[ChatSummary PANDA_DEBUG] _handle_summarize after get_chat_messages: actual_count={actual_count}, messages_len={len(messages) if messages else 0}")
@@ -583,189 +849,477 @@ class ChatSummary(Plugin):
             if not messages:
                 return f"在{time_info}没有找到可总结的消息。"
 
-            # 使用文本总结的 Prompt
-            final_prompt = self.prompt.format(
-                custom_prompt=f"本次总结的是{time_info}的 {actual_count} 条消息。"
-            )
-
-            # 检查 Token 数量
-            estimated_input_tokens = len(final_prompt) + len(messages) # 粗略估计
-            if estimated_input_tokens > self.max_input_tokens:
-                available_tokens = self.max_input_tokens - len(final_prompt) - 100 # 保留余量
-                messages = messages[-available_tokens:] # 简单截断尾部
-                logger.warning(f"[ChatSummary] Input tokens exceeded limit, truncating messages to fit {self.max_input_tokens} tokens.")
+            # 放不下时先分段生成要点，再用文本总结的 Prompt 汇总
+            read_ms = (time.perf_counter() - started) * 1000
+            window_start = start_timestamp if summary_type == "time" else None
+            digests, digest_count = self._map_reduce(tokenizer, messages, budget_tokens, read_ms, session_id, window_start,
+                                                     use_cache)
+
+            # 使用文本总结的 Prompt，按完整输入精确计数，超出时从最旧的消息 (或要点段落) 整条丢弃
+            def render(lines):
+                if digests is not None:
+                    final_prompt = self.prompt.format(
+                        custom_prompt=f"本次总结的是{time_info}的 {digest_count} 条消息，消息较多，已先按时间分段提炼要点。"
+                    )
+                    return final_prompt + self.digest_header + "\n\n".join(lines)
+                final_prompt = self.prompt.format(
+                    custom_prompt=f"本次总结的是{time_info}的 {len(lines)} 条消息。"
+                )
+                return final_prompt + self.transcript_header + "\n".join(lines)
+
+            if digests is not None:
+                messages = digests
+
+            full_content_for_llm = self._fit_input(tokenizer, messages, render)
+            if full_content_for_llm is None:
+                return f"总结失败：Prompt 已超出输入上限 ({self.max_input_tokens} tokens)，请调大 max_input_tokens。"
 
             # 生成总结
-            full_content_for_llm = final_prompt + "\n\n以下是需要总结的群聊内容：\n" + messages
-            summary = self._call_llm_api(full_content_for_llm)
+            sender = self._paragraph_sender(e_context)
+            started = time.perf_counter()
+            summary = self._cached_llm_call(full_content_for_llm, on_delta=sender.feed if sender else None, use_cache=use_cache)
+            if digests is not None:
+                logger.info(f"[ChatSummary MapReduce] Reduce stage finished in {(time.perf_counter() - started) * 1000:.0f} ms.")
+            if sender is not None and sender.sent and not summary.startswith("总结失败："):
+                # 前面的段落已经发出，最终回复只包含最后一段
+                logger.info(f"[ChatSummary] Sent {sender.sent} partial replies while streaming.")
+                summary = sender.remainder() or summary
             logger.debug(f"[ChatSummary] _call_llm_api returned for text summary: '{summary[:100]}...' (type: {type(summary)})")
             return summary
 
+        except MapReduceError as e:
+            return f"总结失败：{e}，已完成的段落已缓存，可稍后重试。"
         except Exception as e:
             logger.error(f"[ChatSummary] 文本总结消息失败: {e}", exc_info=True)
             # 返回错误信息字符串，确保非空
             return f"文本总结失败: {e}"
 
-    def _get_chat_messages_by_time(self, session_id, start_timestamp):
-        """按时间范围获取文本聊天记录"""
+    def _handle_search(self, query, e_context: EventContext):
+        """处理聊天记录搜索命令 (全文索引检索，不调用大模型)"""
+        if self.search_index is None:
+            return "聊天记录搜索功能未启用。"
+        try:
+            msg = e_context['context']['msg']
+            session_id = msg.from_user_id
+            if e_context['context'].get("isgroup", False) and msg.other_user_id:
+                session_id = msg.other_user_id
+            elif not session_id:
+                return "无法确定会话ID，无法搜索。"
+
+            # 末尾的 Xh / Xd 限定时间范围，例如: c搜索 张三 7d
+            start_timestamp, time_info = 0, ""
+            terms = query.split()
+            if len(terms) > 1 and terms[-1][:-1].isdigit() and terms[-1][-1:].lower() in ("h", "d"):
+                amount, unit = int(terms[-1][:-1]), terms[-1][-1].lower()
+                start_timestamp = int(time.time()) - amount * (3600 if unit == "h" else 86400)
+                time_info = f"过去{amount}{'小时' if unit == 'h' else '天'}内"
+                query = " ".join(terms[:-1])
+
+            if self.ingest_queue is not None:
+                self.ingest_queue.flush()
+            conn = self.db.reader()
+            sid = self.session_names.lookup(conn, str(session_id))
+            if sid is None:
+                return f"{time_info}没有找到包含「{query}」的消息。"
+            start = time.perf_counter()
+            all_commands = self.print_commands + self.switch_commands + self.summarize_commands + self.image_summarize_commands + self.search_commands
+            total, results = self.search_index.search(
+                conn, sid, query,
+                limit=self.config.get("search", {}).get("result_limit", 10),
+                start_timestamp=start_timestamp,
+                exclude_prefixes=all_commands,
+            )
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if not results:
+                return f"{time_info}没有找到包含「{query}」的消息。"
+
+            lines = [f"🔍 {time_info}找到 {total} 条包含「{query}」的消息 (显示 {len(results)} 条，耗时 {elapsed_ms:.0f}ms)："]
+            for timestamp, user_id, snippet in results:
+                time_str = time.strftime("%m-%d %H:%M", time.localtime(timestamp))
+                user = self.user_names.name_of(conn, user_id) or "未知用户"
+                lines.append(f"[{time_str}] {user}: {snippet}")
+            return "\n".join(lines)
+        except Exception as e:
+            logger.error(f"[ChatSummary] 搜索聊天记录失败: {e}", exc_info=True)
+            return f"搜索失败: {e}"
+
+    def _hot_lines(self, lookup, session_id, argument):
+        """
+        从内存缓存读取总结行 (lookup 为 "window" 或 "tail")，未启用或未命中时返回 None。
+
+        缓存只包含已提交的消息，先等待写入队列中已有的消息落盘。
+        """
+        if self.hot_cache is None:
+            return None
+        if self.ingest_queue is not None:
+            self.ingest_queue.flush()
+        return getattr(self.hot_cache, lookup)(session_id, argument)
+
+    def _get_chat_messages_by_time(self, session_id, start_timestamp, budget_tokens=None):
+        """按时间范围获取聊天记录行 (窗口内全部有效消息，超出 budget_tokens 时保留最新的部分)"""
         try:
             # 确保start_timestamp是整数，避免浮点数比较问题
             start_timestamp = int(start_timestamp)
             logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_time called for session_id='{session_id}', start_timestamp={start_timestamp}")
-            records = self._get_records(session_id, start_timestamp, 1000) # Limit 足够大
-            logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_time received {len(records) if records else 'None'} records from _get_records.")
-            if not records:
-                return None, 0
-
-            formatted_messages = []
-            actual_msg_count = 0
-            processed_msg_ids = set() # 避免重复记录 (虽然主键应该保证唯一性)
-
-            for record in reversed(records): # 从旧到新
-                msg_id = record[1]
-                if msg_id in processed_msg_ids: continue
-                processed_msg_ids.add(msg_id)
-
-                content = record[3]
-                user = record[2] or "未知用户"
-                timestamp = record[5]
-                is_triggered = record[6] # 0 or 1 # We keep reading this for logging/potential future use, but don't filter on it anymore
-                logger.debug(f"[ChatSummary PANDA_DEBUG] Processing record: msg_id={msg_id}, user='{user}', ts={timestamp}, is_triggered={is_triggered}, content_preview='{str(content)[:50]}...'")
-
-                # --- 修改开始 ---
-                # 只添加非空且不以 # 开头的内容
-                if content and not content.strip().startswith('#'):
-                    time_str = time.strftime("%m-%d %H:%M", time.localtime(timestamp))
-                    # <T> 标记逻辑可以保留或移除，取决于 Prompt 是否需要
-                    user_marker = "<T>" if user.lower() in ["system", "admin"] else ""
-                    formatted_messages.append(f"{user_marker}[{time_str}] {user}: {content.strip()}")
-                    actual_msg_count += 1
-                else:
-                    # 更新日志，反映新的跳过原因
-                    starts_with_hash = content.strip().startswith('#') if content else False
-                    logger.debug(f"[ChatSummary PANDA_DEBUG] Skipping record: msg_id={msg_id}. Reason: content_empty={not bool(content)}, starts_with_hash={starts_with_hash}")
-                # --- 修改结束 ---
-
-            if not formatted_messages:
-                logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_time: No formatted messages after filtering.")
-                return None, 0
-            
-            logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_time returning {len(formatted_messages)} formatted messages, actual_msg_count={actual_msg_count}")
-            return "\n".join(formatted_messages), actual_msg_count
+            lines = self._hot_lines("window", session_id, start_timestamp)
+            if lines is None:
+                lines = self._iter_lines(self._iter_records(session_id, start_timestamp))
+            return self._build_transcript(lines, budget_tokens)
         except Exception as e:
             logger.error(f"[ChatSummary] 获取时间范围消息失败: {e}")
             return None, 0
 
-    def _get_chat_messages_by_count(self, session_id, msg_count):
-        """按消息数量获取文本聊天记录"""
+    def _get_chat_messages_by_count(self, session_id, msg_count, budget_tokens=None):
+        """按消息数量获取聊天记录行 (恰好读取 msg_count 条有效消息，超出 budget_tokens 时保留最新的部分)"""
         try:
-            # 稍微多获取一些记录，因为需要跳过触发消息
-            limit = int(msg_count * 1.5) + 10 # 增加获取量
-            # 获取最近 N 天可能不够，直接按 limit 获取最新的
-            logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_count called for session_id='{session_id}', msg_count={msg_count}, calculated_limit={limit}") # PANDA_DEBUG
-            # 确保使用整数时间戳，0表示获取所有记录
-            start_timestamp = 0
-            logger.debug(f"[ChatSummary] 获取消息: 开始时间戳={start_timestamp} (获取所有记录)")
-            records = self._get_records(session_id, start_timestamp, limit) # start_timestamp=0 获取所有
-            logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_count received {len(records) if records else 'None'} records from _get_records.") # PANDA_DEBUG
-
-            if not records:
-                return None, 0
-
-            formatted_messages = []
-            actual_msg_count = 0
-            processed_msg_ids = set()
-
-            # records 是按 timestamp DESC 排序的，所以直接遍历就是从新到旧
-            for record in records:
-                if actual_msg_count >= msg_count: # 达到目标数量就停止
-                     break
-
-                msg_id = record[1]
-                if msg_id in processed_msg_ids: continue
-                processed_msg_ids.add(msg_id)
-
-                content = record[3]
-                user = record[2] or "未知用户"
-                timestamp = record[5]
-                is_triggered = record[6]
-                logger.debug(f"[ChatSummary PANDA_DEBUG] Processing record (count): msg_id={msg_id}, user='{user}', ts={timestamp}, is_triggered={is_triggered}, content_preview='{str(content)[:50]}...'") # PANDA_DEBUG
-
-                # --- 修改开始 ---
-                # 只添加非空且不以 # 开头的内容
-                if content and not content.strip().startswith('#'):
-                    time_str = time.strftime("%m-%d %H:%M", time.localtime(timestamp))
-                    user_marker = "<T>" if user.lower() in ["system", "admin"] else ""
-                    # 插入到列表开头，保持时间从旧到新
-                    formatted_messages.insert(0, f"{user_marker}[{time_str}] {user}: {content.strip()}")
-                    actual_msg_count += 1
-                else: # PANDA_DEBUG
-                     # 更新日志，反映新的跳过原因
-                     starts_with_hash = content.strip().startswith('#') if content else False
-                     logger.debug(f"[ChatSummary PANDA_DEBUG] Skipping record (count): msg_id={msg_id}. Reason: content_empty={not bool(content)}, starts_with_hash={starts_with_hash}") # PANDA_DEBUG
-                # --- 修改结束 ---
-
-            if not formatted_messages:
-                logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_count: No formatted messages after filtering.") # PANDA_DEBUG
-                return None, 0
-
-            logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_count returning {len(formatted_messages)} formatted messages, actual_msg_count={actual_msg_count}") # PANDA_DEBUG
-            return "\n".join(formatted_messages), actual_msg_count
+            logger.debug(f"[ChatSummary PANDA_DEBUG] _get_chat_messages_by_count called for session_id='{session_id}', msg_count={msg_count}")
+            # 过滤已在 SQL 中完成，start_timestamp=0 获取所有记录中最新的 msg_count 条
+            lines = self._hot_lines("tail", session_id, msg_count)
+            if lines is None:
+                lines = self._iter_lines(self._iter_records(session_id, 0, msg_count))
+            return self._build_transcript(lines, budget_tokens)
         except Exception as e:
             logger.error(f"[ChatSummary] 获取指定数量消息失败: {e}")
             return None, 0
 
-    def _call_llm_api(self, prompt):
-        """调用文本 LLM API 生成总结 (包括处理 JSON 的情况)"""
+    @staticmethod
+    def _format_prefix(user, timestamp):
+        """生成总结行的前缀 "[时间] 用户: " (格式变化时需递增 line_format_version)"""
+        user = user or "未知用户"
+        time_str = time.strftime("%m-%d %H:%M", time.localtime(timestamp))
+        # <T> 标记逻辑可以保留或移除，取决于 Prompt 是否需要
+        user_marker = "<T>" if user.lower() in ["system", "admin"] else ""
+        return f"{user_marker}[{time_str}] {user}: "
+
+    def _iter_lines(self, records):
+        """将 _iter_records 产出的记录拼接为总结行；提前停止时结束记录生成器，释放读事务"""
+        try:
+            for record in records:
+                yield record[7] + record[3].strip()
+        finally:
+            records.close()
+
+    def _build_transcript(self, lines, budget_tokens=None):
+        """
+        将从新到旧的格式化行整理为 (从旧到新的行列表, 条数)。
+
+        累计 token 数超过 budget_tokens 时停止读取，因此内存占用受预算限制，
+        且截断发生在整行边界上、保留的是最新的消息。
+        """
+        try:
+            if budget_tokens is None:
+                kept = list(lines)
+            else:
+                kept, truncated = pack_newest(self._tokenizer(), lines, budget_tokens)
+                if truncated:
+                    logger.warning(f"[ChatSummary] Transcript reached the input budget ({budget_tokens} tokens) after {len(kept)} messages, older messages skipped.")
+        finally:
+            if hasattr(lines, "close"):
+                lines.close()
+        if not kept:
+            return None, 0
+        kept.reverse() # 从旧到新
+        logger.debug(f"[ChatSummary PANDA_DEBUG] _build_transcript returning {len(kept)} formatted messages")
+        return kept, len(kept)
+
+    def _read_budget(self, budget_tokens):
+        """读取聊天记录的 token 上限：启用分段总结时可读取 max_chunks 个输入预算的消息"""
+        return budget_tokens * self.map_max_chunks if self.map_reduce_enabled else budget_tokens
+
+    def _map_reduce(self, tokenizer, lines, budget_tokens, read_ms=0.0, session_id=None, start_timestamp=None,
+                    use_cache=True):
+        """
+        消息超出单次输入预算时，并发生成各段要点，返回 (按时间排列的要点段落, 覆盖的消息条数)；
+        未启用或一次放得下时返回 (None, 0)。有段落生成失败时抛出 MapReduceError，已完成的段落留在缓存中。
+
+        启用分段要点缓存 (partial_summaries) 时按固定时间桶分段并复用已结束的桶 (见 _bucket_digests)，
+        窗口超过 min_window_tokens 时即使一次放得下也使用；否则按消息边界均分。
+        start_timestamp 为窗口起点 (不含)，按条数总结时传 None；读取的消息因 max_chunks 被截断时，
+        以最早读到的消息为起点，与按消息边界分段覆盖的范围相同。
+        use_cache 为 False (命令带刷新参数) 时不复用段落要点缓存和已保存的桶要点，但仍用新结果刷新它们。
+        """
+        if not self.map_reduce_enabled:
+            return None, 0
+        total = sum(tokenizer.count(line) + 1 for line in lines)
+        use_buckets = self.bucket_summaries is not None and session_id is not None
+        if total <= budget_tokens and not (use_buckets and self.bucket_min_window_tokens and total > self.bucket_min_window_tokens):
+            return None, 0
+        if use_buckets:
+            oldest_start = self._count_window_start(session_id, len(lines))
+            start_timestamp = oldest_start if start_timestamp is None else max(int(start_timestamp), oldest_start)
+            return self._bucket_digests(tokenizer, session_id, start_timestamp, read_ms, use_cache)
+        map_prompt = self.map_prompt.format(max_chars=self.map_summary_chars) + "\n\n"
+        chunks = split_chunks(tokenizer, lines, self.max_input_tokens - tokenizer.count(map_prompt))
+        prompts = [map_prompt + "\n".join(chunk) for chunk in chunks]
+        keys = [chunk_key(self.bot_type, self.model, prompt) for prompt in prompts]
+        summaries, stats = map_chunks(self.map_executor, self._map_call, prompts, keys, self.chunk_cache, use_cache)
+        logger.info(f"[ChatSummary MapReduce] {len(lines)} messages in {len(chunks)} chunks: read={read_ms:.0f} ms, "
+                    f"map={stats['map_ms']:.0f} ms (slowest chunk {stats['slowest_chunk_ms']:.0f} ms, "
+                    f"{stats['cached']} cached)")
+        digests = []
+        for index, (chunk, summary) in enumerate(zip(chunks, summaries)):
+            times = [match.group(1) for match in (self._LINE_TIME.search(chunk[0]), self._LINE_TIME.search(chunk[-1])) if match]
+            span = f" {times[0]} ~ {times[-1]}" if times else ""
+            digests.append(f"【第 {index + 1}/{len(chunks)} 段{span}，{len(chunk)} 条消息】\n{summary}")
+        return digests, len(lines)
+
+    def _bucket_digests(self, tokenizer, session_id, start_timestamp, read_ms=0.0, use_cache=True):
+        """
+        按固定时间桶 (bucket_minutes，UTC 对齐) 生成窗口 (start_timestamp, 现在] 的要点段落，返回 (段落, 消息条数)。
+
+        已结束且完整落在窗口内的桶直接复用保存的要点；其余的桶 (缺失的、仍在进行中的、被窗口起点截断的)
+        读取原文：不超过 raw_tokens 的直接以原文参与汇总，更长的并发生成要点，其中已结束的完整桶保存下来。
+        逐桶生成的段数超过 max_chunks 时，相邻的缺失桶合并后按输入预算切块，段数与按消息边界分段时相当。
+        use_cache 为 False 时所有桶都重新生成，已结束的完整桶仍保存新的要点。
+        """
+        started = time.perf_counter()
+        if self.ingest_queue is not None:
+            # 按条数总结可能由内存缓存直接返回，这里保证已入队的消息对按桶读取可见
+            self.ingest_queue.flush()
+        now = int(time.time())
+        size = self.bucket_seconds
+        model_key = f"{self.bot_type}:{self.model}"
+        template = self.map_prompt.format(max_chars=self.bucket_summary_chars) + "\n\n"
+        prompt_version = chunk_key(template)[:16]
+        first = (start_timestamp + 1) // size * size
+        buckets = list(range(first, now + 1, size))
+
+        def reusable(bucket):
+            return bucket + size + self.bucket_close_grace <= now and not (bucket == first and start_timestamp + 1 > first)
+
+        def clock(timestamp):
+            return time.strftime('%m-%d %H:%M', time.localtime(timestamp))
+
+        saved = self.bucket_summaries.get_many(session_id, [b for b in buckets if reusable(b)], model_key,
+                                               prompt_version) if use_cache else {}
+        chunk_budget = self.max_input_tokens - tokenizer.count(template)
+        entries, pending = [], []
+        saved_tokens = 0
+        for bucket in buckets:
+            # (排序键, 时间范围标签)
+            span = (bucket, f"{clock(max(bucket, start_timestamp + 1))} ~ {clock(min(bucket + size, now))}")
+            if bucket in saved:
+                count, tokens, summary = saved[bucket]
+                saved_tokens += tokens
+                if count:
+                    entries.append(span + (count, summary, False))
+                continue
+            records = self.store.range_scan(str(session_id), max(start_timestamp, bucket - 1), min(bucket + size - 1, now))
+            lines = list(self._iter_lines(records))
+            lines.reverse()  # 从旧到新
+            if lines:
+                tokens = sum(tokenizer.count(line) + 1 for line in lines)
+                chunks = split_chunks(tokenizer, lines, chunk_budget) if tokens > self.bucket_raw_tokens else []
+                pending.append((bucket, span, lines, tokens, chunks))
+
+        # (时间范围, 条数, 原文 token 数, 块列表, 完成后保存的桶)
+        groups = [(span, len(lines), tokens, chunks, bucket if reusable(bucket) else None)
+                  for bucket, span, lines, tokens, chunks in pending if chunks]
+        merged = sum(len(chunks) for *_, chunks, _ in groups) > self.map_max_chunks
+        if merged:
+            # 逐桶生成的段数超出 max_chunks 时，把相邻的缺失桶合并后按 token 预算重新切块，
+            # 合并的段落跨越多个桶，不再按桶保存
+            runs = []
+            for item in pending:
+                if runs and item[0] == runs[-1][-1][0] + size:
+                    runs[-1].append(item)
+                else:
+                    runs.append([item])
+            groups = []
+            for run in runs:
+                if len(run) == 1:
+                    bucket, span, lines, tokens, chunks = run[0]
+                    if chunks:
+                        groups.append((span, len(lines), tokens, chunks, bucket if reusable(bucket) else None))
+                    else:
+                        entries.append(span + (len(lines), "\n".join(lines), True))
+                    continue
+                lines = [line for _, _, bucket_lines, _, _ in run for line in bucket_lines]
+                owners = [bucket for bucket, _, bucket_lines, _, _ in run for _ in bucket_lines]
+                offset = 0
+                for chunk in split_chunks(tokenizer, lines, chunk_budget):
+                    times = [match.group(1) for match in (self._LINE_TIME.search(chunk[0]), self._LINE_TIME.search(chunk[-1])) if match]
+                    span = (owners[offset], f"{times[0]} ~ {times[-1]}" if times else clock(owners[offset]))
+                    groups.append((span, len(chunk), sum(tokenizer.count(line) + 1 for line in chunk), [chunk], None))
+                    offset += len(chunk)
+        else:
+            entries.extend(span + (len(lines), "\n".join(lines), True)
+                           for _, span, lines, _, chunks in pending if not chunks)
+        prompts = [template + "\n".join(chunk) for *_, chunks, _ in groups for chunk in chunks]
+        sent_tokens = sum(tokens for _, _, tokens, _, _ in groups)
+        scan_ms = (time.perf_counter() - started) * 1000
+
+        keys = [chunk_key(model_key, prompt) for prompt in prompts]
+        summaries, stats = map_chunks(self.map_executor, self._map_call, prompts, keys, self.chunk_cache, use_cache)
+        uncacheable = set(stats["uncacheable"])
+        offset = 0
+        for span, count, tokens, chunks, bucket in groups:
+            summary = "\n".join(summaries[offset:offset + len(chunks)])
+            foreign = any(index in uncacheable for index in range(offset, offset + len(chunks)))
+            offset += len(chunks)
+            entries.append(span + (count, summary, False))
+            if bucket is not None and not foreign:
+                self.bucket_summaries.put(session_id, bucket, bucket + size, model_key, prompt_version, count, tokens, summary)
+
+        if not entries:
+            return None, 0
+        digests, total = [], 0
+        for _, span, count, text, raw in sorted(entries, key=lambda entry: entry[0]):
+            total += count
+            digests.append(f"【{span}，{count} 条消息{' (原文)' if raw else ''}】\n{text}")
+        logger.info(f"[ChatSummary Buckets] {len(buckets)} buckets: {len(saved)} reused (~{saved_tokens} input tokens saved), "
+                    f"{len(pending)} read, summarized in {len(prompts)} chunks{' (adjacent buckets merged)' if merged else ''} "
+                    f"({stats['cached']} cached, ~{sent_tokens} input tokens), "
+                    f"{sum(1 for entry in entries if entry[4])} sent as raw text; "
+                    f"read={read_ms + scan_ms:.0f} ms, map={stats['map_ms']:.0f} ms")
+        return digests, total
+
+    def _map_call(self, prompt):
+        """
+        生成一段要点 (在 map_executor 线程中执行)，返回 (要点, 是否由当前模型生成)；失败时抛出 MapReduceError。
+
+        failover / 对冲由其他模型生成的要点不写入以当前模型为键的缓存。
+        """
+        summary, provider = self._call_llm_api(prompt)
+        if summary.startswith("总结失败："):
+            raise MapReduceError(summary[len("总结失败："):])
+        return summary, provider == self.bot_type
+
+    def _tokenizer(self):
+        """当前文本模型的 tokenizer (按模型名选择编码)"""
+        return self.tokenizers.for_model(self.model)
+
+    def _fit_input(self, tokenizer, lines, render):
+        """
+        render(lines) 生成发送给模型的完整输入；超出 max_input_tokens 时从最旧的消息开始整条丢弃。
+
+        返回放入预算的输入文本，Prompt 本身已超出预算 (一条消息也放不下) 时返回 None。
+        """
+        kept = fit_oldest(tokenizer, lines, render, self.max_input_tokens)
+        if not kept:
+            return None
+        if len(kept) < len(lines):
+            logger.warning(f"[ChatSummary] Input exceeded {self.max_input_tokens} tokens, dropped the {len(lines) - len(kept)} oldest messages.")
+        return render(kept)
+
+    def _paragraph_sender(self, e_context):
+        """流式生成文本总结时按段落提前发送 (streaming.incremental_reply)，不可用时返回 None"""
+        streaming_config = self.config.get("streaming", {})
+        if not self.llm_streaming or not streaming_config.get("incremental_reply", False):
+            return None
+        try:
+            channel, context = e_context["channel"], e_context["context"]
+        except KeyError:
+            return None
+        if channel is None:
+            return None
+        return ParagraphSender(lambda text: channel.send(Reply(ReplyType.TEXT, text), context),
+                               streaming_config.get("segment_chars", 300))
+
+    def _cached_llm_call(self, prompt, on_delta=None, use_cache=True):
+        """
+        带结果缓存的 _call_llm_api：键为 (最终 Prompt, 模型, 请求参数) 的哈希，只缓存成功的结果。
+
+        命中时把缓存的全文作为一段增量交给 on_delta，调用方的流式处理 (分批回复、JSON 解析) 照常进行。
+        use_cache 为 False 时跳过查询，但仍用新结果刷新缓存。
+        """
+        if self.result_cache is None:
+            return self._call_llm_api(prompt, on_delta)[0]
+        payload = self._build_payload(prompt)
+        params = {name: value for name, value in payload.items() if name not in ("messages", "stream", "request_id")}
+        key = result_key(prompt, bot_type=self.bot_type, api_base=self.api_base, **params)
+        if use_cache:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                logger.info(f"[ChatSummary] Summary served from the result cache ({len(cached)} chars).")
+                if on_delta is not None:
+                    on_delta(cached)
+                return cached
+        result, provider = self._call_llm_api(prompt, on_delta)
+        if provider != self.bot_type:
+            # 由其他模型代答 (failover / 对冲) 的结果不缓存在当前模型的键下
+            logger.debug(f"[ChatSummary] Summary served by '{provider}', not caching it under '{self.bot_type}'.")
+        elif result and not result.startswith("总结失败："):
+            self.result_cache.put(key, result)
+        return result
+
+    def _call_llm_api(self, prompt, on_delta=None):
+        """
+        调用文本 LLM API 生成总结 (包括处理 JSON 的情况)，返回 (文本, 给出结果的模型)
+
+        启用流式输出时，on_delta(text) 在每段增量文本到达时调用，返回 True 表示不再需要后续输出。
+        请求由 router 发给当前模型，启用 failover 时失败或超时改用其他已配置的模型 (见 routing 配置)。
+        """
+        return self.router.call(self.bot_type, prompt, on_delta)
+
+    def _call_provider(self, bot_type, prompt, on_delta=None):
+        """向指定模型发出一次请求，失败时返回以 "总结失败：" 开头的文本"""
         try:
-            headers, payload, api_base = self._prepare_api_request(prompt)
+            headers, payload, api_base = self._prepare_api_request(prompt, bot_type)
+            if self.llm_streaming:
+                payload['stream'] = True
 
             # 确定 API URL
             url = api_base
             if not url:
-                 logger.error(f"[ChatSummary] API base URL 未配置 for bot type {self.bot_type}")
+                 logger.error(f"[ChatSummary] API base URL 未配置 for bot type {bot_type}")
                  return f"总结失败：API基础URL未配置"
 
             logger.debug(f"[ChatSummary] Calling LLM API URL: {url}")
             # logger.debug(f"[ChatSummary] Payload: {json.dumps(payload, indent=2, ensure_ascii=False)}") # Debug payload
 
-            response = requests.post(url, headers=headers, json=payload, timeout=180)
-
-            if response.status_code == 200:
-                result = response.json()
-                # logger.debug(f"[ChatSummary] LLM API Response: {result}") # Debug response
-                summary = ""
-                # 不同 API 返回结构适配
-                if self.bot_type == 'zhipuai':
-                    try:
-                        summary = result['choices'][0]['message']['content'].strip()
-                    except (KeyError, IndexError, TypeError) as e:
-                         logger.error(f"[ChatSummary] 解析 Zhipu 响应失败: {e}, 响应: {result}")
-                         return "总结失败：无法解析 Zhipu API 响应"
-                else: # 默认 OpenAI / Siliconflow / Qwen 兼容
+            started = time.perf_counter()
+            with self.http_pool.post(bot_type, url, headers=headers, json=payload, stream=self.llm_streaming) as response:
+                # 接口忽略 stream 参数时仍按普通 JSON 响应处理
+                if response.status_code == 200 and "text/event-stream" in response.headers.get("Content-Type", ""):
                     try:
-                        summary = result['choices'][0]['message']['content'].strip()
-                    except (KeyError, IndexError, TypeError) as e:
-                         logger.error(f"[ChatSummary] 解析 OpenAI/兼容 响应失败: {e}, 响应: {result}")
-                         return "总结失败：无法解析 API 响应"
-
-                # 返回原始文本，让调用者处理 JSON 解析或后处理
-                return summary
-            else:
-                error_text = f"API 错误 ({response.status_code}): {response.text[:200]}..."
-                logger.error(f"[ChatSummary] {error_text}")
-                # 返回包含错误信息的文本
-                if "insufficient_quota" in response.text.lower():
-                    return f"总结失败：API 错误 {response.status_code} (余额不足或额度用尽)"
-                elif "invalid_api_key" in response.text.lower() or "API key is invalid" in response.text:
-                     return f"总结失败：API 错误 {response.status_code} (API Key 无效)"
-                elif response.status_code == 400 and "maximum context length" in response.text:
-                     return f"总结失败：API 错误 {response.status_code} (输入内容过长，已超出模型限制)"
+                        stream = read_chat_stream(response, on_delta, started)
+                    except StreamError as e:
+                        logger.error(f"[ChatSummary] LLM stream error: {e}")
+                        return f"总结失败：{e}"
+                    self.stream_metrics.record(stream)
+                    logger.info(f"[ChatSummary] LLM stream finished: ttft={stream.ttft_ms or 0:.0f} ms, "
+                                f"total={stream.total_ms:.0f} ms, tokens={stream.tokens}, finish_reason={stream.finish_reason}, "
+                                f"stopped_early={stream.stopped_early}")
+                    return stream.text.strip()
+
+                if response.status_code == 200:
+                    result = response.json()
+                    # logger.debug(f"[ChatSummary] LLM API Response: {result}") # Debug response
+                    summary = ""
+                    # 不同 API 返回结构适配
+                    if bot_type == 'zhipuai':
+                        try:
+                            summary = result['choices'][0]['message']['content'].strip()
+                        except (KeyError, IndexError, TypeError) as e:
+                             logger.error(f"[ChatSummary] 解析 Zhipu 响应失败: {e}, 响应: {result}")
+                             return "总结失败：无法解析 Zhipu API 响应"
+                    else: # 默认 OpenAI / Siliconflow / Qwen 兼容
+                        try:
+                            summary = result['choices'][0]['message']['content'].strip()
+                        except (KeyError, IndexError, TypeError) as e:
+                             logger.error(f"[ChatSummary] 解析 OpenAI/兼容 响应失败: {e}, 响应: {result}")
+                             return "总结失败：无法解析 API 响应"
+
+                    # 返回原始文本，让调用者处理 JSON 解析或后处理
+                    return summary
                 else:
-                    return f"总结失败：{error_text}"
+                    error_text = f"API 错误 ({response.status_code}): {response.text[:200]}..."
+                    logger.error(f"[ChatSummary] {error_text}")
+                    if response.status_code == 401:
+                        self.auth.invalidate(bot_type, self._provider_settings(bot_type)[1])
+                    # 返回包含错误信息的文本
+                    if "insufficient_quota" in response.text.lower():
+                        return f"总结失败：API 错误 {response.status_code} (余额不足或额度用尽)"
+                    elif "invalid_api_key" in response.text.lower() or "API key is invalid" in response.text:
+                         return f"总结失败：API 错误 {response.status_code} (API Key 无效)"
+                    elif response.status_code == 400 and "maximum context length" in response.text:
+                         return f"总结失败：API 错误 {response.status_code} (输入内容过长，已超出模型限制)"
+                    else:
+                        return f"总结失败：{error_text}"
 
         except requests.exceptions.Timeout:
-            logger.error(f"[ChatSummary] API 请求超时")
+            logger.error(f"[ChatSummary] {bot_type} API 请求超时")
             return "总结失败：请求超时"
         except ValueError as e: # 捕获 _prepare_api_request 或其他地方的 ValueError
              logger.error(f"[ChatSummary] 值错误: {e}")
@@ -775,34 +1329,96 @@ class ChatSummary(Plugin):
             return f"总结失败：内部错误 ({e})"
 
     def _init_database(self):
-        """初始化数据库架构"""
-        c = self.conn.cursor()
-        # 增加索引提升查询效率
-        c.execute("""CREATE TABLE IF NOT EXISTS chat_records
-                    (sessionid TEXT NOT NULL,
-                     msgid INTEGER NOT NULL,
-                     user TEXT,
-                     content TEXT,
-                     type TEXT,
-                     timestamp INTEGER,
-                     is_triggered INTEGER DEFAULT 0,
-                     PRIMARY KEY (sessionid, msgid))""")
-        # 检查并添加索引（如果不存在）
-        indices = c.execute("PRAGMA index_list(chat_records)").fetchall()
-        index_names = [idx[1] for idx in indices]
-        if 'idx_chat_records_session_ts_type' not in index_names:
-             c.execute("CREATE INDEX idx_chat_records_session_ts_type ON chat_records (sessionid, timestamp DESC, type)")
-             logger.info("[ChatSummary] Created index idx_chat_records_session_ts_type on chat_records table.")
-
-        # 检查 is_triggered 列是否存在 (保持原有逻辑)
-        c = c.execute("PRAGMA table_info(chat_records);")
-        column_exists = any(column[1] == 'is_triggered' for column in c.fetchall())
-        if not column_exists:
-            self.conn.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
-            self.conn.execute("UPDATE chat_records SET is_triggered = 0;")
-            logger.info("[ChatSummary] Added is_triggered column to chat_records table.")
-
-        self.conn.commit()
+        """初始化 SQLite 表结构，并在存在旧版 chat_records 表时启动后台迁移"""
+        migration_config = self.config.get("schema_migration", {})
+        self.store.initialize(
+            migration_batch_size=migration_config.get("batch_size", 2000),
+            migration_pause_sec=migration_config.get("pause_ms", 50) / 1000,
+        )
+        with self.db.write() as conn:
+            if self.search_index is not None:
+                self.search_index.create_tables(conn)
+            else:
+                drop_search_index(conn)
+            if self.keyword_index is not None:
+                self.keyword_index.create_tables(conn)
+            if self.bucket_summaries is not None:
+                self.bucket_summaries.create_tables(conn)
+
+        if self.keyword_index is not None:
+            self.store.legacy_migration.insert_hooks.append(self.keyword_index.index_rows)
+        if self.search_index is not None:
+            self.store.legacy_migration.insert_hooks.append(
+                lambda conn, rows: self.search_index.index_rows(conn, rows, replace=False))
+        self.store.legacy_migration.start()
+        if self.search_index is not None:
+            self.search_index.start_backfill()
+
+    def _init_sqlite_store(self, curdir):
+        """创建 SQLite 后端及其附属组件 (分片布局、内容压缩、全文索引)"""
+        db_path = curdir / "chat.db"
+        sqlite_config = self.config.get("sqlite", {})
+        self.db = ConnectionManager(
+            db_path,
+            journal_mode=sqlite_config.get("journal_mode", "WAL"),
+            busy_timeout_ms=sqlite_config.get("busy_timeout_ms", 5000),
+            mmap_size=sqlite_config.get("mmap_size", 268435456),
+            cache_size_kb=sqlite_config.get("cache_size_kb", 16384),
+            synchronous=sqlite_config.get("synchronous", "NORMAL"),
+        )
+        partition_config = self.config.get("partition", {})
+        if partition_config.get("enabled", False):
+            self.layout = MonthlyPartitions(
+                self.db,
+                shard_dir=curdir / partition_config.get("shard_dir", "chat_shards"),
+                archive_dir=curdir / partition_config.get("archive_dir", "chat_shards/archive"),
+                max_attached=partition_config.get("max_attached", 6),
+            )
+        else:
+            self.layout = SingleFileLayout()
+        compression_config = self.config.get("compression", {})
+        # 解码器始终创建：即使关闭了压缩，之前压缩过的内容也需要能读出
+        self.content_codec = ContentCodec(compression_config.get("codec", "zlib"), compression_config.get("level", 6))
+        if compression_config.get("enabled", False):
+            self.cold_compressor = ColdContentCompressor(
+                self.db,
+                self.content_codec,
+                self.layout,
+                min_age_hours=compression_config.get("min_age_hours", 72),
+                batch_size=compression_config.get("batch_size", 500),
+                dict_size_kb=compression_config.get("dict_size_kb", 32),
+                min_length=compression_config.get("min_length", 24),
+                max_run_seconds=compression_config.get("max_run_seconds", 30),
+            )
+        search_config = self.config.get("search", {})
+        if search_config.get("enabled", True):
+            self.search_index = SearchIndex(
+                self.db,
+                self.content_codec,
+                self.layout,
+                tokenizer=search_config.get("tokenizer", "trigram"),
+                backfill_batch=search_config.get("backfill_batch", 1000),
+                pause_sec=search_config.get("pause_ms", 50) / 1000,
+            )
+        self.store = SQLiteMessageStore(
+            self.db,
+            self.layout,
+            self.content_codec,
+            self._format_prefix,
+            format_version=self.line_format_version,
+            page_size=self.read_page_size,
+        )
+        self.session_names = self.store.session_names
+        self.user_names = self.store.user_names
+        if self.search_index is not None:
+            self.store.write_hooks.append(self.search_index.index_rows)
+        if self.keyword_segmenter is not None:
+            self.keyword_index = KeywordIndex(self.keyword_segmenter,
+                                              self.config.get("keywords", {}).get("max_terms", 20000))
+            self.store.write_hooks.append(self.keyword_index.index_rows)
+        if self.partial_summaries_enabled:
+            self.bucket_summaries = BucketSummaryStore(self.db, self.session_names)
+        self._init_database()
 
     def get_help_text(self, verbose=False, **kwargs):
         """获取插件帮助信息 (更新)"""
@@ -816,6 +1432,7 @@ class ChatSummary(Plugin):
 2. 聊天记录总结
    - 生成文本总结：{'、'.join(f'`{cmd}`' for cmd in self.summarize_commands)}
    - 生成图片总结：{'、'.join(f'`{cmd}`' for cmd in self.image_summarize_commands)}
+   - 搜索聊天记录：{'、'.join(f'`{cmd} 关键词 [Xh|Xd]`' for cmd in self.search_commands)} (如: c搜索 张三 7d，不调用大模型)
 
    总结参数 (对文本和图片总结都有效)：
    - `[命令]` : 总结最近 {self.default_summary_count} 条消息 (默认)
@@ -833,7 +1450,7 @@ class ChatSummary(Plugin):
 """
         return help_text
 
-    def _handle_text_summary_to_image(self, args, e_context: EventContext, summary_type="count"):
+    def _handle_text_summary_to_image(self, args, e_context: EventContext, summary_type="count", use_cache=True):
         """处理将文本总结渲染为图片的命令"""
         # 使用 self 属性进行检查
         if not self.image_summarize_enabled or self.image_summarize_module is None:
@@ -850,18 +1467,22 @@ class ChatSummary(Plugin):
             elif not session_id:
                  raise ValueError("无法确定会话ID")
 
-            # 1. 获取文本消息
+            # 1. 获取文本消息 (读取时按输入上限截断，Prompt 确定后再精确校验)
             messages, actual_count = "", 0
             time_info = ""
+            tokenizer = self._tokenizer()
+            read_budget = self._read_budget(self.max_input_tokens)
+            started = time.perf_counter()
             if summary_type == "time":
                 hours = int(args[0])
                 start_timestamp = time.time() - (hours * 3600)
-                messages, actual_count = self._get_chat_messages_by_time(session_id, start_timestamp)
+                messages, actual_count = self._get_chat_messages_by_time(session_id, start_timestamp, read_budget)
                 time_info = f"过去{hours}小时内"
             else: # count
                 requested_count = int(args[0])
-                messages, actual_count = self._get_chat_messages_by_count(session_id, requested_count)
+                messages, actual_count = self._get_chat_messages_by_count(session_id, requested_count, read_budget)
                 time_info = f"最近{actual_count}"
+                start_timestamp = self._count_window_start(session_id, actual_count)
 
             if not messages:
                 reply_content = f"在{time_info}没有找到可总结的消息。"
@@ -889,12 +1510,47 @@ class ChatSummary(Plugin):
                  logger.info(f"[ChatSummary] Error reading prompt file, setting action to BREAK_PASS") # 更新日志
                  return
 
-            # 填充消息记录和可能的元信息到 Prompt
-            formatted_prompt = image_prompt_template + f"\n\n--- 待总结的聊天记录 ({time_info} {actual_count}条) ---\n" + messages
+            # 消息数、活跃用户、话唠榜等统计由本地汇总精确计算，不再让模型估算
+            activity_stats = self._activity_stats(session_id, start_timestamp) if messages else None
+
+            # 填充消息记录和可能的元信息到 Prompt，超出输入上限时从最旧的消息整条丢弃
+            prompt_head = image_prompt_template
+            if activity_stats:
+                prompt_head += "\n\n" + self._format_activity_for_prompt(activity_stats)
+
+            def render(lines):
+                return prompt_head + f"\n\n--- 待总结的聊天记录 ({time_info} {len(lines)}条) ---\n" + "\n".join(lines)
+
+            # 放不下时先分段生成要点，再用图片总结的 Prompt 汇总
+            read_ms = (time.perf_counter() - started) * 1000
+            try:
+                digests, digest_count = self._map_reduce(tokenizer, messages, self.max_input_tokens - tokenizer.count(render([])),
+                                                         read_ms, session_id, start_timestamp, use_cache)
+            except MapReduceError as e:
+                e_context["reply"] = Reply(ReplyType.TEXT, f"图片总结失败：{e}，已完成的段落已缓存，可稍后重试。")
+                e_context.action = EventAction.BREAK_PASS
+                return
+            if digests is not None:
+                messages = digests
+
+                def render(lines):
+                    return (prompt_head + f"\n\n--- 待总结的聊天记录 ({time_info} {digest_count}条，消息较多，以下为按时间分段提炼的要点) ---\n"
+                            + "\n\n".join(lines))
+
+            formatted_prompt = self._fit_input(tokenizer, messages, render)
+            if formatted_prompt is None:
+                e_context["reply"] = Reply(ReplyType.TEXT, f"图片总结失败：Prompt 已超出输入上限 ({self.max_input_tokens} tokens)，请调大 max_input_tokens。")
+                e_context.action = EventAction.BREAK_PASS
+                return
 
             # 3. 调用 LLM API 获取 JSON 响应
             logger.info("[ChatSummary] Requesting JSON summary from LLM...")
-            llm_response_text = self._call_llm_api(formatted_prompt)
+            # 流式输出时边生成边解析，JSON 对象闭合后即停止读取
+            json_stream = StreamingJSONObject()
+            started = time.perf_counter()
+            llm_response_text = self._cached_llm_call(formatted_prompt, on_delta=json_stream.feed, use_cache=use_cache)
+            if digests is not None:
+                logger.info(f"[ChatSummary MapReduce] Reduce stage finished in {(time.perf_counter() - started) * 1000:.0f} ms.")
 
             # 检查 LLM 是否返回了错误信息
             if llm_response_text.startswith("总结失败："):
@@ -906,12 +1562,15 @@ class ChatSummary(Plugin):
             # 4. 解析 JSON
             summary_data = None
             try:
-                cleaned_response = llm_response_text.strip()
-                if cleaned_response.startswith("```json"):
-                    cleaned_response = cleaned_response[7:]
-                if cleaned_response.endswith("```"):
-                    cleaned_response = cleaned_response[:-3]
-                summary_data = json.loads(cleaned_response.strip())
+                if json_stream.done:
+                    summary_data = json_stream.result()
+                else:
+                    cleaned_response = llm_response_text.strip()
+                    if cleaned_response.startswith("```json"):
+                        cleaned_response = cleaned_response[7:]
+                    if cleaned_response.endswith("```"):
+                        cleaned_response = cleaned_response[:-3]
+                    summary_data = json.loads(cleaned_response.strip())
                 if not isinstance(summary_data, dict):
                      raise ValueError("LLM did not return a JSON object.")
                 logger.info("[ChatSummary] Successfully parsed JSON summary from LLM.")
@@ -963,6 +1622,13 @@ class ChatSummary(Plugin):
                 summary_data['metadata']['group_name'] = ""
             # +++++++++++++++++++++++++++
 
+            # 词云由本地关键词提取生成，覆盖模型可能返回的 word_cloud
+            if self.keyword_segmenter is not None:
+                exclude = [summary_data['metadata'].get('group_name')]
+                if activity_stats:
+                    exclude += [item['nickname'] for item in activity_stats['top_chatters']]
+                summary_data['word_cloud'] = self._local_word_cloud(session_id, start_timestamp, exclude)
+
             # 5. 调用渲染模块生成图片 (Uses the modified summary_data)
             logger.info("[ChatSummary] Generating summary image...")
             output_dir = str(Path(__file__).parent / "image_summary" / "output") # 输出目录
@@ -976,7 +1642,8 @@ class ChatSummary(Plugin):
                  image_path = self.image_summarize_module.generate_summary_image_from_data(
                      summary_data, 
                      output_dir, 
-                     is_group_chat=is_group_chat
+                     is_group_chat=is_group_chat,
+                     activity_stats=activity_stats,
                  )
             except ImportError as dep_error: # 捕获渲染模块抛出的依赖错误
                  logger.error(f"图片生成失败，依赖项错误: {dep_error}")
@@ -1060,6 +1727,84 @@ class ChatSummary(Plugin):
             e_context.action = EventAction.BREAK_PASS # 修改为 BREAK_PASS
             logger.info(f"[ChatSummary] Unexpected exception caught, setting action to BREAK_PASS") # 更新日志
 
+    def _count_window_start(self, session_id, msg_count):
+        """按条数总结时窗口的起点：最早一条被总结消息之前的时间戳"""
+        oldest = None
+        records = self._iter_records(session_id, 0, msg_count)
+        try:
+            for record in records:
+                oldest = record[5]
+        finally:
+            records.close()
+        return oldest - 1 if oldest is not None else int(time.time())
+
+    def _activity_stats(self, session_id, start_timestamp):
+        """
+        计算窗口内的精确统计 (见 storage.analytics.analyze)，供图片报告的 metadata / data_analysis 使用。
+
+        计数、话唠榜、活跃分布和熬夜冠军读取按小时汇总的结果，只有消息字数和连续对话片段逐条读取消息。
+        没有消息或读取失败时返回 None。
+        """
+        try:
+            buckets = self.store.aggregate(str(session_id), start_timestamp, None, analytics.BUCKET_SECONDS)
+            if not buckets:
+                return None
+            window = analytics.load_window(self.store, session_id, start_timestamp)
+        except Exception as e:
+            logger.warning(f"[ChatSummary] Failed to load activity stats: {e}")
+            return None
+        return analytics.analyze(buckets, window, night_hours=self.night_hours)
+
+    def _local_word_cloud(self, session_id, start_timestamp, exclude=()):
+        """
+        对窗口内的消息做 TF-IDF 关键词提取，生成图片模板的词云列表。
+
+        SQLite 后端使用写入时累计的会话级文档频率计算 IDF，其它后端以窗口内的消息本身计算。
+        """
+        keywords_config = self.config.get("keywords", {})
+        try:
+            texts = [record[3] for record in self._iter_records(session_id, start_timestamp)]
+            frequencies = None
+            if self.keyword_index is not None:
+                conn = self.db.reader()
+                sid = self.session_names.lookup(conn, str(session_id))
+                if sid is not None:
+                    frequencies = lambda terms: self.keyword_index.frequencies(conn, sid, terms)
+            start = time.perf_counter()
+            keywords = extract_keywords(self.keyword_segmenter, texts, keywords_config.get("max_words", 10),
+                                        frequencies, exclude)
+            logger.debug(f"[ChatSummary] Extracted {len(keywords)} keywords from {len(texts)} messages "
+                         f"in {(time.perf_counter() - start) * 1000:.1f} ms.")
+        except Exception as e:
+            logger.warning(f"[ChatSummary] Failed to extract keywords: {e}")
+            return []
+        return word_cloud(keywords, keywords_config.get("min_size", 28), keywords_config.get("max_size", 42),
+                          keywords_config.get("palette"))
+
+    @staticmethod
+    def _format_activity_for_prompt(stats):
+        """把精确统计写入 Prompt，模型只需补充用户画像、高频词等描述性内容"""
+        lines = ["--- 本地精确统计 (metadata 与 data_analysis 中的计数直接使用以下数值，无需自行统计) ---",
+                 f"总消息数：{stats['total_messages']}，活跃用户数：{stats['active_users']}，时间范围：{stats['time_range']}",
+                 "话唠榜：" + "，".join(f"{item['nickname']} ({item['message_count']}条)" for item in stats["top_chatters"])]
+        night_owl = stats["night_owl"]
+        if night_owl:
+            lines.append(f"熬夜冠军：{night_owl['nickname']}，最晚活跃 {night_owl['latest_active_time']}，"
+                         f"深夜消息 {night_owl['late_night_messages']} 条")
+        else:
+            lines.append("熬夜冠军：无 (没有深夜消息)")
+        weekdays = stats["weekday_activity"]
+        busiest_day = analytics.WEEKDAYS[max(range(7), key=weekdays.__getitem__)]
+        lines.append(f"最活跃时段：{stats['peak_hour']}:00-{stats['peak_hour']}:59，最活跃的星期：{busiest_day}")
+        length = stats["message_length"]
+        lines.append(f"消息字数：平均 {length['average']}，中位数 {length['median']}，最长 {length['max']}")
+        bursts = stats["reply_bursts"]
+        if bursts["longest"]:
+            longest = bursts["longest"]
+            lines.append(f"连续对话：{bursts['count']} 段，最长一段 {longest['start_time']}-{longest['end_time']}，"
+                         f"{longest['message_count']} 条消息、{longest['participants']} 人参与")
+        return "\n".join(lines)
+
     # +++ 重构: 获取群昵称，优先使用 GeweChat API +++
     def _get_group_nickname(self, group_wxid: str) -> str:
         """
@@ -1179,6 +1924,61 @@ class ChatSummary(Plugin):
         except Exception as e:
             logger.error(f"[ChatSummary Cleanup] Error iterating directory {directory}: {e}", exc_info=True)
 
+    def _log_runtime_stats(self):
+        """定期输出运行时计数器 (写入队列深度、背压等)"""
+        if self.ingest_queue is not None:
+            logger.info(f"[ChatSummary Stats] ingest_queue: {self.ingest_queue.stats()}")
+        logger.info(f"[ChatSummary Stats] storage: {self.store.stats()}")
+        logger.info(f"[ChatSummary Stats] http: {self.http_pool.stats()}")
+        logger.info(f"[ChatSummary Stats] auth: {self.auth.stats()}")
+        logger.info(f"[ChatSummary Stats] routing: {self.router.stats()}")
+        logger.info(f"[ChatSummary Stats] tokens: {self.tokenizers.stats()}")
+        if self.map_reduce_enabled:
+            logger.info(f"[ChatSummary Stats] chunk_cache: {self.chunk_cache.stats()}")
+        if self.bucket_summaries is not None:
+            logger.info(f"[ChatSummary Stats] bucket_summaries: {self.bucket_summaries.stats()}")
+        if self.result_cache is not None:
+            logger.info(f"[ChatSummary Stats] result_cache: {self.result_cache.stats()}")
+        if self.single_flight is not None:
+            logger.info(f"[ChatSummary Stats] coalescing: {self.single_flight.stats()}")
+        if self.llm_streaming:
+            logger.info(f"[ChatSummary Stats] streaming: {self.stream_metrics.stats()}")
+        if self.search_index is not None:
+            logger.info(f"[ChatSummary Stats] search: {self.search_index.stats()}")
+        if self.keyword_index is not None:
+            logger.info(f"[ChatSummary Stats] keywords: {self.keyword_index.stats()}")
+        if self.hot_cache is not None:
+            logger.info(f"[ChatSummary Stats] hot_cache: {self.hot_cache.stats()}")
+        if self.retention is not None and self.retention.last_run:
+            logger.info(f"[ChatSummary Stats] retention (last run): {self.retention.last_run}")
+
+    def _apply_retention(self):
+        """定时任务：按保留策略清理旧消息并归还空间"""
+        try:
+            self.retention.run()
+        except Exception as e:
+            logger.error(f"[ChatSummary Retention] Retention job failed: {e}", exc_info=True)
+
+    def _archive_old_shards(self, months):
+        """定时任务：归档超过保留月数的分片"""
+        try:
+            archived = self.layout.archive_older_than(months)
+            if archived and self.hot_cache is not None:
+                # 缓存中可能有来自已归档分片的旧消息
+                self.hot_cache.invalidate()
+            if archived:
+                logger.info(f"[ChatSummary Partition] Archived shards: {archived}")
+        except Exception as e:
+            logger.error(f"[ChatSummary Partition] Shard archiving failed: {e}", exc_info=True)
+
+    def _compress_cold_content(self):
+        """定时任务：压缩冷数据并输出空间节省与解压耗时报告"""
+        try:
+            self.cold_compressor.run()
+            logger.info(f"[ChatSummary Compression] Report: {self.cold_compressor.report()}")
+        except Exception as e:
+            logger.error(f"[ChatSummary Compression] Compression job failed: {e}", exc_info=True)
+
     # +++ 新增：调度器运行函数 +++
     def _run_scheduler(self):
         """运行定时任务调度器"""
@@ -1186,6 +1986,19 @@ class ChatSummary(Plugin):
         # 设置清理任务，目标目录和时间阈值从类属性获取
         schedule.every().day.at("03:00").do(self._cleanup_output_files, directory=self.cleanup_target_dir, max_age_hours=48)
         logger.info(f"[ChatSummary Scheduler] Scheduled cleanup task for {self.cleanup_target_dir} daily at 03:00 (older than 48h).")
+        schedule.every().hour.do(self._log_runtime_stats)
+        if self.cold_compressor is not None:
+            interval = self.config.get("compression", {}).get("interval_minutes", 30)
+            schedule.every(interval).minutes.do(self._compress_cold_content)
+            logger.info(f"[ChatSummary Scheduler] Scheduled cold content compression every {interval} minutes.")
+        if self.retention is not None:
+            run_at = self.config.get("retention", {}).get("run_at", "04:00")
+            schedule.every().day.at(run_at).do(self._apply_retention)
+            logger.info(f"[ChatSummary Scheduler] Scheduled retention job daily at {run_at}.")
+        archive_months = self.config.get("partition", {}).get("archive_after_months", 0)
+        if self.layout is not None and self.layout.partitioned and archive_months > 0:
+            schedule.every().day.at("03:30").do(self._archive_old_shards, months=archive_months)
+            logger.info(f"[ChatSummary Scheduler] Scheduled shard archiving daily at 03:30 (older than {archive_months} months).")
 
         while True:
             try:
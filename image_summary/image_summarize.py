@@ -1502,7 +1502,76 @@ def generate_lite_html(summary_data: dict) -> str:
 </body>
 </html>"""
 
-def generate_summary_image_from_data(summary_data: dict, output_dir: str = str(DEFAULT_OUTPUT_DIR), is_group_chat: bool = False) -> str | None:
+def apply_activity_stats(summary_data: dict, activity_stats: dict | None) -> dict:
+    """
+    用本地精确统计覆盖模型返回的计数类字段。
+
+    metadata 中的 total_messages / active_users / time_range、话唠榜和熬夜冠军的计数直接替换；
+    昵称相同时保留模型写的用户画像、高频词、代表发言和称号。话题热度的话题仍来自模型，
+    只把百分比按精确总消息数重新计算。
+
+    Args:
+        summary_data: 从 LLM 获取并解析后的 JSON 数据字典 (原地修改)。
+        activity_stats: storage.analytics.analyze 的返回值，为 None 时不做修改。
+
+    Returns:
+        修改后的 summary_data。
+    """
+    if not activity_stats:
+        return summary_data
+
+    metadata = summary_data.get('metadata')
+    if not isinstance(metadata, dict):
+        metadata = summary_data['metadata'] = {}
+    for key in ('total_messages', 'active_users', 'time_range'):
+        metadata[key] = activity_stats[key]
+
+    analytics = summary_data.get('data_analysis')
+    if not isinstance(analytics, dict):
+        analytics = summary_data['data_analysis'] = {}
+    # 附加统计 (活跃时段分布、消息字数、连续对话) 原样放入 data_analysis
+    for key in ('hourly_activity', 'peak_hour', 'weekday_activity', 'message_length', 'reply_bursts'):
+        if key in activity_stats:
+            analytics[key] = activity_stats[key]
+
+    llm_chatters = {item.get('nickname'): item for item in analytics.get('top_chatters') or [] if isinstance(item, dict)}
+    top_chatters = []
+    for item in activity_stats['top_chatters']:
+        described = llm_chatters.get(item['nickname'], {})
+        top_chatters.append({
+            **item,
+            'user_profile': described.get('user_profile', ''),
+            'frequent_words': described.get('frequent_words', []),
+        })
+    analytics['top_chatters'] = top_chatters
+
+    night_owl = activity_stats['night_owl']
+    if night_owl:
+        described = analytics.get('night_owl')
+        if not isinstance(described, dict) or described.get('nickname') != night_owl['nickname']:
+            described = {}
+        analytics['night_owl'] = {
+            **night_owl,
+            'representative_message': described.get('representative_message', ''),
+            'title': described.get('title', '熬夜冠军'),
+        }
+    else:
+        analytics['night_owl'] = {}
+
+    total = activity_stats['total_messages']
+    for item in analytics.get('topic_heat') or []:
+        if isinstance(item, dict) and total:
+            try:
+                count = int(item.get('message_count'))
+            except (TypeError, ValueError):
+                continue
+            count = min(max(count, 0), total)
+            item['message_count'] = count
+            item['percentage'] = f"{count * 100 / total:.0f}%"
+    return summary_data
+
+def generate_summary_image_from_data(summary_data: dict, output_dir: str = str(DEFAULT_OUTPUT_DIR), is_group_chat: bool = False,
+                                     activity_stats: dict | None = None) -> str | None:
     """
     协调函数：根据 JSON 数据生成 HTML 并将其渲染为图片。
     增强版：优先尝试标准模板，失败后根据场景回退。
@@ -1511,6 +1580,7 @@ def generate_summary_image_from_data(summary_data: dict, output_dir: str = str(D
         summary_data: 从 LLM 获取并解析后的 JSON 数据字典。
         output_dir: 图片输出目录。
         is_group_chat: 是否为群聊场景。
+        activity_stats: 本地精确统计，提供时覆盖模型返回的计数类字段 (见 apply_activity_stats)。
 
     Returns:
         成功时返回图片文件路径，失败返回 None。
@@ -1518,6 +1588,7 @@ def generate_summary_image_from_data(summary_data: dict, output_dir: str = str(D
     """
     global last_text_summary
     last_text_summary = None
+    apply_activity_stats(summary_data, activity_stats)
     
     # 添加日志: 记录传入的原始元数据 (如果存在)
     original_metadata = summary_data.get('metadata', '元数据字段不存在')
@@ -0,0 +1,102 @@
+import base64
+import hmac
+import json
+import threading
+import time
+from urllib.parse import urlparse
+
+from .log import logger
+
+
+class BearerAuth:
+    """Authorization: Bearer <api_key>，headers 按 (api_key, api_base) 构建一次后复用"""
+
+    def __init__(self, host_header=False):
+        self.host_header = host_header
+
+    def build(self, api_key, api_base):
+        """返回 (headers, 有效期截止时间戳)；None 表示长期有效"""
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        if self.host_header:
+            headers["Host"] = urlparse(api_base).netloc
+        return headers, None
+
+
+class ZhipuJWTAuth:
+    """
+    智谱 API 的 HS256 JWT 鉴权：api_key 形如 "<key_id>.<secret>"，签出的 token 有效期 ttl 秒。
+
+    Args:
+        ttl: token 有效期 (秒)。
+        refresh_margin: 距离过期不足该秒数时重新签发，避免请求途中过期。
+    """
+
+    def __init__(self, ttl=3600, refresh_margin=300):
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl // 2)
+
+    def build(self, api_key, api_base):
+        parts = api_key.split(".")
+        if len(parts) != 2:
+            raise ValueError("Invalid API key format for zhipuai")
+        key_id, secret = parts
+        now = int(time.time())
+        exp = now + self.ttl
+        header_str = _b64(json.dumps({"alg": "HS256", "sign_type": "SIGN"}))
+        payload_str = _b64(json.dumps({"api_key": key_id, "exp": exp, "timestamp": now}))
+        signature = hmac.new(secret.encode("utf-8"), f"{header_str}.{payload_str}".encode("utf-8"), "sha256").digest()
+        token = f"{header_str}.{payload_str}.{base64.b64encode(signature).decode('utf-8').replace('=', '')}"
+        return {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}, exp - self.refresh_margin
+
+
+def _b64(text):
+    return base64.b64encode(text.encode("utf-8")).decode("utf-8").replace("=", "")
+
+
+class ProviderAuth:
+    """
+    按模型类型生成并缓存请求头。
+
+    每个 (模型类型, api_key, api_base) 的请求头只构建一次，需要签名的 token 在过期前自动重签，
+    请求路径上只做一次字典查找。其它模型可通过 register() 接入自己的请求头构建器
+    (任何提供 build(api_key, api_base) -> (headers, refresh_at) 的对象)；未注册的模型使用 Bearer 鉴权。
+    返回的 headers 字典被所有请求共享，调用方不得修改。
+    """
+
+    def __init__(self):
+        self.providers = {
+            "zhipuai": ZhipuJWTAuth(),
+            "deepseek": BearerAuth(host_header=True),
+        }
+        self.default = BearerAuth()
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.hits = 0
+
+    def register(self, bot_type, provider):
+        with self._lock:
+            self.providers[bot_type] = provider
+            self._cache = {key: value for key, value in self._cache.items() if key[0] != bot_type}
+
+    def headers(self, bot_type, api_key, api_base):
+        key = (bot_type, api_key, api_base)
+        cached = self._cache.get(key)
+        if cached is not None and (cached[1] is None or time.time() < cached[1]):
+            self.hits += 1
+            return cached[0]
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is None or (cached[1] is not None and time.time() >= cached[1]):
+                cached = self._cache[key] = self.providers.get(bot_type, self.default).build(api_key, api_base)
+                self.builds += 1
+                logger.debug(f"[ChatSummary Auth] Built request headers for {bot_type}.")
+            return cached[0]
+
+    def invalidate(self, bot_type, api_key):
+        """服务端拒绝鉴权 (如 401) 时丢弃缓存，下次请求重新构建"""
+        with self._lock:
+            self._cache = {key: value for key, value in self._cache.items() if key[:2] != (bot_type, api_key)}
+
+    def stats(self):
+        return {"builds": self.builds, "hits": self.hits}
@@ -0,0 +1,8 @@
+try:
+    from common.log import logger
+except ImportError:
+    # 在插件目录下单独运行命令行工具或测试时没有 chatgpt-on-wechat 的 common 包
+    import logging
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logger = logging.getLogger("ChatSummary")
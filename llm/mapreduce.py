@@ -0,0 +1,136 @@
+"""
+分层 (map-reduce) 总结：聊天记录超出单次输入预算时，按消息边界切成多个块，
+并发地对每块生成摘要 (map)，再把按时间排列的摘要交给原来的文字 / 图片总结 Prompt (reduce)。
+
+已完成的块摘要按 (模型, Prompt, 块内容) 缓存，部分块失败后重试只需重新生成失败的块。
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from .log import logger
+
+# 块摘要 Prompt 不含块序号，窗口变化后内容相同的块仍能命中缓存
+MAP_PROMPT = (
+    "以下是一段群聊记录，是较长聊天记录按时间切分后的其中一段。"
+    "请按时间顺序提炼这一段的要点：讨论了哪些话题、各自的关键观点与结论、提到的重要信息 (时间、数字、链接、待办)，"
+    "以及每个话题的主要参与者 (保留原昵称)。有代表性的原话可以用引号保留。"
+    "只输出要点，不要寒暄，不超过 {max_chars} 字。"
+)
+
+
+class MapReduceError(Exception):
+    """块摘要生成失败"""
+
+
+def split_chunks(tokenizer, lines, budget):
+    """
+    把从旧到新的消息行按消息边界切块，每块 token 数 (每行另计 1 个换行) 不超过 budget。
+
+    先按总量算出需要的块数，再按平均大小切分，避免最后一块只有零星几条消息；
+    单条消息超过 budget 时独占一块。
+    """
+    costs = [tokenizer.count(line) + 1 for line in lines]
+    total = sum(costs)
+    target = total / max(1, math.ceil(total / budget))
+    chunks, current, used = [], [], 0
+    for line, cost in zip(lines, costs):
+        # 这条消息越过平均大小的一半以上或超出预算时，从它开始新的一块
+        if current and (used + cost > budget or used + cost / 2 > target):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(line)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_key(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ChunkSummaryCache:
+    """块摘要的 LRU 缓存 (进程内)"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            summary = self._entries.get(key)
+            if summary is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return summary
+
+    def put(self, key, summary):
+        with self._lock:
+            self._entries[key] = summary
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def map_chunks(executor, call, prompts, keys, cache, use_cache=True):
+    """
+    并发生成块摘要。prompts[i] 为第 i 块的完整输入，keys[i] 为其缓存键；call(prompt) 返回 (摘要, 是否可缓存)，
+    失败时抛出异常 (例如由其他模型代答的摘要不应缓存在当前模型的键下)。
+    use_cache 为 False 时不查询缓存，所有块重新生成，新结果仍写入缓存。
+
+    返回 (按块顺序的摘要列表, 统计)，统计中的 uncacheable 为不可缓存的块下标；
+    有块失败时其余块的结果照常写入缓存，然后抛出 MapReduceError。
+    """
+    started = time.perf_counter()
+    summaries = [cache.get(key) if use_cache else None for key in keys]
+    pending = {}
+
+    def run(index):
+        chunk_started = time.perf_counter()
+        summary, cacheable = call(prompts[index])
+        return summary, cacheable, (time.perf_counter() - chunk_started) * 1000
+
+    for index, summary in enumerate(summaries):
+        if summary is None:
+            pending[index] = executor.submit(run, index)
+    errors, chunk_ms, uncacheable = [], [], []
+    for index, future in pending.items():
+        try:
+            summary, cacheable, elapsed_ms = future.result()
+        except Exception as e:
+            errors.append(f"第 {index + 1} 段: {e}")
+            continue
+        summaries[index] = summary
+        chunk_ms.append(elapsed_ms)
+        if cacheable:
+            cache.put(keys[index], summary)
+        else:
+            uncacheable.append(index)
+    stats = {
+        "chunks": len(prompts),
+        "cached": len(prompts) - len(pending),
+        "failed": len(errors),
+        "map_ms": round((time.perf_counter() - started) * 1000, 1),
+        "slowest_chunk_ms": round(max(chunk_ms), 1) if chunk_ms else 0.0,
+        "uncacheable": uncacheable,
+    }
+    if errors:
+        logger.warning(f"[ChatSummary MapReduce] Map stage failed: {stats}")
+        raise MapReduceError(f"{len(errors)}/{len(prompts)} 段摘要生成失败 ({'; '.join(errors)})")
+    return summaries, stats
@@ -0,0 +1,306 @@
+"""
+在 models 中配置的多个模型之间路由总结请求。
+
+启用 failover 后，当前模型出错或超时时依次改用下一个健康的模型；连续失败达到阈值的模型暂时熔断，
+冷却期内排到最后。可选的对冲请求 (hedging)：首个请求超过该模型历史延迟的 p95 仍未开始输出时，
+再向下一个模型发出同样的请求，采用先完成的结果，另一个请求在下一段流式输出到达时停止。
+流式请求按首个 token 的延迟 (TTFT) 计算 p95，非流式请求按完整响应的延迟计算。
+"""
+import bisect
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from .log import logger
+
+# 延迟直方图的桶上界 (毫秒)：50 ms 到约 300 s，按 1.25 倍递增
+_BUCKET_BOUNDS = []
+_bound = 50.0
+while _bound < 300000:
+    _BUCKET_BOUNDS.append(round(_bound, 1))
+    _bound *= 1.25
+_BUCKET_BOUNDS.append(float("inf"))
+
+
+class LatencyHistogram:
+    """
+    对数分桶的延迟直方图，quantile() 返回所在桶的上界。
+
+    样本数达到 decay_at 时所有桶减半，较近的延迟占主要权重。
+    """
+
+    def __init__(self, decay_at=1000):
+        self.decay_at = decay_at
+        self._counts = [0] * len(_BUCKET_BOUNDS)
+        self.count = 0
+
+    def record(self, elapsed_ms):
+        self._counts[bisect.bisect_left(_BUCKET_BOUNDS, elapsed_ms)] += 1
+        self.count += 1
+        if self.count >= self.decay_at:
+            self._counts = [count // 2 for count in self._counts]
+            self.count = sum(self._counts)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(_BUCKET_BOUNDS, self._counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return _BUCKET_BOUNDS[-1]
+
+
+class _Provider:
+    __slots__ = ("name", "latency", "ttft", "calls", "successes", "failures", "consecutive_failures",
+                 "open_until", "hedges", "wins", "cancelled")
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = LatencyHistogram()
+        self.ttft = LatencyHistogram()
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.hedges = 0
+        self.wins = 0
+        self.cancelled = 0
+
+
+class _OutputGate:
+    """
+    多个并发请求共享调用方的 on_delta：最先输出的请求占用它，其余请求的增量被丢弃并停止读取。
+    已经有输出的请求失败后不能再换模型重试 (调用方已收到部分内容)。
+
+    调用方没有 on_delta 时 (分段要点等非流式调用) 没有人收到部分内容，输出不占用 gate，
+    请求中途失败仍可换模型；胜出的请求在返回时才占用 gate，其余请求随后停止读取。
+    """
+
+    def __init__(self, on_delta):
+        self.on_delta = on_delta
+        self.owner = None
+        self._lock = threading.Lock()
+
+    def claim(self, attempt):
+        with self._lock:
+            if self.owner is None:
+                self.owner = attempt
+            return self.owner is attempt
+
+    def for_attempt(self, attempt):
+        def on_delta(text):
+            if attempt.first_output is None:
+                attempt.first_output = time.perf_counter()
+            if self.on_delta is None:
+                owner = self.owner
+                if owner is not None and owner is not attempt:
+                    attempt.cancelled = True
+                    return True
+                return False
+            if not self.claim(attempt):
+                attempt.cancelled = True
+                return True
+            return self.on_delta(text)
+        return on_delta
+
+
+class _Attempt:
+    __slots__ = ("provider", "cancelled", "hedge", "first_output")
+
+    def __init__(self, provider, hedge=False):
+        self.provider = provider
+        self.cancelled = False
+        self.hedge = hedge
+        self.first_output = None
+
+
+class ProviderRouter:
+    """
+    Args:
+        providers: 可用模型 (bot_type) 的名称，按 failover 顺序排列。
+        call: call(provider, prompt, on_delta) 向指定模型发出请求，返回文本。
+        failed: failed(text) 判断 call 的返回是否为失败。
+        executor: 对冲请求使用的线程池，为 None 时不对冲 (只在失败后依次重试)。
+        failover: 为 False 时只使用当前模型 (也不对冲)。
+        streaming: call 是否流式输出，为 True 时对冲等待时间按 TTFT 的分位数计算。
+        failure_threshold: 连续失败多少次后熔断。
+        cooldown: 熔断时长 (秒)。
+        hedge_quantile: 对冲等待时间取当前模型延迟 (流式时为 TTFT) 的分位数。
+        hedge_min_samples: 延迟样本数达到多少后才按分位数对冲，之前使用 hedge_initial_delay。
+        hedge_initial_delay: 样本不足时的对冲等待时间 (秒)，为 None 时样本不足不对冲。
+        hedge_min_delay: 对冲等待时间的下限 (秒)。
+    """
+
+    def __init__(self, providers, call, failed, executor=None, failover=False, streaming=False, failure_threshold=3,
+                 cooldown=60, hedge_quantile=0.95, hedge_min_samples=20, hedge_initial_delay=None, hedge_min_delay=1.0):
+        self.call_provider = call
+        self.failed = failed
+        self.executor = executor
+        self.failover = failover
+        self.streaming = streaming
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_initial_delay = hedge_initial_delay
+        self.hedge_min_delay = hedge_min_delay
+        self._providers = {name: _Provider(name) for name in providers}
+        self._lock = threading.Lock()
+        self.failovers = 0
+
+    def _state(self, name):
+        with self._lock:
+            state = self._providers.get(name)
+            if state is None:
+                state = self._providers[name] = _Provider(name)
+            return state
+
+    def order(self, primary):
+        """本次请求依次尝试的模型：当前模型在前，熔断中的模型排在最后"""
+        self._state(primary)
+        if not self.failover:
+            return [primary]
+        now = time.monotonic()
+        with self._lock:
+            names = [primary] + [name for name in self._providers if name != primary]
+            healthy = [name for name in names if self._providers[name].open_until <= now]
+            return healthy + [name for name in names if name not in healthy]
+
+    def hedge_delay(self, name):
+        """name 开始请求后多久发出对冲请求 (秒)，不对冲时返回 None"""
+        state = self._state(name)
+        with self._lock:
+            histogram = state.ttft if self.streaming else state.latency
+            if histogram.count < self.hedge_min_samples:
+                delay = self.hedge_initial_delay
+            else:
+                delay = histogram.quantile(self.hedge_quantile) / 1000
+        return None if delay is None else max(self.hedge_min_delay, delay)
+
+    def _run(self, attempt, prompt, gate):
+        state = self._state(attempt.provider)
+        started = time.perf_counter()
+        result = self.call_provider(attempt.provider, prompt, gate.for_attempt(attempt))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            state.calls += 1
+            if attempt.cancelled:
+                state.cancelled += 1
+            elif self.failed(result):
+                state.failures += 1
+                state.consecutive_failures += 1
+                if state.consecutive_failures >= self.failure_threshold and state.open_until <= time.monotonic():
+                    state.open_until = time.monotonic() + self.cooldown
+                    logger.warning(f"[ChatSummary Routing] '{state.name}' failed {state.consecutive_failures} times in a row, "
+                                   f"skipping it for {self.cooldown}s.")
+            else:
+                state.successes += 1
+                state.consecutive_failures = 0
+                state.open_until = 0.0
+                state.latency.record(elapsed_ms)
+                if attempt.first_output is not None:
+                    state.ttft.record((attempt.first_output - started) * 1000)
+        return result
+
+    def call(self, primary, prompt, on_delta=None):
+        """按 order(primary) 发出请求，返回 (文本, 给出结果的模型)；全部失败时返回最后一个失败结果"""
+        candidates = self.order(primary)
+        gate = _OutputGate(on_delta)
+        if self.executor is None:
+            for index, name in enumerate(candidates):
+                attempt = _Attempt(name)
+                result = self._run(attempt, prompt, gate)
+                if not self.failed(result):
+                    return self._won(attempt, result, index)
+                logger.warning(f"[ChatSummary Routing] '{name}' failed: {result[:200]}")
+                if gate.owner is attempt:
+                    break
+            return result, name
+        return self._call_hedged(candidates, prompt, gate)
+
+    def _call_hedged(self, candidates, prompt, gate):
+        pending = {}
+        next_index = 0
+        result, last = None, candidates[0]
+
+        def launch(hedge=False):
+            nonlocal next_index
+            attempt = _Attempt(candidates[next_index], hedge)
+            next_index += 1
+            pending[self.executor.submit(self._run, attempt, prompt, gate)] = attempt
+            return attempt
+
+        launch()
+        hedge_at = None
+        delay = self.hedge_delay(candidates[0])
+        if delay is not None and len(candidates) > 1:
+            hedge_at = time.monotonic() + delay
+        while pending:
+            timeout = None
+            started_output = any(attempt.first_output is not None for attempt in pending.values())
+            if hedge_at is not None and not started_output and next_index < len(candidates):
+                timeout = max(0.0, hedge_at - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge_at = None
+                if any(attempt.first_output is not None for attempt in pending.values()):
+                    # 等待期间已开始输出，不再对冲
+                    continue
+                # 超过 p95 仍未完成也未开始输出，向下一个模型发出对冲请求 (每次调用只对冲一次)
+                attempt = launch(hedge=True)
+                with self._lock:
+                    self._providers[attempt.provider].hedges += 1
+                logger.info(f"[ChatSummary Routing] '{candidates[0]}' exceeded {delay:.1f}s, hedging with '{attempt.provider}'.")
+                continue
+            for future in done:
+                attempt = pending.pop(future)
+                result, last = future.result(), attempt.provider
+                if attempt.cancelled or (gate.owner is not None and gate.owner is not attempt):
+                    continue
+                if not self.failed(result):
+                    # 其余在途请求在下一段输出到达时停止
+                    gate.claim(attempt)
+                    return self._won(attempt, result, candidates.index(attempt.provider))
+                logger.warning(f"[ChatSummary Routing] '{attempt.provider}' failed: {result[:200]}")
+                if gate.owner is attempt:
+                    return result, attempt.provider
+            if not pending and next_index < len(candidates):
+                # 失败后改用下一个模型，不再对冲
+                hedge_at = None
+                launch()
+        return result, last
+
+    def _won(self, attempt, result, index):
+        with self._lock:
+            self._providers[attempt.provider].wins += 1
+            if index > 0:
+                self.failovers += 1
+        if index > 0:
+            logger.info(f"[ChatSummary Routing] Served by '{attempt.provider}'"
+                        f"{' (hedged request)' if attempt.hedge else ' after failover'}.")
+        return result, attempt.provider
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            providers = {}
+            for name, state in self._providers.items():
+                p50, p95 = state.latency.quantile(0.5), state.latency.quantile(0.95)
+                providers[name] = {
+                    "calls": state.calls,
+                    "successes": state.successes,
+                    "failures": state.failures,
+                    "wins": state.wins,
+                    "hedges": state.hedges,
+                    "cancelled": state.cancelled,
+                    "p50_ms": p50,
+                    "p95_ms": p95,
+                    "ttft_p50_ms": state.ttft.quantile(0.5),
+                    "ttft_p95_ms": state.ttft.quantile(0.95),
+                    "open": state.open_until > now,
+                }
+            return {"failovers": self.failovers, "providers": providers}
@@ -0,0 +1,145 @@
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .log import logger
+
+
+class _PooledSession:
+    """一个模型的 requests.Session 及其在途请求数 (用于安全替换)"""
+
+    __slots__ = ("session", "api_base", "active", "retired")
+
+    def __init__(self, session, api_base):
+        self.session = session
+        self.api_base = api_base
+        self.active = 0
+        self.retired = False
+
+
+class SessionPool:
+    """
+    按模型 (models 配置中的每一项) 维护长连接的 requests.Session。
+
+    同一模型的请求复用连接池中的 keep-alive 连接，省去每次总结的 DNS / TCP / TLS 握手。
+    模型的 api_base 变化或切换模型时旧 Session 被替换：新请求立即使用新 Session，
+    旧 Session 在最后一个在途请求的响应关闭后 (流式响应读完或被放弃) 才关闭。
+
+    Args:
+        pool_connections: 每个 Session 缓存的主机连接池数量。
+        pool_maxsize: 每个主机连接池保留的最大连接数。
+        keep_alive: 为 False 时每个请求带 Connection: close，不复用连接。
+        connect_timeout: 建立连接的超时 (秒)。
+        read_timeout: 等待响应数据的超时 (秒)。
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=8, keep_alive=True, connect_timeout=10, read_timeout=180):
+        self.pool_connections = max(1, int(pool_connections))
+        self.pool_maxsize = max(1, int(pool_maxsize))
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        # 已替换下来的 Session 的计数，保证 stats() 在重建后仍然累计
+        self._retired_counts = {}
+        self.rebuilds = 0
+
+    def _build(self, api_base):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return _PooledSession(session, api_base)
+
+    def _acquire(self, name, api_base):
+        with self._lock:
+            entry = self._sessions.get(name)
+            if entry is not None and entry.api_base != api_base:
+                logger.info(f"[ChatSummary HTTP] api_base of '{name}' changed, rebuilding its session.")
+                self._retire(name, entry)
+                entry = None
+            if entry is None:
+                entry = self._sessions[name] = self._build(api_base)
+            entry.active += 1
+            return entry
+
+    def _release(self, name, entry):
+        with self._lock:
+            entry.active -= 1
+            if entry.retired and entry.active == 0:
+                self._close(name, entry)
+
+    def _retire(self, name, entry):
+        """调用方持有锁；没有在途请求时立即关闭，否则等最后一个请求结束"""
+        del self._sessions[name]
+        entry.retired = True
+        self.rebuilds += 1
+        if entry.active == 0:
+            self._close(name, entry)
+
+    def _close(self, name, entry):
+        requests_sent, connections = self._pool_counts(entry)
+        total = self._retired_counts.setdefault(name, [0, 0])
+        total[0] += requests_sent
+        total[1] += connections
+        entry.session.close()
+
+    @staticmethod
+    def _pool_counts(entry):
+        """从 urllib3 连接池读取 (请求数, 新建连接数)"""
+        requests_sent = connections = 0
+        for adapter in set(entry.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        return requests_sent, connections
+
+    @contextmanager
+    def post(self, name, url, **kwargs):
+        """
+        用模型 name 的 Session 发送 POST，以上下文管理器的形式返回响应；未指定 timeout 时使用配置的 (连接, 读取) 超时。
+
+        退出时关闭响应，之后才释放 Session：stream=True 时响应头到达后仍在读取响应体，
+        期间切换模型不会关闭正在使用的连接。
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        entry = self._acquire(name, url)
+        try:
+            with entry.session.post(url, **kwargs) as response:
+                yield response
+        finally:
+            self._release(name, entry)
+
+    def reset(self, name):
+        """替换模型 name 的 Session (如切换模型时)，下一个请求重新建立连接"""
+        with self._lock:
+            entry = self._sessions.get(name)
+            if entry is not None:
+                self._retire(name, entry)
+
+    def close(self):
+        with self._lock:
+            for name, entry in list(self._sessions.items()):
+                self._retire(name, entry)
+
+    def stats(self):
+        """每个模型的请求数、新建连接数和复用连接的请求数 (含已替换的 Session)"""
+        with self._lock:
+            counts = {name: list(total) for name, total in self._retired_counts.items()}
+            for name, entry in self._sessions.items():
+                requests_sent, connections = self._pool_counts(entry)
+                total = counts.setdefault(name, [0, 0])
+                total[0] += requests_sent
+                total[1] += connections
+            result = {name: {"requests": requests_sent, "connections": connections,
+                             "reused": max(0, requests_sent - connections)}
+                      for name, (requests_sent, connections) in counts.items()}
+            result["rebuilds"] = self.rebuilds
+            return result
@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from .log import logger
+
+
+class _Call:
+    __slots__ = ("future", "started", "followers")
+
+    def __init__(self):
+        self.future = Future()
+        self.started = time.monotonic()
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一个键的调用仍在执行、且开始不超过 join_window 秒时，
+    后到的调用不再执行，而是等待并共享首个调用 (leader) 的结果或异常。
+
+    等待超过 wait_timeout 秒 (None 为不限) 时，后到的调用自行执行一次。
+
+    Args:
+        join_window: 允许加入的时间窗口 (秒)，超过后同一个键重新开始一次调用。
+        wait_timeout: 跟随者等待 leader 的最长时间 (秒)。
+    """
+
+    def __init__(self, join_window=60, wait_timeout=None):
+        self.join_window = join_window
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.joined = 0
+        self.wait_timeouts = 0
+        self.max_followers = 0
+
+    def do(self, key, fn):
+        """执行 fn() 或加入同一个键正在执行的调用，返回 (结果, 是否共享了其他请求的结果)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and not call.future.done() and time.monotonic() - call.started <= self.join_window:
+                call.followers += 1
+                self.joined += 1
+                self.max_followers = max(self.max_followers, call.followers)
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+        if not leader:
+            try:
+                return call.future.result(timeout=self.wait_timeout), True
+            except FutureTimeout:
+                with self._lock:
+                    self.joined -= 1
+                    self.wait_timeouts += 1
+                logger.warning(f"[ChatSummary SingleFlight] Waited {self.wait_timeout}s for an in-flight request, running it separately.")
+                return fn(), False
+        try:
+            result = fn()
+        except BaseException as e:
+            call.future.set_exception(e)
+            raise
+        else:
+            call.future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "joined": self.joined,
+                "wait_timeouts": self.wait_timeouts,
+                "max_followers": self.max_followers,
+                "in_flight": len(self._calls),
+            }
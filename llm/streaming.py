@@ -0,0 +1,244 @@
+"""
+流式 (SSE) 调用 LLM：逐块读取 OpenAI 兼容接口和智谱接口的 server-sent events，
+记录首个 token 的延迟 (TTFT) 与生成的 token 数，并把增量文本交给调用方提前处理。
+
+测试见 tests/test_streaming.py (启动本地 SSE 桩服务，不访问外部接口)。
+"""
+import json
+import threading
+import time
+
+from .log import logger
+
+
+class StreamError(Exception):
+    """流中途返回的错误事件或无法解析的数据"""
+
+
+class StreamResult:
+    """一次流式调用的结果与计时"""
+
+    __slots__ = ("text", "ttft_ms", "total_ms", "chunks", "tokens", "usage_reported", "finish_reason", "stopped_early")
+
+    def __init__(self):
+        self.text = ""
+        self.ttft_ms = None
+        self.total_ms = 0.0
+        self.chunks = 0
+        self.tokens = 0
+        self.usage_reported = False
+        self.finish_reason = None
+        self.stopped_early = False
+
+
+def iter_sse_data(response):
+    """产出每个 SSE 事件的 data 字段 (多行 data 以换行连接)，收到 [DONE] 时结束"""
+    response.encoding = "utf-8"
+    data = []
+    # chunk_size=None：分块传输的响应每到达一块就处理，不等凑满缓冲区
+    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+        if not line:
+            if data:
+                payload, data = "\n".join(data), []
+                if payload == "[DONE]":
+                    return
+                yield payload
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if field == "data":
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data and "\n".join(data) != "[DONE]":
+        yield "\n".join(data)
+
+
+def read_chat_stream(response, on_delta=None, started=None):
+    """
+    读取 chat/completions 的流式响应，返回 StreamResult。
+
+    on_delta(text) 在每段增量文本到达时调用，返回 True 表示调用方已拿到所需内容，
+    此时立即关闭连接、停止读取。服务端给出 usage 时 tokens 取 completion_tokens，
+    否则按增量块数近似 (多数接口每块一个 token)。
+    """
+    started = time.perf_counter() if started is None else started
+    result = StreamResult()
+    parts = []
+    try:
+        for data in iter_sse_data(response):
+            try:
+                event = json.loads(data)
+            except ValueError:
+                raise StreamError(f"无法解析的流数据: {data[:200]}")
+            if event.get("error"):
+                error = event["error"]
+                raise StreamError(error.get("message", str(error)) if isinstance(error, dict) else str(error))
+            usage = event.get("usage")
+            if isinstance(usage, dict) and usage.get("completion_tokens") is not None:
+                result.tokens = usage["completion_tokens"]
+                result.usage_reported = True
+            for choice in event.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if choice.get("finish_reason"):
+                    result.finish_reason = choice["finish_reason"]
+                if not content:
+                    continue
+                if result.ttft_ms is None:
+                    result.ttft_ms = (time.perf_counter() - started) * 1000
+                parts.append(content)
+                result.chunks += 1
+                if on_delta is not None and on_delta(content):
+                    result.stopped_early = True
+                    break
+            if result.stopped_early:
+                break
+    finally:
+        response.close()
+    result.text = "".join(parts)
+    if not result.usage_reported:
+        result.tokens = result.chunks
+    result.total_ms = (time.perf_counter() - started) * 1000
+    return result
+
+
+class StreamMetrics:
+    """流式调用的累计计数，随运行时统计输出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.tokens = 0
+        self.early_stops = 0
+        self.ttft_ms_total = 0.0
+        self.total_ms_total = 0.0
+        self.last = None
+
+    def record(self, result):
+        with self._lock:
+            self.streams += 1
+            self.tokens += result.tokens
+            self.early_stops += int(result.stopped_early)
+            self.ttft_ms_total += result.ttft_ms or 0.0
+            self.total_ms_total += result.total_ms
+            self.last = {"ttft_ms": None if result.ttft_ms is None else round(result.ttft_ms, 1),
+                         "total_ms": round(result.total_ms, 1), "tokens": result.tokens}
+
+    def stats(self):
+        with self._lock:
+            streams = max(1, self.streams)
+            return {
+                "streams": self.streams,
+                "tokens": self.tokens,
+                "early_stops": self.early_stops,
+                "avg_ttft_ms": round(self.ttft_ms_total / streams, 1),
+                "avg_total_ms": round(self.total_ms_total / streams, 1),
+                "last": self.last,
+            }
+
+
+class StreamingJSONObject:
+    """
+    边生成边解析模型输出的 JSON 对象。
+
+    跟踪括号深度与字符串状态，顶层对象的每个成员一完成就解析，生成结束时只剩最后一个成员需要解析；
+    顶层对象闭合后 feed() 返回 True，调用方可以不再读取剩余输出 (如结尾的 ``` 或说明文字)。
+    输出开头不是 JSON (允许 ```json 代码块标记) 或成员解析失败时 failed 为 True，
+    调用方应回退到对完整文本解析。
+    """
+
+    _FENCES = ("", "```", "```json", "```JSON")
+
+    def __init__(self):
+        self.text = ""
+        self.members = {}
+        self.done = False
+        self.failed = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = None
+
+    def feed(self, chunk):
+        if self.done or self.failed:
+            return self.done
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._member_start is None:
+                if ch == "{":
+                    if text[:i].strip() not in self._FENCES:
+                        self.failed = True
+                        return False
+                    self._depth, self._member_start = 1, i + 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos = i + 1
+                    self._finish_member(text[self._member_start:i])
+                    self.done = not self.failed
+                    return self.done
+            elif ch == "," and self._depth == 1:
+                self._finish_member(text[self._member_start:i])
+                self._member_start = i + 1
+                if self.failed:
+                    return False
+        self._pos = len(text)
+        if self._member_start is None and len(text.strip()) > len("```json") and text.strip() not in self._FENCES:
+            self.failed = "{" not in text
+        return False
+
+    def _finish_member(self, segment):
+        if not segment.strip():
+            return
+        try:
+            self.members.update(json.loads("{" + segment + "}"))
+        except ValueError:
+            self.failed = True
+
+    def result(self):
+        return dict(self.members)
+
+
+class ParagraphSender:
+    """
+    把流式生成的文本按段落分批发送：缓冲超过 min_chars 且出现段落分隔 (空行) 时，
+    发送到最后一个分隔为止的内容；最后一段留给调用方作为最终回复。
+    """
+
+    def __init__(self, send, min_chars=300):
+        self.send = send
+        self.min_chars = max(1, int(min_chars))
+        self.buffer = ""
+        self.sent = 0
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if len(self.buffer) >= self.min_chars:
+            cut = self.buffer.rfind("\n\n")
+            if cut > 0 and self.buffer[:cut].strip():
+                segment, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+                try:
+                    self.send(segment)
+                    self.sent += 1
+                except Exception as e:
+                    logger.warning(f"[ChatSummary Stream] Failed to send a partial reply: {e}")
+                    self.buffer = segment + self.buffer
+                    self.min_chars = float("inf")  # 发送失败后不再分批，全部留给最终回复
+        return False
+
+    def remainder(self):
+        return self.buffer.strip()
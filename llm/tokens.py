@@ -0,0 +1,214 @@
+"""
+按模型计算 token 数，并在输入预算内按整条消息打包聊天记录。
+
+安装了 tiktoken 且能加载编码表时按模型对应的编码精确计数；否则 (或 mode 为 approx 时)
+使用按字符类别估算的近似计数。非 OpenAI 模型 (DeepSeek、通义千问、智谱等) 没有公开的
+tiktoken 编码，使用 cl100k_base 计数，其中文分词通常比这些模型自己的分词器更细，预算偏保守。
+"""
+import functools
+import math
+import re
+import threading
+import time
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from .log import logger
+
+DEFAULT_ENCODING = "cl100k_base"
+APPROX = "approx"
+
+# 模型名前缀 -> 编码，按顺序匹配 (tiktoken 无法识别的模型名才使用)
+MODEL_ENCODINGS = [
+    ("gpt-4o", "o200k_base"),
+    ("gpt-4.1", "o200k_base"),
+    ("gpt-4.5", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+]
+
+# 近似计数：英文单词约 4 个字符一个 token，数字约 3 位一个，ASCII 标点各一个，其余字符 (中文等) 各一个
+_APPROX_PIECE = re.compile(r"[A-Za-z]+|[0-9]+|[!-/:-@\[-`{-~]|[^\x00-\x7f]")
+
+# 短文本 (单条消息行) 的计数结果缓存，长文本 (完整 Prompt) 不缓存
+_CACHEABLE_CHARS = 512
+
+
+def approx_count(text):
+    count = 0
+    for piece in _APPROX_PIECE.findall(text):
+        first = piece[0]
+        if first.isascii() and first.isalpha():
+            count += math.ceil(len(piece) / 4)
+        elif first.isascii() and first.isdigit():
+            count += math.ceil(len(piece) / 3)
+        else:
+            count += 1
+    return count
+
+
+def encoding_name_for(model):
+    """返回模型使用的 tiktoken 编码名"""
+    model = (model or "").lower()
+    if tiktoken is not None and model:
+        try:
+            return tiktoken.encoding_name_for_model(model)
+        except (KeyError, AttributeError):
+            pass
+    for prefix, name in MODEL_ENCODINGS:
+        if model.startswith(prefix):
+            return name
+    return DEFAULT_ENCODING
+
+
+class Tokenizer:
+    """一种编码的计数器，count() 对短文本的结果做 LRU 缓存"""
+
+    def __init__(self, name, encoding=None, cache_size=8192):
+        self.name = name
+        self.encoding = encoding
+        self.exact = encoding is not None
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return approx_count(text)
+
+    def count(self, text):
+        if not text:
+            return 0
+        if len(text) <= _CACHEABLE_CHARS:
+            return self._cached(text)
+        return self._count(text)
+
+    def cache_info(self):
+        info = self._cached.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+
+class TokenizerService:
+    """
+    按模型提供 Tokenizer，同一编码只加载一次。
+
+    编码表在后台线程中加载 (首次加载需联网下载，不设超时)，加载完成前 for_model 返回近似计数器，
+    总结请求不会因为下载编码表而阻塞；插件启动时可用 preload 提前加载并有限等待。
+
+    Args:
+        mode: auto (优先 tiktoken，未安装或编码表加载失败时近似计数) 或 approx (始终近似计数)。
+        encoding: 指定编码名，覆盖按模型名的映射。
+        cache_size: 每个 Tokenizer 缓存的短文本计数结果数量。
+    """
+
+    def __init__(self, mode="auto", encoding=None, cache_size=8192):
+        self.mode = mode
+        self.encoding_override = encoding or None
+        self.cache_size = cache_size
+        self._approx = Tokenizer(APPROX, cache_size=cache_size)
+        self._tokenizers = {APPROX: self._approx}
+        self._loading = {}
+        self._lock = threading.Lock()
+        if mode != APPROX and tiktoken is None:
+            logger.warning("[ChatSummary Tokens] tiktoken is not installed, using approximate token counts. "
+                           "Run 'pip install tiktoken' for exact budgeting.")
+
+    def _encoding_name(self, model):
+        if self.mode == APPROX or tiktoken is None:
+            return APPROX
+        return self.encoding_override or encoding_name_for(model)
+
+    def for_model(self, model):
+        """返回模型的 Tokenizer；编码表尚未加载完成时返回近似计数器并在后台开始加载"""
+        name = self._encoding_name(model)
+        tokenizer = self._tokenizers.get(name)
+        if tokenizer is not None:
+            return tokenizer
+        self._start_loading(name)
+        return self._approx
+
+    def preload(self, models, timeout=5.0):
+        """在后台加载这些模型的编码表，最多等待 timeout 秒，返回是否已全部加载完成"""
+        loaders = [self._start_loading(name) for name in {self._encoding_name(model) for model in models}]
+        loaders = [loader for loader in loaders if loader is not None]
+        deadline = time.monotonic() + max(0.0, timeout or 0)
+        for loader in loaders:
+            loader.join(max(0.0, deadline - time.monotonic()))
+        pending = [loader.name for loader in loaders if loader.is_alive()]
+        if pending:
+            logger.info(f"[ChatSummary Tokens] Still loading tiktoken encodings after {timeout}s, "
+                        f"using approximate token counts until they are ready.")
+        return not pending
+
+    def _start_loading(self, name):
+        """启动 (或返回已在进行的) 后台加载线程，编码已加载时返回 None"""
+        with self._lock:
+            if name in self._tokenizers:
+                return None
+            loader = self._loading.get(name)
+            if loader is None:
+                loader = self._loading[name] = threading.Thread(target=self._load, args=(name,), daemon=True,
+                                                                name=f"ChatSummaryTokens-{name}")
+                loader.start()
+        return loader
+
+    def _load(self, name):
+        try:
+            # 首次加载编码表需要联网下载 (之后使用 tiktoken 的本地缓存)
+            tokenizer = Tokenizer(name, tiktoken.get_encoding(name), self.cache_size)
+            logger.info(f"[ChatSummary Tokens] Loaded tiktoken encoding '{name}'.")
+        except Exception as e:
+            logger.warning(f"[ChatSummary Tokens] Failed to load tiktoken encoding '{name}' ({e}), "
+                           f"using approximate token counts.")
+            tokenizer = self._approx
+        with self._lock:
+            self._tokenizers[name] = tokenizer
+            self._loading.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            tokenizers = list(self._tokenizers.items())
+            loading = list(self._loading)
+        stats = {name: dict(tokenizer.cache_info(), exact=tokenizer.exact) for name, tokenizer in tokenizers}
+        if loading:
+            stats["loading"] = loading
+        return stats
+
+
+def pack_newest(tokenizer, lines, budget):
+    """
+    从新到旧读取消息行，累计 token 数 (每行另计 1 个换行) 超过 budget 前停止。
+
+    返回 (保留的行 (从新到旧), 是否因预算截断)；逐行累加是整段文本计数的上界近似，最终以 fit_oldest 精确校验。
+    """
+    kept, used = [], 0
+    for line in lines:
+        used += tokenizer.count(line) + 1
+        if used > budget:
+            return kept, True
+        kept.append(line)
+    return kept, False
+
+
+def fit_oldest(tokenizer, lines, render, budget):
+    """
+    lines 为从旧到新的消息行，render(lines) 生成完整输入文本。
+
+    从最旧的消息开始整条丢弃，返回使 tokenizer.count(render(保留的行)) <= budget 的最长后缀；
+    丢弃条数按二分查找确定，只需对完整文本计数 O(log n) 次。全部丢弃仍超出预算时返回空列表。
+    """
+    if tokenizer.count(render(lines)) <= budget:
+        return lines
+    low, high = 1, len(lines)  # 丢弃 high 条一定满足 (空列表)，丢弃 low - 1 条不满足
+    while low < high:
+        middle = (low + high) // 2
+        if tokenizer.count(render(lines[middle:])) <= budget:
+            high = middle
+        else:
+            low = middle + 1
+    return lines[high:]
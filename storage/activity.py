@@ -0,0 +1,167 @@
+import time
+
+from .log import logger
+from .partition import MAIN_TABLE
+from .schema import SUMMARIZABLE_INDEX, get_meta, is_summarizable, set_meta
+
+ACTIVITY_TABLE = "chat_activity"
+BUCKET_SECONDS = 3600
+
+
+def bucket_of(timestamp) -> int:
+    """时间戳所在的小时桶 (按 UTC 整点对齐)"""
+    return int(timestamp) // BUCKET_SECONDS * BUCKET_SECONDS
+
+
+class ActivityRollup:
+    """
+    按 (会话, 小时桶, 用户) 汇总可总结消息的条数与首末发言时间，保存在主库的 chat_activity 表中。
+
+    写入时在同一事务内把新消息的条数和首末时间以增量 UPSERT 合并到桶中；替换已有 msgid 的写入、
+    迁移和保留策略删除时，对受影响的桶从消息表重新计数，因此重复写入同一 msgid 或删除消息后
+    汇总仍然精确；统计一个时间窗口只需读取窗口内的桶。
+
+    Args:
+        layout: 存储布局，用于定位桶所在的消息表 (主库或已附加的分片)。
+    """
+
+    BUILT_KEY = "activity_rollup_built"
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.refreshed_buckets = 0
+        self.delta_rows = 0
+
+    def create_tables(self, conn):
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {ACTIVITY_TABLE}
+                        (session_id INTEGER NOT NULL,
+                         bucket INTEGER NOT NULL,
+                         user_id INTEGER,
+                         message_count INTEGER NOT NULL,
+                         first_ts INTEGER NOT NULL,
+                         last_ts INTEGER NOT NULL,
+                         PRIMARY KEY (session_id, bucket, user_id)) WITHOUT ROWID""")
+
+    def needs_build(self, conn) -> bool:
+        return get_meta(conn, self.BUILT_KEY) is None
+
+    def build_table(self, conn, table):
+        """从一张消息表汇总已有消息 (首次启用时对主库和每个分片各调用一次，结果累加)"""
+        conn.execute(f"""INSERT INTO {ACTIVITY_TABLE} (session_id, bucket, user_id, message_count, first_ts, last_ts)
+                         SELECT session_id, (timestamp / {BUCKET_SECONDS}) * {BUCKET_SECONDS}, user_id,
+                                COUNT(*), MIN(timestamp), MAX(timestamp)
+                         FROM {table} WHERE is_summarizable = 1
+                         GROUP BY 1, 2, 3
+                         ON CONFLICT (session_id, bucket, user_id) DO UPDATE SET
+                             message_count = message_count + excluded.message_count,
+                             first_ts = MIN(first_ts, excluded.first_ts),
+                             last_ts = MAX(last_ts, excluded.last_ts)""")
+
+    def mark_built(self, conn):
+        set_meta(conn, self.BUILT_KEY, int(time.time()))
+
+    def _tables(self, conn, bucket):
+        """桶可能所在的、当前连接上已附加的消息表 (写事务内不能再附加新的分片)"""
+        if not self.layout.partitioned:
+            return [MAIN_TABLE]
+        attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+        aliases = {self.layout.alias(self.layout.shard_key(ts)) for ts in (bucket, bucket + BUCKET_SECONDS - 1)}
+        return [f"{alias}.chat_messages" for alias in sorted(aliases) if alias in attached] + [MAIN_TABLE]
+
+    def refresh(self, conn, keys):
+        """
+        重新计数受影响的桶。
+
+        keys: (session_id, timestamp) 的可迭代对象，即本次写入或删除的消息；须在同一写事务内调用。
+        """
+        for session_id, bucket in sorted({(session_id, bucket_of(ts)) for session_id, ts in keys}):
+            merged = {}
+            for table in self._tables(conn, bucket):
+                for user_id, count, first_ts, last_ts in conn.execute(
+                        f"""SELECT user_id, COUNT(*), MIN(timestamp), MAX(timestamp)
+                            FROM {table} INDEXED BY {SUMMARIZABLE_INDEX}
+                            WHERE session_id = ? AND is_summarizable = 1 AND timestamp >= ? AND timestamp < ?
+                            GROUP BY user_id""",
+                        (session_id, bucket, bucket + BUCKET_SECONDS)):
+                    previous = merged.get(user_id)
+                    if previous is not None:
+                        count, first_ts, last_ts = (count + previous[0], min(first_ts, previous[1]),
+                                                    max(last_ts, previous[2]))
+                    merged[user_id] = (count, first_ts, last_ts)
+            conn.execute(f"DELETE FROM {ACTIVITY_TABLE} WHERE session_id = ? AND bucket = ?", (session_id, bucket))
+            conn.executemany(f"""INSERT INTO {ACTIVITY_TABLE} (session_id, bucket, user_id, message_count, first_ts, last_ts)
+                                 VALUES (?,?,?,?,?,?)""",
+                             [(session_id, bucket, user_id) + values for user_id, values in merged.items()])
+            self.refreshed_buckets += 1
+
+    def existing_keys(self, conn, table, rows):
+        """
+        写入前调用：rows 中的 (session_id, msgid) 已在 table 中存在的，返回 {(session_id, msgid): 原时间戳}。
+
+        INSERT OR REPLACE 会删除这些行 (时间戳可能不同，即位于另一个桶)，写入后由 add_rows 重新计数。
+        """
+        msgids_by_session = {}
+        for row in rows:
+            msgids_by_session.setdefault(row[0], set()).add(row[2])
+        existing = {}
+        for session_id, msgids in msgids_by_session.items():
+            msgids = sorted(msgids)
+            for index in range(0, len(msgids), 500):
+                chunk = msgids[index:index + 500]
+                for msgid, timestamp in conn.execute(
+                        f"""SELECT msgid, timestamp FROM {table}
+                            WHERE session_id = ? AND msgid IN ({",".join("?" * len(chunk))})""",
+                        [session_id] + chunk):
+                    existing[(session_id, msgid)] = timestamp
+        return existing
+
+    def add_rows(self, conn, rows, existing):
+        """
+        写入钩子：rows 为刚以 INSERT OR REPLACE 写入的 (session_id, timestamp, msgid, user_id, type_code, is_triggered, content)，
+        existing 为写入前 existing_keys 的结果。
+
+        新消息按 (会话, 桶, 用户) 合并后增量更新；替换了已有行 (或在同一批中重复) 的 msgid 所在的新旧桶重新计数，
+        这些桶中的新消息已包含在重新计数的结果里，不再重复累加。
+        """
+        seen = {}
+        for row in rows:
+            seen[(row[0], row[2])] = seen.get((row[0], row[2]), 0) + 1
+        recount = {(session_id, bucket_of(timestamp)) for (session_id, _), timestamp in existing.items()}
+        recount.update((row[0], bucket_of(row[1])) for row in rows
+                       if (row[0], row[2]) in existing or seen[(row[0], row[2])] > 1)
+        deltas = {}
+        for session_id, timestamp, _, user_id, code, _, content in rows:
+            bucket = bucket_of(timestamp)
+            if (session_id, bucket) in recount or not is_summarizable(code, content):
+                continue
+            key = (session_id, bucket, user_id)
+            previous = deltas.get(key)
+            deltas[key] = ((1, timestamp, timestamp) if previous is None else
+                           (previous[0] + 1, min(previous[1], timestamp), max(previous[2], timestamp)))
+        conn.executemany(f"""INSERT INTO {ACTIVITY_TABLE} (session_id, bucket, user_id, message_count, first_ts, last_ts)
+                             VALUES (?,?,?,?,?,?)
+                             ON CONFLICT (session_id, bucket, user_id) DO UPDATE SET
+                                 message_count = message_count + excluded.message_count,
+                                 first_ts = MIN(first_ts, excluded.first_ts),
+                                 last_ts = MAX(last_ts, excluded.last_ts)""",
+                         [key + values for key, values in deltas.items()])
+        self.delta_rows += len(deltas)
+        self.refresh(conn, recount)
+
+    def refresh_rows(self, conn, rows):
+        """迁移钩子 (INSERT OR IGNORE，冲突的行不写入)：rows 为 (session_id, timestamp, msgid, ...) 元组，对所在的桶重新计数"""
+        self.refresh(conn, ((row[0], row[1]) for row in rows))
+
+    def refresh_deleted(self, conn, session_id, keys):
+        """保留策略的删除钩子：keys 为 [(timestamp, msgid), ...]"""
+        self.refresh(conn, ((session_id, ts) for ts, _ in keys))
+
+    def buckets(self, conn, session_id, first_bucket, last_bucket):
+        """读取 [first_bucket, last_bucket] 内的汇总行 [(桶, 用户名, 条数, 首条时间戳, 末条时间戳), ...]"""
+        return conn.execute(f"""SELECT a.bucket, u.name, a.message_count, a.first_ts, a.last_ts
+                                FROM {ACTIVITY_TABLE} a LEFT JOIN users u ON u.id = a.user_id
+                                WHERE a.session_id = ? AND a.bucket >= ? AND a.bucket <= ?""",
+                            (session_id, first_bucket, last_bucket)).fetchall()
+
+    def stats(self):
+        return {"delta_rows": self.delta_rows, "refreshed_buckets": self.refreshed_buckets}
@@ -0,0 +1,291 @@
+"""
+会话窗口的本地统计：总消息数、话唠榜、按小时 / 星期的活跃分布和熬夜冠军由按小时汇总的行
+(store.aggregate，SQLite 后端读取 chat_activity 汇总表) 计算；消息长度和连续对话片段需要逐条消息，
+把窗口内的可总结消息载入列数组 (安装了 NumPy 时为 ndarray，否则为 array) 后按列计算。
+
+在插件目录下运行基准测试 (合成数据，不读取 chat.db)：
+
+    python -m storage.analytics --rows 1000000
+"""
+import argparse
+import heapq
+import random
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .backends.base import USER, CONTENT, TIMESTAMP
+
+NIGHT_HOURS = frozenset({23, 0, 1, 2, 3, 4, 5})  # 计入深夜消息的本地小时
+DAY_START = 6 * 3600  # 比较谁睡得最晚时，以本地早上 6 点为一天的起点
+BUCKET_SECONDS = 3600  # store.aggregate 的桶宽，与 chat_activity 汇总表一致
+BURST_GAP = 60  # 相邻消息间隔不超过该秒数时视为同一段连续对话
+MIN_BURST = 5  # 连续对话片段的最少消息数
+WEEKDAYS = ("周一", "周二", "周三", "周四", "周五", "周六", "周日")
+
+
+class ColumnWindow:
+    """
+    一个会话窗口内的消息，按列保存并按时间从旧到新排列。
+
+    Attributes:
+        timestamps: 消息时间戳 (int64)。
+        users: 用户编号 (int32)，对应 names 中的下标。
+        lengths: 消息字数 (int32)。
+        names: 用户名列表。
+    """
+
+    def __init__(self, timestamps, users, lengths, names):
+        self.timestamps = timestamps
+        self.users = users
+        self.lengths = lengths
+        self.names = names
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_records(cls, records):
+        """从记录元组 (任意顺序，通常是 range_scan 的新到旧) 建立列"""
+        timestamps, users, lengths = array("q"), array("l"), array("l")
+        codes, names = {}, []
+        for record in records:
+            user = record[USER] or "未知用户"
+            code = codes.get(user)
+            if code is None:
+                code = codes[user] = len(names)
+                names.append(user)
+            timestamps.append(record[TIMESTAMP])
+            users.append(code)
+            lengths.append(len(record[CONTENT] or ""))
+        return cls.from_columns(timestamps, users, lengths, names)
+
+    @classmethod
+    def from_columns(cls, timestamps, users, lengths, names):
+        """由三列数据建立窗口，必要时按时间戳排序 (同一秒内保持原有的相对顺序)"""
+        if np is not None:
+            timestamps = np.asarray(timestamps, dtype=np.int64)
+            users = np.asarray(users, dtype=np.int32)
+            lengths = np.asarray(lengths, dtype=np.int32)
+            if len(timestamps) > 1 and not np.all(timestamps[1:] >= timestamps[:-1]):
+                if np.all(timestamps[1:] <= timestamps[:-1]):
+                    timestamps, users, lengths = timestamps[::-1], users[::-1], lengths[::-1]
+                else:
+                    order = np.argsort(timestamps, kind="stable")
+                    timestamps, users, lengths = timestamps[order], users[order], lengths[order]
+            return cls(timestamps, users, lengths, list(names))
+
+        timestamps, users, lengths = array("q", timestamps), array("l", users), array("l", lengths)
+        if any(timestamps[i] > timestamps[i + 1] for i in range(len(timestamps) - 1)):
+            order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+            timestamps = array("q", (timestamps[i] for i in order))
+            users = array("l", (users[i] for i in order))
+            lengths = array("l", (lengths[i] for i in order))
+        return cls(timestamps, users, lengths, list(names))
+
+
+def load_window(store, session_id, start_timestamp=0, end_timestamp=None):
+    """读取 start_timestamp < timestamp <= end_timestamp 内的可总结消息"""
+    return ColumnWindow.from_records(store.range_scan(str(session_id), int(start_timestamp), end_timestamp))
+
+
+def _length_ranks(total):
+    """消息字数中位数、P90 和最大值在升序排列中的下标"""
+    return (total - 1) // 2, min(total - 1, total * 9 // 10), total - 1
+
+
+def _numpy_passes(window, burst_gap, min_burst):
+    ts, users, lengths = window.timestamps, window.users, window.lengths
+    total = len(ts)
+    ranks = _length_ranks(total)
+    quantiles = np.partition(lengths, ranks)[list(ranks)].tolist()
+    segment_starts = np.flatnonzero(np.concatenate(([True], np.diff(ts) > burst_gap)))
+    segment_sizes = np.diff(np.append(segment_starts, total))
+    bursts = segment_sizes >= min_burst
+    return {
+        "length_total": int(lengths.sum()),
+        "length_quantiles": quantiles,
+        "bursts": (segment_starts[bursts].tolist(), segment_sizes[bursts].tolist()),
+        "participants": lambda start, size: len(np.unique(users[start:start + size])),
+    }
+
+
+def _python_passes(window, burst_gap, min_burst):
+    ts, users, lengths = window.timestamps, window.users, window.lengths
+    segment_starts = [0] + [i for i in range(1, len(ts)) if ts[i] - ts[i - 1] > burst_gap]
+    segment_sizes = [end - start for start, end in zip(segment_starts, segment_starts[1:] + [len(ts)])]
+    bursts = [(start, size) for start, size in zip(segment_starts, segment_sizes) if size >= min_burst]
+    sorted_lengths = sorted(lengths)
+    return {
+        "length_total": sum(lengths),
+        "length_quantiles": [sorted_lengths[rank] for rank in _length_ranks(len(ts))],
+        "bursts": ([start for start, _ in bursts], [size for _, size in bursts]),
+        "participants": lambda start, size: len(set(users[start:start + size])),
+    }
+
+
+def _clock(timestamp, time_format="%H:%M"):
+    return time.strftime(time_format, time.localtime(int(timestamp)))
+
+
+def bucket_stats(buckets, top_n=3, night_hours=NIGHT_HOURS):
+    """
+    由按小时汇总的行 (store.aggregate 的返回值) 计算计数类统计，没有消息时返回 None。
+
+    按小时 / 星期的分布以桶起点的本地时间归类，时区偏移不是整小时时会有半小时的误差；
+    熬夜冠军取深夜桶内末条发言最晚的人，同一小时桶内越晚越“熬夜”，所以只看末条时间即可。
+
+    Args:
+        buckets: [(桶起始时间戳, 用户名, 条数, 首条时间戳, 末条时间戳), ...]，桶宽为一小时。
+    """
+    counts, night_counts, latest = {}, {}, {}
+    hours, weekdays = [0] * 24, [0] * 7
+    local_times = {}
+    first_ts = last_ts = None
+    for bucket, user, count, first, last in buckets:
+        if not count:
+            continue
+        user = user or "未知用户"
+        moment = local_times.get(bucket)
+        if moment is None:
+            moment = local_times[bucket] = time.localtime(bucket)
+        counts[user] = counts.get(user, 0) + count
+        hours[moment.tm_hour] += count
+        weekdays[moment.tm_wday] += count
+        if moment.tm_hour in night_hours:
+            night_counts[user] = night_counts.get(user, 0) + count
+            # 距本地早上 6 点的秒数，越大表示睡得越晚
+            lateness = (moment.tm_hour * 3600 + moment.tm_min * 60 + moment.tm_sec + last - bucket - DAY_START) % 86400
+            latest[user] = max(latest.get(user, (lateness, last)), (lateness, last))
+        first_ts = first if first_ts is None else min(first_ts, first)
+        last_ts = last if last_ts is None else max(last_ts, last)
+    if not counts:
+        return None
+
+    ranked = heapq.nsmallest(top_n, counts, key=lambda user: (-counts[user], user))
+    night_owl = None
+    if latest:
+        # 最晚的发言时间相同时，深夜消息多的人胜出
+        user = max(latest, key=lambda user: (latest[user][0], night_counts[user], latest[user][1]))
+        night_owl = {
+            "nickname": user,
+            "latest_active_time": _clock(latest[user][1]),
+            "late_night_messages": night_counts[user],
+        }
+
+    time_format = "%H:%M" if last_ts - first_ts < 86400 else "%m-%d %H:%M"
+    return {
+        "total_messages": sum(counts.values()),
+        "active_users": len(counts),
+        "time_range": f"{_clock(first_ts, time_format)}-{_clock(last_ts, time_format)}",
+        "top_chatters": [{"rank": rank, "nickname": user, "message_count": counts[user]}
+                         for rank, user in enumerate(ranked, 1)],
+        "night_owl": night_owl,
+        "hourly_activity": hours,
+        "peak_hour": max(range(24), key=hours.__getitem__),
+        "weekday_activity": weekdays,
+    }
+
+
+def window_stats(window, burst_gap=BURST_GAP, min_burst=MIN_BURST):
+    """
+    计算必须逐条消息才能得到的统计，窗口为空时返回 None：
+
+        message_length: {"average", "median", "p90", "max"} 消息字数
+        reply_bursts: {"count", "messages", "longest"} 相邻间隔不超过 burst_gap 秒、
+            至少 min_burst 条消息的连续对话片段
+    """
+    total = len(window)
+    if not total:
+        return None
+    passes = (_numpy_passes if np is not None else _python_passes)(window, burst_gap, min_burst)
+    ts = window.timestamps
+
+    burst_starts, burst_sizes = passes["bursts"]
+    longest = None
+    if burst_sizes:
+        start, size = max(zip(burst_starts, burst_sizes), key=lambda item: item[1])
+        longest = {
+            "start_time": _clock(ts[start]),
+            "end_time": _clock(ts[start + size - 1]),
+            "message_count": size,
+            "participants": passes["participants"](start, size),
+        }
+    return {
+        "message_length": {
+            "average": round(passes["length_total"] / total, 1),
+            "median": passes["length_quantiles"][0],
+            "p90": passes["length_quantiles"][1],
+            "max": passes["length_quantiles"][2],
+        },
+        "reply_bursts": {
+            "count": len(burst_sizes),
+            "messages": sum(burst_sizes),
+            "longest": longest,
+        },
+    }
+
+
+def analyze(buckets, window, top_n=3, night_hours=NIGHT_HOURS, burst_gap=BURST_GAP, min_burst=MIN_BURST):
+    """
+    合并 bucket_stats 与 window_stats 的结果，没有消息时返回 None。
+
+    返回的 top_chatters / night_owl 与图片报告 data_analysis 中的同名键结构一致，
+    total_messages, active_users, time_range 与报告 metadata 同名键一致，
+    其余键为附加统计 (hourly_activity, peak_hour, weekday_activity, message_length, reply_bursts)。
+    """
+    stats = bucket_stats(buckets, top_n, night_hours)
+    if stats is None:
+        return None
+    stats.update(window_stats(window, burst_gap, min_burst) or {
+        "message_length": {"average": 0, "median": 0, "p90": 0, "max": 0},
+        "reply_bursts": {"count": 0, "messages": 0, "longest": None},
+    })
+    return stats
+
+
+def _buckets_of(window, bucket_seconds=BUCKET_SECONDS):
+    """把窗口按 (小时桶, 用户) 汇总为 store.aggregate 的行格式 (基准测试用)"""
+    buckets = {}
+    for timestamp, user in zip(window.timestamps, window.users):
+        key = (int(timestamp) // bucket_seconds * bucket_seconds, window.names[user])
+        count, first, last = buckets.get(key, (0, timestamp, timestamp))
+        buckets[key] = (count + 1, min(first, timestamp), max(last, timestamp))
+    return [(bucket, user) + values for (bucket, user), values in sorted(buckets.items())]
+
+
+def _synthetic_window(rows, users=200, seed=7, start=1700000000):
+    """合成窗口：消息间隔 0-120 秒，用户活跃度呈长尾分布"""
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(users)]
+    timestamps, moment = array("q"), start
+    for _ in range(rows):
+        moment += rng.randrange(120)
+        timestamps.append(moment)
+    codes = array("l", rng.choices(range(users), weights, k=rows))
+    lengths = array("l", (rng.randrange(1, 200) for _ in range(rows)))
+    return ColumnWindow.from_columns(timestamps, codes, lengths, [f"user{i}" for i in range(users)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the session window analytics")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    window = _synthetic_window(args.rows)
+    buckets = _buckets_of(window)
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        window_stats(window)
+    window_ms = (time.perf_counter() - started) * 1000 / args.repeat
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        result = analyze(buckets, window)
+    elapsed_ms = (time.perf_counter() - started) * 1000 / args.repeat
+    print(f"backend={'numpy' if np is not None else 'array'} rows={args.rows} buckets={len(buckets)} "
+          f"window_stats={window_ms:.1f} ms analyze={elapsed_ms:.1f} ms")
+    print({key: result[key] for key in ("total_messages", "active_users", "top_chatters", "night_owl", "peak_hour")})
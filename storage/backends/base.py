@@ -0,0 +1,47 @@
+from ..schema import type_code, is_summarizable
+
+# 记录元组的字段顺序 (写入与读取相同)：
+# (session_id, msgid, user, content, type, timestamp, is_triggered, line_prefix)
+# session_id / user 为字符串，type 为 ContextType 名称，line_prefix 为总结行前缀 (不可总结的消息为 None)
+SESSION, MSGID, USER, CONTENT, TYPE, TIMESTAMP, TRIGGERED, LINE_PREFIX = range(8)
+
+
+def summarizable(record) -> bool:
+    """记录是否参与总结 (与 SQLite 中 is_summarizable 列的判定一致)"""
+    return bool(is_summarizable(type_code(record[TYPE]), record[CONTENT]))
+
+
+class MessageStore:
+    """
+    聊天记录存储接口。
+
+    所有实现都以 (会话, msgid) 去重，重复写入时替换旧记录；读取只返回可总结的消息
+    (文本、非空、不以 # 开头)，按 (timestamp, msgid) 从新到旧排列。
+    """
+
+    name = "base"
+
+    def append(self, records):
+        """批量写入记录元组，在一个事务内提交"""
+        raise NotImplementedError
+
+    def range_scan(self, session_id, start_timestamp=0, end_timestamp=None, limit=None):
+        """产出 start_timestamp < timestamp <= end_timestamp 的可总结记录 (新到旧)，limit 为 None 时不限条数"""
+        raise NotImplementedError
+
+    def count_scan(self, session_id, count):
+        """产出最新的 count 条可总结记录 (新到旧)"""
+        return self.range_scan(session_id, 0, None, count)
+
+    def aggregate(self, session_id, start_timestamp=0, end_timestamp=None, bucket_seconds=3600):
+        """
+        按 (时间桶, 用户) 统计窗口内的可总结消息，返回 [(桶起始时间戳, 用户, 消息数, 首条时间戳, 末条时间戳), ...]，
+        按桶和用户排序。
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {"backend": self.name}
+
+    def close(self):
+        """释放连接等资源"""
@@ -0,0 +1,178 @@
+"""
+存储后端的一致性检查与基准测试：所有后端对同一组合成消息必须给出相同的结果，
+再分别测量写入吞吐、按条数 / 时间窗口的扫描延迟和聚合延迟。
+
+在插件目录下运行 (使用临时目录，不影响 chat.db)：
+
+    python -m storage.backends.conformance --backends sqlite memory duckdb --messages 100000
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from ..connection import ConnectionManager
+from ..compression import ContentCodec
+from ..partition import SingleFileLayout
+from .base import MSGID, TIMESTAMP
+from .memory import MemoryMessageStore
+from .sqlite import SQLiteMessageStore
+
+
+def _format_prefix(user, timestamp):
+    return f"[{timestamp}] {user}: "
+
+
+def _open_sqlite(directory, page_size):
+    store = SQLiteMessageStore(ConnectionManager(Path(directory) / "conformance.db"), SingleFileLayout(),
+                               ContentCodec(), _format_prefix, page_size=page_size)
+    store.initialize()
+    return store
+
+
+def _open_duckdb(directory, page_size):
+    from .duckdb import DuckDBMessageStore
+    return DuckDBMessageStore(Path(directory) / "conformance.duckdb", page_size=page_size)
+
+
+FACTORIES = {
+    "sqlite": _open_sqlite,
+    "memory": lambda directory, page_size: MemoryMessageStore(),
+    "duckdb": _open_duckdb,
+}
+
+
+def _record(session, msgid, user, content, timestamp, msg_type="TEXT"):
+    prefix = _format_prefix(user, timestamp) if msg_type == "TEXT" and content.strip() and not content.strip().startswith("#") else None
+    return (session, msgid, user, content, msg_type, timestamp, 0, prefix)
+
+
+def synthetic_records(messages, sessions=4, seed=7, start=1700000000):
+    """合成消息：约 30% 为 # 指令、空白或非文本消息，时间戳有重复，便于检查 (timestamp, msgid) 排序"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(messages):
+        roll = rng.random()
+        msg_type = "TEXT"
+        if roll < 0.15:
+            content = f"#指令 {i}"
+        elif roll < 0.2:
+            content = "  "
+        elif roll < 0.3:
+            content, msg_type = "[图片]", "IMAGE"
+        else:
+            content = f"第 {i} 条消息 {rng.choice(['你好', '数据库', '周末去哪', '总结一下'])}"
+        records.append(_record(f"session{i % sessions}@chatroom", i + 1, f"user{rng.randrange(20)}", content,
+                               start + i // 2, msg_type))
+    return records
+
+
+def check_store(store):
+    """检查单个后端的语义，失败时抛出 AssertionError"""
+    base = 1700000000
+    store.append([
+        _record("a", 1, "u1", "第一条", base + 1),
+        _record("a", 2, "u2", "#指令", base + 2),
+        _record("a", 3, "u1", "   ", base + 3),
+        _record("a", 4, "u2", "[图片]", base + 4, "IMAGE"),
+        _record("a", 5, "u2", "第二条", base + 5),
+        _record("a", 6, "u1", "同一秒 A", base + 6),
+        _record("a", 7, "u2", "同一秒 B", base + 6),
+        _record("b", 8, "u3", "另一个会话", base + 6),
+    ])
+    # 相同 msgid 重复写入时替换旧记录
+    store.append([_record("a", 1, "u1", "第一条 (编辑后)", base + 1)])
+
+    rows = list(store.range_scan("a"))
+    assert [row[MSGID] for row in rows] == [7, 6, 5, 1], rows
+    assert rows[-1][3] == "第一条 (编辑后)", rows[-1]
+    assert rows[0][7] == _format_prefix("u2", base + 6), rows[0]
+    assert [row[MSGID] for row in store.count_scan("a", 2)] == [7, 6]
+    assert [row[MSGID] for row in store.count_scan("a", 10)] == [7, 6, 5, 1]
+    assert [row[MSGID] for row in store.range_scan("a", base + 1, base + 5)] == [5]
+    assert [row[MSGID] for row in store.range_scan("a", base, base + 6, 3)] == [7, 6, 5]
+    assert list(store.range_scan("missing")) == []
+
+    # 重新写入为不可总结的内容后不再出现在扫描结果中
+    store.append([_record("a", 5, "u2", "#改成指令", base + 5)])
+    assert [row[MSGID] for row in store.range_scan("a")] == [7, 6, 1]
+
+    bucket = base // 3600 * 3600
+    assert store.aggregate("a", 0, None, 3600) == [(bucket, "u1", 2, base + 1, base + 6),
+                                                   (bucket, "u2", 1, base + 6, base + 6)], store.aggregate("a")
+    assert store.aggregate("a", base + 1, base + 6, 60) == [(base // 60 * 60, "u1", 1, base + 6, base + 6),
+                                                           (base // 60 * 60, "u2", 1, base + 6, base + 6)]
+    assert store.aggregate("a", base + 6) == []
+
+
+def check_equivalent(stores, records):
+    """同一组消息写入所有后端后，扫描和聚合的结果必须一致"""
+    sessions = sorted({record[0] for record in records})
+    start, end = records[0][TIMESTAMP], records[-1][TIMESTAMP]
+    middle = (start + end) // 2
+    reference, *others = stores
+    for session in sessions:
+        for query in (lambda store: list(store.count_scan(session, 100)),
+                      lambda store: list(store.range_scan(session, middle)),
+                      lambda store: list(store.range_scan(session, start, middle)),
+                      lambda store: store.aggregate(session, 0, None, 600),
+                      lambda store: store.aggregate(session, start + 1234, None, 3600),
+                      lambda store: store.aggregate(session, start + 1234, middle + 77, 3600)):
+            expected = [tuple(row) for row in query(reference)]
+            for store in others:
+                actual = [tuple(row) for row in query(store)]
+                assert actual == expected, f"{store.name} differs from {reference.name} for {session}"
+
+
+def _timed(func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def run(backends, messages=50000, batch_size=200, repeat=10, page_size=500):
+    records = synthetic_records(messages)
+    session = records[0][0]
+    window_start = records[-1][TIMESTAMP] - 3600
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = []
+        for name in backends:
+            directory = Path(tmp) / f"check-{name}"
+            directory.mkdir()
+            semantic = FACTORIES[name](directory, page_size)
+            try:
+                check_store(semantic)
+            finally:
+                semantic.close()
+            print(f"{name}: conformance checks passed")
+
+        print(f"messages={messages} batch_size={batch_size} repeat={repeat}")
+        print(f"{'backend':<10}{'ingest rows/s':>15}{'count=500 ms':>14}{'window=1h ms':>14}{'aggregate ms':>14}")
+        for name in backends:
+            directory = Path(tmp) / name
+            directory.mkdir()
+            store = FACTORIES[name](directory, page_size)
+            stores.append(store)
+            _, ingest_ms = _timed(lambda: [store.append(records[i:i + batch_size])
+                                           for i in range(0, len(records), batch_size)])
+            _, count_ms = _timed(lambda: list(store.count_scan(session, 500)), repeat)
+            _, window_ms = _timed(lambda: list(store.range_scan(session, window_start)), repeat)
+            _, aggregate_ms = _timed(lambda: store.aggregate(session, 0, None, 3600), repeat)
+            print(f"{name:<10}{messages / ingest_ms * 1000:>15.0f}{count_ms:>14.2f}{window_ms:>14.2f}{aggregate_ms:>14.2f}")
+        check_equivalent(stores, records)
+        print("all backends returned identical results")
+        for store in stores:
+            store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark message store backends")
+    parser.add_argument("--backends", nargs="+", default=["sqlite", "memory"], choices=sorted(FACTORIES))
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+    run(args.backends, args.messages, args.batch_size, args.repeat, args.page_size)
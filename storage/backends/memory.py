@@ -0,0 +1,57 @@
+import threading
+from bisect import bisect_right, insort
+
+from .base import MessageStore, summarizable, MSGID, USER, TIMESTAMP
+
+_MAX_KEY = 2 ** 63 - 1
+
+
+class MemoryMessageStore(MessageStore):
+    """
+    纯内存实现，进程退出后数据丢失，用于测试与基准对比。
+
+    每个会话维护一个按 (timestamp, msgid) 排序的可总结记录列表和 msgid 索引。
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.rows = 0
+
+    def append(self, records):
+        with self._lock:
+            for record in records:
+                keys, by_msgid = self._sessions.setdefault(record[0], ([], {}))
+                previous = by_msgid.pop(record[MSGID], None)
+                if previous is not None:
+                    del keys[bisect_right(keys, (previous[TIMESTAMP], previous[MSGID])) - 1]
+                    self.rows -= 1
+                if not summarizable(record):
+                    continue
+                by_msgid[record[MSGID]] = record
+                insort(keys, (record[TIMESTAMP], record[MSGID]))
+                self.rows += 1
+
+    def range_scan(self, session_id, start_timestamp=0, end_timestamp=None, limit=None):
+        with self._lock:
+            keys, by_msgid = self._sessions.get(session_id, ([], {}))
+            upper = bisect_right(keys, (end_timestamp if end_timestamp is not None else _MAX_KEY, _MAX_KEY))
+            lower = bisect_right(keys, (start_timestamp, _MAX_KEY))
+            if limit is not None:
+                lower = max(lower, upper - limit)
+            # 在锁内复制窗口，迭代期间的写入不影响结果
+            window = [by_msgid[msgid] for _, msgid in keys[lower:upper]]
+        yield from reversed(window)
+
+    def aggregate(self, session_id, start_timestamp=0, end_timestamp=None, bucket_seconds=3600):
+        buckets = {}
+        for record in self.range_scan(session_id, start_timestamp, end_timestamp):
+            key = (record[TIMESTAMP] // bucket_seconds * bucket_seconds, record[USER])
+            count, first, last = buckets.get(key, (0, record[TIMESTAMP], record[TIMESTAMP]))
+            buckets[key] = (count + 1, min(first, record[TIMESTAMP]), max(last, record[TIMESTAMP]))
+        return [(bucket, user) + values for (bucket, user), values in sorted(buckets.items())]
+
+    def stats(self):
+        return {"backend": self.name, "sessions": len(self._sessions), "rows": self.rows}
@@ -0,0 +1,250 @@
+import heapq
+import itertools
+import time
+
+from .. import schema
+from ..activity import ActivityRollup, ACTIVITY_TABLE, BUCKET_SECONDS, bucket_of
+from ..compression import create_compression_tables
+from ..log import logger
+from ..query import iter_summarizable
+from .base import MessageStore
+
+_MAX_KEY = 2 ** 63 - 1
+
+
+class SQLiteMessageStore(MessageStore):
+    """
+    基于 SQLite 的实现 (默认)：v2 表结构、可选的按月分片、内容压缩，以及旧版 chat_records 表的后台迁移。
+
+    Args:
+        db: ConnectionManager。
+        layout: SingleFileLayout 或 MonthlyPartitions。
+        codec: ContentCodec，读取时解压内容。
+        format_prefix: 生成总结行前缀的函数 (user, timestamp) -> str。
+        format_version: 当前前缀格式版本，存储的版本不同时读取时重新生成并回写。
+        page_size: 读路径每页的行数。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db, layout, codec, format_prefix, format_version=1, page_size=500):
+        self.db = db
+        self.layout = layout
+        self.codec = codec
+        self.format_prefix = format_prefix
+        self.format_version = format_version
+        self.page_size = page_size
+        self.session_names = schema.NameCache("sessions")
+        self.user_names = schema.NameCache("users")
+        self.legacy_migration = None
+        self.rollup = ActivityRollup(layout)
+        # 在写入事务内调用 hook(conn, rows)，rows 为 (session_id, timestamp, msgid, user_id, type_code, is_triggered, content)
+        self.write_hooks = []
+
+    def initialize(self, migration_batch_size=2000, migration_pause_sec=0.05):
+        """创建 / 升级表结构 (包括已有分片)，存在旧版 chat_records 表时准备后台迁移 (由调用方启动)"""
+        with self.db.write() as conn:
+            schema.create_schema(conn, decode=self.codec.decode)
+            create_compression_tables(conn)
+            self.rollup.create_tables(conn)
+            if schema.table_exists(conn, schema.LEGACY_TABLE):
+                # 检查 is_triggered 列是否存在 (保持原有逻辑，迁移时需要读取该列)
+                c = conn.execute(f"PRAGMA table_info({schema.LEGACY_TABLE});")
+                column_exists = any(column[1] == 'is_triggered' for column in c.fetchall())
+                if not column_exists:
+                    conn.execute(f"ALTER TABLE {schema.LEGACY_TABLE} ADD COLUMN is_triggered INTEGER DEFAULT 0;")
+                    logger.info("[ChatSummary] Added is_triggered column to chat_records table.")
+
+        # 已有分片同样升级到当前表结构
+        self.layout.upgrade_shards(lambda conn, db_name: schema.create_message_table(conn, db_name, self.codec.decode))
+        self._build_rollup()
+        self.legacy_migration = schema.LegacyMigration(
+            self.db,
+            self.session_names,
+            self.user_names,
+            batch_size=migration_batch_size,
+            pause_sec=migration_pause_sec,
+        )
+        self.legacy_migration.insert_hooks.append(self.rollup.refresh_rows)
+
+    def _build_rollup(self):
+        """首次启用活跃度汇总时从已有消息建立；中途中断时下次启动清空重建"""
+        with self.db.write() as conn:
+            if not self.rollup.needs_build(conn):
+                return
+            start = time.perf_counter()
+            conn.execute(f"DELETE FROM {ACTIVITY_TABLE}")
+            self.rollup.build_table(conn, "main.chat_messages")
+        self.layout.upgrade_shards(lambda conn, db_name: self.rollup.build_table(conn, f"{db_name}.chat_messages"))
+        with self.db.write() as conn:
+            self.rollup.mark_built(conn)
+        logger.info(f"[ChatSummary Activity] Built activity rollup from existing messages in {time.perf_counter() - start:.1f}s.")
+
+    def append(self, records):
+        # 分片布局下一个事务附加的分片有上限，跨越多个月的导入批次拆成多个事务
+        for batch in self.layout.write_batches(records, lambda record: record[5]):
+            self._append(batch)
+
+    def _append(self, records):
+        try:
+            with self.db.write() as conn:
+                # 分片模式下需要在事务开始前附加目标分片
+                tables = self.layout.write_tables(conn, {record[5] for record in records})
+                rows_by_table = {}
+                for session_id, msg_id, user, content, msg_type, timestamp, is_triggered, line_prefix in records:
+                    rows_by_table.setdefault(tables[timestamp], []).append(((
+                        self.session_names.intern(conn, session_id),
+                        timestamp,
+                        msg_id,
+                        self.user_names.intern(conn, user),
+                        schema.type_code(msg_type),
+                        is_triggered,
+                        content,
+                    ), line_prefix))
+                for table, entries in rows_by_table.items():
+                    rows = [row for row, _ in entries]
+                    existing = self.rollup.existing_keys(conn, table, rows)
+                    # 写入时计算 is_summarizable，读路径据此在 SQL 中过滤
+                    conn.executemany(f"""INSERT OR REPLACE INTO {table}
+                                         (session_id, timestamp, msgid, user_id, type_code, is_triggered, content,
+                                          is_summarizable, line_prefix, fmt_version)
+                                         VALUES (?,?,?,?,?,?,?,?,?,?)""",
+                                     [row + (schema.is_summarizable(row[4], row[6]), line_prefix,
+                                             self.format_version if line_prefix is not None else 0)
+                                      for row, line_prefix in entries])
+                    self.rollup.add_rows(conn, rows, existing)
+                    for hook in self.write_hooks:
+                        hook(conn, rows)
+        except Exception:
+            # 事务回滚后缓存中可能残留未提交的 id
+            self.session_names.invalidate()
+            self.user_names.invalidate()
+            raise
+
+    def range_scan(self, session_id, start_timestamp=0, end_timestamp=None, limit=None):
+        """
+        记录按页从数据库读取，内存中只保留当前一页。调用方提前停止迭代时，未读取的分片不会被附加。
+        存储的 line_prefix 版本过旧 (或缺失) 时按当前格式重新生成，迭代结束后回写数据库。
+        """
+        conn = self.db.reader()
+        target_type = "TEXT"
+        sid = self.session_names.lookup(conn, str(session_id))
+        legacy_cursor = self.legacy_migration.pending_cursor(conn) if self.legacy_migration is not None else None
+        if legacy_cursor is not None:
+            # 迁移进行中：先附加所有需要的分片，再在同一个读事务中查询，保证新旧两张表看到的是同一快照
+            # (迁移只在升级后首次启动时进行，此时的分片都是升级之后创建的，数量远低于 max_attached)
+            tables = self.layout.message_tables(conn, start_timestamp, end_timestamp) if sid is not None else []
+            conn.execute("BEGIN")
+        else:
+            # 从新到旧逐个分片查询，取够 limit 条即停止，不附加更旧的分片
+            tables = self.layout.iter_message_tables(conn, start_timestamp, end_timestamp) if sid is not None else []
+        stale = []
+        try:
+            decode = self.codec.decode
+            version = self.format_version
+
+            def current_records():
+                for msgid, user, content, ts, trig, line_prefix, fmt_version in \
+                        iter_summarizable(conn, tables, sid, start_timestamp, limit, self.page_size,
+                                          end_timestamp=end_timestamp):
+                    if fmt_version != version or line_prefix is None:
+                        line_prefix = self.format_prefix(user, ts)
+                        stale.append((line_prefix, version, sid, ts, msgid))
+                    yield session_id, msgid, user, decode(conn, sid, content), target_type, ts, trig, line_prefix
+
+            records = current_records()
+            if legacy_cursor is not None:
+                legacy_cursor = self.legacy_migration.pending_cursor(conn)
+            if legacy_cursor is not None:
+                # 迁移尚未完成：按时间归并旧表中还未迁移的记录 (旧表没有 is_summarizable 列，逐条判断)
+                text_code = schema.type_code(target_type)
+                end = end_timestamp if end_timestamp is not None else _MAX_KEY
+                legacy_records = (record + (self.format_prefix(record[2], record[5]),) for record in conn.execute(
+                                      f"""SELECT sessionid, msgid, user, content, type, timestamp, is_triggered
+                                          FROM {schema.LEGACY_TABLE}
+                                          WHERE sessionid=? AND timestamp>? AND timestamp<=? AND type=? AND rowid>?
+                                          ORDER BY timestamp DESC""",
+                                      (session_id, start_timestamp, end, target_type, legacy_cursor))
+                                  if schema.is_summarizable(text_code, record[3]))
+                records = heapq.merge(records, legacy_records, key=lambda record: record[5], reverse=True)
+                seen = set()
+                count = 0
+                for record in records:
+                    if record[1] in seen:
+                        continue
+                    seen.add(record[1])
+                    yield record
+                    count += 1
+                    if limit is not None and count >= limit:
+                        break
+            else:
+                yield from records
+        finally:
+            if conn.in_transaction:
+                conn.execute("COMMIT")
+            if stale:
+                self._store_line_prefixes(stale)
+
+    def _store_line_prefixes(self, stale):
+        """回写读取时重新生成的总结行前缀 [(line_prefix, fmt_version, session_id, timestamp, msgid), ...]"""
+        try:
+            # 按月分组，每组一个事务：先附加覆盖该月的表 (分片布局下主库中可能还有启用分片前的旧消息)，再更新
+            for _, group in itertools.groupby(stale, key=lambda row: time.strftime("%Y%m", time.localtime(row[3]))):
+                rows = list(group)
+                with self.db.write() as conn:
+                    timestamps = [row[3] for row in rows]
+                    # 同一个月内最多一个分片，可以在写事务开始前一次附加
+                    for table in self.layout.message_tables(conn, min(timestamps), max(timestamps)):
+                        conn.executemany(f"""UPDATE {table} SET line_prefix=?, fmt_version=?
+                                             WHERE session_id=? AND timestamp=? AND msgid=?""", rows)
+            logger.debug(f"[ChatSummary] Regenerated {len(stale)} stored line prefixes (format v{self.format_version}).")
+        except Exception as e:
+            # 回写失败不影响本次总结，下次读取时会再次生成
+            logger.warning(f"[ChatSummary] Failed to store regenerated line prefixes: {e}")
+
+    def aggregate(self, session_id, start_timestamp=0, end_timestamp=None, bucket_seconds=3600):
+        """按小时统计时，完整落在窗口内的桶直接读取 chat_activity 汇总表，只有两端不完整的桶从消息表计数"""
+        conn = self.db.reader()
+        sid = self.session_names.lookup(conn, str(session_id))
+        if sid is None:
+            return []
+        end = end_timestamp if end_timestamp is not None else _MAX_KEY
+        if bucket_seconds != BUCKET_SECONDS:
+            return self._aggregate_messages(conn, sid, start_timestamp, end, bucket_seconds)
+        # 窗口为 (start, end]：第一个完整桶从 start 之后的整点开始，最后一个完整桶在 end 之前结束
+        first_full = -(-(start_timestamp + 1) // BUCKET_SECONDS) * BUCKET_SECONDS
+        last_full = bucket_of(end + 1) - BUCKET_SECONDS if end < _MAX_KEY else bucket_of(end)
+        if first_full > last_full:
+            return self._aggregate_messages(conn, sid, start_timestamp, end, bucket_seconds)
+        rows = self.rollup.buckets(conn, sid, first_full, last_full)
+        if first_full - 1 > start_timestamp:
+            rows += self._aggregate_messages(conn, sid, start_timestamp, first_full - 1, bucket_seconds)
+        if end < _MAX_KEY and last_full + BUCKET_SECONDS - 1 < end:
+            rows += self._aggregate_messages(conn, sid, last_full + BUCKET_SECONDS - 1, end, bucket_seconds)
+        return sorted(rows, key=lambda row: (row[0], row[1] or ""))
+
+    def _aggregate_messages(self, conn, sid, start_timestamp, end, bucket_seconds):
+        """直接从消息表统计 (start_timestamp, end] 内的可总结消息"""
+        buckets = {}
+        # 分组在各表内由 SQLite 完成 (走 is_summarizable 部分索引)，这里只合并跨分片的同一桶
+        for table in self.layout.iter_message_tables(conn, start_timestamp, end if end < _MAX_KEY else None):
+            for bucket, user, count, first, last in conn.execute(
+                    f"""SELECT (m.timestamp / ?) * ?, u.name, COUNT(*), MIN(m.timestamp), MAX(m.timestamp)
+                        FROM {table} AS m INDEXED BY {schema.SUMMARIZABLE_INDEX}
+                        LEFT JOIN users u ON u.id = m.user_id
+                        WHERE m.session_id = ? AND m.is_summarizable = 1 AND m.timestamp > ? AND m.timestamp <= ?
+                        GROUP BY 1, m.user_id""",
+                    (bucket_seconds, bucket_seconds, sid, start_timestamp, end)):
+                previous = buckets.get((bucket, user))
+                if previous is not None:
+                    count, first, last = count + previous[0], min(first, previous[1]), max(last, previous[2])
+                buckets[(bucket, user)] = (count, first, last)
+        return sorted(((bucket, user) + values for (bucket, user), values in buckets.items()),
+                      key=lambda row: (row[0], row[1] or ""))
+
+    def stats(self):
+        return {"backend": self.name, "layout": self.layout.stats(), "codec": self.codec.stats(),
+                "activity": self.rollup.stats()}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,110 @@
+"""
+读路径基准测试：对比旧的 "多取 1.5 倍再在 Python 中过滤" 与基于 is_summarizable 部分索引的精确读取。
+
+在插件目录下运行 (使用临时数据库，不影响 chat.db)：
+
+    python -m storage.benchmark --messages 200000 --ineligible 0.4
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from . import schema
+from .connection import ConnectionManager
+from .query import iter_summarizable
+
+
+def _populate(db, messages, ineligible_ratio, sessions=4, seed=7):
+    """写入合成消息，ineligible_ratio 比例的消息为 # 开头的指令或空白内容"""
+    rng = random.Random(seed)
+    session_names = schema.NameCache("sessions")
+    user_names = schema.NameCache("users")
+    now = int(time.time())
+    with db.write() as conn:
+        schema.create_schema(conn)
+        sids = [session_names.intern(conn, f"session{i}@chatroom") for i in range(sessions)]
+        uids = [user_names.intern(conn, f"user{i}") for i in range(50)]
+        rows = []
+        for i in range(messages):
+            roll = rng.random()
+            if roll < ineligible_ratio * 0.8:
+                content = f"#指令 {i}"
+            elif roll < ineligible_ratio:
+                content = "   "
+            else:
+                content = f"第 {i} 条消息：今天讨论的话题是数据库读路径的优化"
+            code = schema.TYPE_CODES["TEXT"]
+            # 所有会话合计每秒 1 条消息
+            rows.append((sids[i % sessions], now - messages + i, i + 1, rng.choice(uids), code, 0, content,
+                         schema.is_summarizable(code, content)))
+        conn.executemany("""INSERT INTO chat_messages
+                            (session_id, timestamp, msgid, user_id, type_code, is_triggered, content, is_summarizable)
+                            VALUES (?,?,?,?,?,?,?,?)""", rows)
+    return sids[0], now
+
+
+def _legacy_by_count(conn, sid, msg_count):
+    """旧实现：按类型取 msg_count * 1.5 + 10 行，在 Python 中过滤"""
+    limit = int(msg_count * 1.5) + 10
+    rows = conn.execute("""SELECT m.msgid, u.name, m.content, m.timestamp, m.is_triggered
+                           FROM chat_messages m LEFT JOIN users u ON u.id = m.user_id
+                           WHERE m.session_id=? AND m.timestamp>? AND m.type_code=?
+                           ORDER BY m.timestamp DESC LIMIT ?""",
+                        (sid, 0, schema.TYPE_CODES["TEXT"], limit)).fetchall()
+    kept = [row for row in rows if row[2] and not row[2].strip().startswith("#")][:msg_count]
+    return len(rows), len(kept)
+
+
+def _legacy_by_time(conn, sid, start_timestamp):
+    """旧实现：时间窗口最多取 1000 行，在 Python 中过滤"""
+    rows = conn.execute("""SELECT m.msgid, u.name, m.content, m.timestamp, m.is_triggered
+                           FROM chat_messages m LEFT JOIN users u ON u.id = m.user_id
+                           WHERE m.session_id=? AND m.timestamp>? AND m.type_code=?
+                           ORDER BY m.timestamp DESC LIMIT ?""",
+                        (sid, start_timestamp, schema.TYPE_CODES["TEXT"], 1000)).fetchall()
+    kept = [row for row in rows if row[2] and not row[2].strip().startswith("#")]
+    return len(rows), len(kept)
+
+
+def _timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def run(messages=100000, ineligible_ratio=0.4, repeat=20, page_size=500):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ConnectionManager(Path(tmp) / "bench.db")
+        sid, now = _populate(db, messages, ineligible_ratio)
+        with db.write() as conn:
+            conn.execute("ANALYZE")
+        conn = db.reader()
+        tables = ["main.chat_messages"]
+
+        print(f"messages={messages} ineligible_ratio={ineligible_ratio} page_size={page_size}")
+        print(f"{'query':<16}{'path':<10}{'rows read':>10}{'eligible':>10}{'ms':>10}")
+        for count in (100, 500, 1000):
+            (read, kept), legacy_ms = _timed(lambda: _legacy_by_count(conn, sid, count), repeat)
+            print(f"{'count=' + str(count):<16}{'legacy':<10}{read:>10}{kept:>10}{legacy_ms:>10.2f}")
+            rows, new_ms = _timed(lambda: list(iter_summarizable(conn, tables, sid, 0, count, page_size)), repeat)
+            print(f"{'':<16}{'indexed':<10}{len(rows):>10}{len(rows):>10}{new_ms:>10.2f}")
+        for hours in (1, 24):
+            start_timestamp = now - hours * 3600
+            (read, kept), legacy_ms = _timed(lambda: _legacy_by_time(conn, sid, start_timestamp), repeat)
+            print(f"{'window=' + str(hours) + 'h':<16}{'legacy':<10}{read:>10}{kept:>10}{legacy_ms:>10.2f}")
+            rows, new_ms = _timed(lambda: list(iter_summarizable(conn, tables, sid, start_timestamp, None, page_size)), repeat)
+            print(f"{'':<16}{'indexed':<10}{len(rows):>10}{len(rows):>10}{new_ms:>10.2f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark summarizable-row reads")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--ineligible", type=float, default=0.4, help="fraction of # commands / blank messages")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+    run(args.messages, args.ineligible, args.repeat, args.page_size)
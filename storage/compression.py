@@ -0,0 +1,287 @@
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .log import logger
+from .search import search_index_bytes
+
+# 压缩内容以 BLOB 存储，头部为 1 字节编码 + 4 字节字典 id；未压缩内容保持 TEXT
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+_HEADER = struct.Struct(">BI")
+
+
+def create_compression_tables(conn):
+    """创建字典表与压缩进度表"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS content_dicts
+                    (session_id INTEGER NOT NULL,
+                     dict_id INTEGER NOT NULL,
+                     codec INTEGER NOT NULL,
+                     data BLOB NOT NULL,
+                     created_at INTEGER NOT NULL,
+                     PRIMARY KEY (session_id, dict_id)) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS compression_progress
+                    (session_id INTEGER PRIMARY KEY,
+                     upto_ts INTEGER NOT NULL DEFAULT 0,
+                     upto_msgid INTEGER NOT NULL DEFAULT 0,
+                     rows INTEGER NOT NULL DEFAULT 0,
+                     raw_bytes INTEGER NOT NULL DEFAULT 0,
+                     stored_bytes INTEGER NOT NULL DEFAULT 0)""")
+
+
+def build_dictionary(samples, dict_size):
+    """
+    由会话的历史消息构造共享字典。
+
+    zlib 的预置字典越靠后的内容匹配代价越低，因此按出现频率升序拼接，
+    最常见的消息/短语放在末尾，超过 dict_size 时保留尾部。
+    """
+    counts = Counter(sample for sample in samples if sample)
+    ordered = sorted(counts.items(), key=lambda item: (item[1], len(item[0])))
+    data = "\n".join(text for text, _ in ordered).encode("utf-8")
+    return data[-dict_size:]
+
+
+class ContentCodec:
+    """
+    消息内容的压缩/解压，按 (会话, 字典 id) 缓存字典。
+
+    decode() 对 TEXT 值原样返回，因此读路径可以无差别地调用。
+    """
+
+    def __init__(self, codec="zlib", level=6):
+        if codec == "zstd" and zstandard is None:
+            logger.warning("[ChatSummary Compression] zstandard is not installed, falling back to zlib.")
+            codec = "zlib"
+        self.codec = CODEC_NAMES.get(codec, CODEC_ZLIB)
+        self.level = int(level)
+        self._dicts = {}
+        self._lock = threading.Lock()
+        self.decoded_rows = 0
+        self.decode_seconds = 0.0
+
+    def load_dictionary(self, conn, session_id, dict_id):
+        """读取 (并缓存) 指定字典，返回 (codec, data)"""
+        key = (session_id, dict_id)
+        cached = self._dicts.get(key)
+        if cached is not None:
+            return cached
+        row = conn.execute("SELECT codec, data FROM content_dicts WHERE session_id=? AND dict_id=?",
+                           (session_id, dict_id)).fetchone()
+        if row is None:
+            raise ValueError(f"compression dictionary {dict_id} for session {session_id} not found")
+        with self._lock:
+            self._dicts[key] = (row[0], bytes(row[1]))
+        return self._dicts[key]
+
+    def current_dictionary(self, conn, session_id):
+        """返回会话最新的字典 id，尚未建立时返回 None"""
+        row = conn.execute("SELECT MAX(dict_id) FROM content_dicts WHERE session_id=?", (session_id,)).fetchone()
+        return row[0] if row and row[0] is not None else None
+
+    def encode(self, conn, session_id, dict_id, text):
+        """压缩一条内容，返回带头部的 BLOB"""
+        codec, zdict = self.load_dictionary(conn, session_id, dict_id)
+        raw = text.encode("utf-8")
+        if codec == CODEC_ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=zstandard.ZstdCompressionDict(zdict))
+            body = compressor.compress(raw)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=zdict)
+            body = compressor.compress(raw) + compressor.flush()
+        return _HEADER.pack(codec, dict_id) + body
+
+    def decode(self, conn, session_id, value):
+        """解压一条内容；非 BLOB 值原样返回"""
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        start = time.perf_counter()
+        value = bytes(value)
+        codec, dict_id = _HEADER.unpack_from(value)
+        _, zdict = self.load_dictionary(conn, session_id, dict_id)
+        body = value[_HEADER.size:]
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise ImportError("zstandard is required to read zstd-compressed chat content")
+            raw = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(zdict)).decompress(body)
+        else:
+            decompressor = zlib.decompressobj(-15, zdict=zdict)
+            raw = decompressor.decompress(body) + decompressor.flush()
+        self.decoded_rows += 1
+        self.decode_seconds += time.perf_counter() - start
+        return raw.decode("utf-8")
+
+    def stats(self):
+        """返回解压次数与平均耗时"""
+        avg_us = (self.decode_seconds / self.decoded_rows * 1e6) if self.decoded_rows else 0.0
+        return {"decoded_rows": self.decoded_rows, "avg_decode_us": round(avg_us, 1)}
+
+
+class ColdContentCompressor:
+    """
+    后台压缩任务：把早于 min_age_hours 的消息内容压缩为带共享字典的 BLOB。
+
+    每个会话按 (timestamp, msgid) 水位推进，每批一个短写事务；单次运行受 max_run_seconds 限制，
+    未完成的部分留到下一次调度继续。
+    """
+
+    def __init__(self, db, codec: ContentCodec, layout, min_age_hours=72, batch_size=500, dict_size_kb=32,
+                 min_length=24, dict_samples=2000, max_run_seconds=30):
+        self.db = db
+        self.codec = codec
+        self.layout = layout
+        self.min_age = int(min_age_hours) * 3600
+        self.batch_size = int(batch_size)
+        self.dict_size = int(dict_size_kb) * 1024
+        self.min_length = int(min_length)
+        self.dict_samples = int(dict_samples)
+        self.max_run_seconds = max_run_seconds
+
+    def run(self, now=None):
+        """执行一轮压缩，返回本轮统计"""
+        now = int(now or time.time())
+        cutoff = now - self.min_age
+        deadline = time.monotonic() + self.max_run_seconds
+        run_stats = {"rows": 0, "raw_bytes": 0, "stored_bytes": 0, "sessions": 0, "seconds": 0.0}
+        start = time.perf_counter()
+
+        session_ids = [row[0] for row in self.db.reader().execute("SELECT id FROM sessions ORDER BY id").fetchall()]
+        for session_id in session_ids:
+            if time.monotonic() > deadline:
+                logger.info("[ChatSummary Compression] Time budget exhausted, remaining sessions deferred to next run.")
+                break
+            if self._compress_session(session_id, cutoff, deadline, run_stats):
+                run_stats["sessions"] += 1
+
+        run_stats["seconds"] = round(time.perf_counter() - start, 2)
+        logger.info(f"[ChatSummary Compression] Run finished: {run_stats}")
+        return run_stats
+
+    def _compress_session(self, session_id, cutoff, deadline, run_stats) -> bool:
+        with self.db.write() as conn:
+            dict_id = self.codec.current_dictionary(conn, session_id)
+            if dict_id is None:
+                dict_id = self._create_dictionary(conn, session_id, cutoff)
+                if dict_id is None:
+                    return False
+
+        touched = False
+        while time.monotonic() <= deadline:
+            with self.db.write() as conn:
+                row = conn.execute("SELECT upto_ts, upto_msgid FROM compression_progress WHERE session_id=?", (session_id,)).fetchone()
+                upto_ts, upto_msgid = row if row else (0, 0)
+                # 从旧到新依次检查各消息表，水位之前的行已处理过
+                rows, table = [], None
+                for table in self.layout.iter_message_tables(conn, upto_ts, cutoff, oldest_first=True):
+                    rows = conn.execute(f"""SELECT timestamp, msgid, content FROM {table}
+                                            WHERE session_id=? AND (timestamp, msgid) > (?, ?) AND timestamp<?
+                                              AND typeof(content)='text'
+                                            ORDER BY timestamp, msgid LIMIT ?""",
+                                        (session_id, upto_ts, upto_msgid, cutoff, self.batch_size)).fetchall()
+                    if rows:
+                        break
+                if not rows:
+                    return touched
+
+                updates = []
+                raw_bytes = stored_bytes = 0
+                for timestamp, msgid, content in rows:
+                    raw = len(content.encode("utf-8"))
+                    if raw < self.min_length:
+                        continue
+                    blob = self.codec.encode(conn, session_id, dict_id, content)
+                    if len(blob) >= raw:
+                        continue
+                    updates.append((blob, session_id, timestamp, msgid))
+                    raw_bytes += raw
+                    stored_bytes += len(blob)
+                conn.executemany(f"UPDATE {table} SET content=? WHERE session_id=? AND timestamp=? AND msgid=?", updates)
+
+                # 过短或不可压缩的行保持 TEXT，水位越过它们，避免下次重复检查
+                conn.execute("""INSERT INTO compression_progress (session_id, upto_ts, upto_msgid, rows, raw_bytes, stored_bytes)
+                                VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(session_id) DO UPDATE SET
+                                    upto_ts=excluded.upto_ts,
+                                    upto_msgid=excluded.upto_msgid,
+                                    rows=rows+excluded.rows,
+                                    raw_bytes=raw_bytes+excluded.raw_bytes,
+                                    stored_bytes=stored_bytes+excluded.stored_bytes""",
+                             (session_id, rows[-1][0], rows[-1][1], len(updates), raw_bytes, stored_bytes))
+            touched = True
+            run_stats["rows"] += len(updates)
+            run_stats["raw_bytes"] += raw_bytes
+            run_stats["stored_bytes"] += stored_bytes
+        return touched
+
+    def _create_dictionary(self, conn, session_id, cutoff):
+        """用会话的冷数据样本训练字典，样本不足时返回 None"""
+        samples = []
+        for table in self.layout.iter_message_tables(conn, 0, cutoff):
+            samples.extend(row[0] for row in conn.execute(f"""SELECT content FROM {table}
+                                                              WHERE session_id=? AND timestamp<? AND typeof(content)='text'
+                                                              ORDER BY timestamp DESC LIMIT ?""",
+                                                           (session_id, cutoff, self.dict_samples - len(samples))).fetchall())
+            if len(samples) >= self.dict_samples:
+                break
+        if len(samples) < 50:
+            return None
+        codec = self.codec.codec
+        data = None
+        if codec == CODEC_ZSTD:
+            try:
+                trained = zstandard.train_dictionary(self.dict_size, [s.encode("utf-8") for s in samples])
+                data = trained.as_bytes()
+            except Exception as e:
+                logger.debug(f"[ChatSummary Compression] zstd dictionary training failed for session {session_id}, using raw content dictionary: {e}")
+        if data is None:
+            data = build_dictionary(samples, self.dict_size)
+        conn.execute("INSERT INTO content_dicts (session_id, dict_id, codec, data, created_at) VALUES (?, 1, ?, ?, ?)",
+                     (session_id, codec, data, int(time.time())))
+        logger.info(f"[ChatSummary Compression] Built {len(data)} byte dictionary for session {session_id} from {len(samples)} samples.")
+        return 1
+
+    def report(self, sample_rows=200):
+        """
+        汇总压缩效果：累计节省的空间，以及抽样测量的解压耗时 (读延迟影响)。
+
+        同时给出全文索引的数据量：索引为保存原文的普通 FTS5 表时 (SQLite 3.43 以下)，
+        被压缩的文本在索引中仍是明文，实际节省的空间要扣除这一部分。
+        """
+        conn = self.db.reader()
+        rows, raw_bytes, stored_bytes = conn.execute(
+            "SELECT COALESCE(SUM(rows),0), COALESCE(SUM(raw_bytes),0), COALESCE(SUM(stored_bytes),0) FROM compression_progress").fetchone()
+        dict_bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(data)),0) FROM content_dicts").fetchone()[0]
+        index_bytes = search_index_bytes(conn)
+
+        samples = []
+        for table in self.layout.iter_message_tables(conn):
+            samples.extend(conn.execute(f"""SELECT session_id, content FROM {table}
+                                           WHERE typeof(content)='blob' LIMIT ?""", (sample_rows - len(samples),)).fetchall())
+            if len(samples) >= sample_rows:
+                break
+        decode_us = 0.0
+        if samples:
+            start = time.perf_counter()
+            for session_id, content in samples:
+                self.codec.decode(conn, session_id, content)
+            decode_us = (time.perf_counter() - start) / len(samples) * 1e6
+
+        saved = raw_bytes - stored_bytes - dict_bytes
+        return {
+            "compressed_rows": rows,
+            "raw_bytes": raw_bytes,
+            "stored_bytes": stored_bytes,
+            "dictionary_bytes": dict_bytes,
+            "saved_bytes": saved,
+            "ratio": round(stored_bytes / raw_bytes, 3) if raw_bytes else None,
+            "search_index_bytes": index_bytes,
+            "avg_decode_us_per_row": round(decode_us, 1),
+        }
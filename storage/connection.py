@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from .log import logger
+
+
+class ConnectionManager:
+    """
+    SQLite 连接管理：一个带锁的写连接 + 每个线程独立的只读连接。
+
+    开启 WAL 后读写互不阻塞：写线程持有唯一的写连接，总结等读操作在各自线程的
+    读连接上执行，长时间的扫描不会卡住消息写入，反之亦然。
+
+    Args:
+        db_path: 数据库文件路径。
+        journal_mode: 日志模式，默认 WAL。
+        busy_timeout_ms: 遇到锁时的最长等待时间 (毫秒)。
+        mmap_size: 内存映射读取的字节数上限，0 表示关闭。
+        cache_size_kb: 每个连接的页缓存大小 (KiB)。
+        synchronous: 同步级别，WAL 下 NORMAL 即可保证不损坏数据库。
+        auto_vacuum: 新建数据库的 auto_vacuum 模式，INCREMENTAL 便于删除后分段归还空间
+            (对已有表的数据库不生效，需手动 VACUUM 一次才能转换)。
+        read_only: 只读打开 (导出等工具使用)：不创建写连接、不修改任何 PRAGMA，
+            所有连接以 mode=ro 打开，write() 抛出异常。
+    """
+
+    def __init__(self, db_path, journal_mode="WAL", busy_timeout_ms=5000, mmap_size=268435456,
+                 cache_size_kb=16384, synchronous="NORMAL", auto_vacuum="INCREMENTAL", read_only=False):
+        self.db_path = str(db_path)
+        self.read_only = read_only
+        self.journal_mode = journal_mode
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.mmap_size = int(mmap_size)
+        self.cache_size_kb = int(cache_size_kb)
+        self.synchronous = synchronous
+
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._generation = 0
+        self._closed = False
+
+        self._writer = None
+        if read_only:
+            logger.info(f"[ChatSummary DB] Opened {self.db_path} read-only.")
+            return
+        self._writer = self._open()
+        # auto_vacuum 必须在切换 WAL 和建表之前设置
+        self._writer.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+        mode = self._writer.execute(f"PRAGMA journal_mode={self.journal_mode}").fetchone()[0]
+        if str(mode).lower() != str(self.journal_mode).lower():
+            logger.warning(f"[ChatSummary DB] Requested journal_mode={self.journal_mode}, got {mode}.")
+        self._writer.execute(f"PRAGMA synchronous={self.synchronous}")
+        logger.info(f"[ChatSummary DB] Opened {self.db_path} (journal_mode={mode}, busy_timeout={self.busy_timeout_ms}ms, "
+                    f"mmap_size={self.mmap_size}, cache_size={self.cache_size_kb}KiB)")
+
+    def _open(self, read_only=False):
+        """打开一个新连接并应用通用 PRAGMA"""
+        if self.read_only:
+            conn = sqlite3.connect(Path(self.db_path).resolve().as_uri() + "?mode=ro", uri=True,
+                                   timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_size_kb}")
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        if read_only:
+            # 读连接使用自动提交模式，每条查询都读取最新的已提交快照
+            conn.isolation_level = None
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    @contextmanager
+    def write(self):
+        """获取写连接；块内的所有语句在同一事务中提交，异常时回滚"""
+        with self._write_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("ConnectionManager is closed")
+            if self.read_only:
+                raise sqlite3.OperationalError(f"{self.db_path} is opened read-only")
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    def reader(self):
+        """返回当前线程专用的只读连接 (首次调用或连接被作废后创建)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.generation != self._generation:
+            # 连接已被 invalidate_readers() 作废 (例如分片被归档)，关闭后重新打开
+            self._discard_reader(conn)
+            conn = None
+        if conn is None:
+            if self._closed:
+                raise sqlite3.ProgrammingError("ConnectionManager is closed")
+            conn = self._open(read_only=True)
+            self._local.conn = conn
+            self._local.generation = self._generation
+            with self._readers_lock:
+                self._readers.append(conn)
+            logger.debug(f"[ChatSummary DB] Opened read connection for thread {threading.current_thread().name}.")
+        return conn
+
+    def invalidate_readers(self):
+        """作废所有线程的读连接，各线程下次调用 reader() 时重新打开 (会丢弃其附加的数据库)"""
+        self._generation += 1
+
+    def _discard_reader(self, conn):
+        with self._readers_lock:
+            if conn in self._readers:
+                self._readers.remove(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """关闭写连接和所有读连接"""
+        with self._write_lock:
+            if self._closed:
+                return
+            self._closed = True
+            with self._readers_lock:
+                readers, self._readers = self._readers, []
+            for conn in readers:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            if self._writer is None:
+                return
+            try:
+                self._writer.execute("PRAGMA optimize")
+                self._writer.close()
+            except sqlite3.Error as e:
+                logger.warning(f"[ChatSummary DB] Error closing writer connection: {e}")
+        logger.info(f"[ChatSummary DB] Closed {self.db_path}.")
@@ -0,0 +1,124 @@
+import threading
+from bisect import insort
+from collections import OrderedDict, deque
+
+
+class _SessionTail:
+    """
+    单个会话的最近消息，按 (timestamp, msgid) 从旧到新排列。
+
+    start 为缓存完整覆盖的起点键 (timestamp, msgid)：不早于它的有效消息都在缓存中。它只在最旧的
+    消息被挤出时后移，不会因为迟到的旧消息而前移 (更早的消息可能在进程启动或会话被淘汰前就已写入)。
+    """
+
+    __slots__ = ("entries", "msgids", "start")
+
+    def __init__(self, max_messages, start):
+        self.entries = deque(maxlen=max_messages)
+        self.msgids = set()
+        self.start = start
+
+    def coverage(self):
+        """缓存完整覆盖的起点：晚于该时间戳的有效消息都在缓存中"""
+        return self.start[0]
+
+
+class HotTailCache:
+    """
+    按会话缓存最近接收的可总结消息 (已格式化的行)。
+
+    每个会话一个有界的环形缓冲，会话数量按 LRU 淘汰。缓冲从进程启动后该会话的第一条消息开始
+    连续记录，因此可以精确回答 "最近 N 条" 和 "某时间点之后" 的查询；超出缓冲范围时返回 None，
+    由调用方回退到 SQLite。
+
+    Args:
+        max_messages: 每个会话缓存的最大消息数。
+        max_sessions: 同时缓存的会话数上限。
+    """
+
+    def __init__(self, max_messages=500, max_sessions=200):
+        self.max_messages = max(1, int(max_messages))
+        self.max_sessions = max(1, int(max_sessions))
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_sessions = 0
+
+    def add(self, session_id, msgid, timestamp, line):
+        """记录一条已写入的可总结消息；重复的 msgid 会替换旧行，早于覆盖起点的迟到消息被忽略"""
+        with self._lock:
+            tail = self._sessions.get(session_id)
+            if tail is None:
+                tail = self._sessions[session_id] = _SessionTail(self.max_messages, (timestamp, msgid))
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted_sessions += 1
+            else:
+                self._sessions.move_to_end(session_id)
+            entry = (timestamp, msgid, line)
+            if msgid in tail.msgids:
+                tail.entries = deque((item for item in tail.entries if item[1] != msgid), maxlen=self.max_messages)
+                tail.msgids.discard(msgid)
+            if entry[:2] < tail.start:
+                # 覆盖范围之外的消息，由 SQLite 回答包含它的查询
+                return
+            if len(tail.entries) == tail.entries.maxlen:
+                tail.msgids.discard(tail.entries[0][1])
+            if not tail.entries or tail.entries[-1][:2] <= entry[:2]:
+                tail.entries.append(entry)
+            else:
+                # 乱序到达的消息按时间插入
+                entries = list(tail.entries)
+                insort(entries, entry)
+                tail.entries = deque(entries[-self.max_messages:], maxlen=self.max_messages)
+                tail.msgids = {item[1] for item in tail.entries}
+            tail.msgids.add(msgid)
+            if tail.entries[0][:2] > tail.start:
+                # 最旧的消息被挤出，覆盖起点随之后移
+                tail.start = tail.entries[0][:2]
+
+    def tail(self, session_id, count):
+        """返回最近 count 条消息的行 (新到旧)，缓存不足 count 条时返回 None"""
+        with self._lock:
+            tail = self._sessions.get(session_id)
+            if tail is None or len(tail.entries) < count:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [tail.entries[-index][2] for index in range(1, count + 1)]
+
+    def window(self, session_id, start_timestamp):
+        """返回晚于 start_timestamp 的全部消息的行 (新到旧)，缓存未完整覆盖该窗口时返回 None"""
+        with self._lock:
+            tail = self._sessions.get(session_id)
+            if tail is None or start_timestamp < tail.coverage():
+                self.misses += 1
+                return None
+            self.hits += 1
+            lines = []
+            for timestamp, _, line in reversed(tail.entries):
+                if timestamp <= start_timestamp:
+                    break
+                lines.append(line)
+            return lines
+
+    def invalidate(self, session_id=None):
+        """丢弃指定会话 (或全部会话) 的缓存，例如消息被保留策略删除或分片被归档后"""
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "messages": sum(len(tail.entries) for tail in self._sessions.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evicted_sessions": self.evicted_sessions,
+            }
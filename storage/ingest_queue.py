@@ -0,0 +1,186 @@
+import queue
+import threading
+import time
+
+from .log import logger
+
+
+class IngestQueue:
+    """
+    有界的写入队列：消息线程只负责入队，由单独的写线程把多行合并到一个事务中提交。
+
+    Args:
+        write_batch: 在写线程中调用的函数，参数为记录列表，需在一次事务内完成写入。
+        max_size: 队列最大长度，队列满时 put 会阻塞 (背压)。
+        batch_size: 单个事务最多包含的行数，达到后立即提交。
+        flush_interval_ms: 最早入队的行最多等待多久就会被提交。
+        put_timeout: 单次等待队列空位的超时 (秒)，超时后记录背压并继续等待，不丢消息。
+    """
+
+    def __init__(self, write_batch, max_size=10000, batch_size=200, flush_interval_ms=200, put_timeout=1.0):
+        self._write_batch = write_batch
+        self._queue = queue.Queue(maxsize=max(1, int(max_size)))
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(1, int(flush_interval_ms)) / 1000.0
+        self.put_timeout = put_timeout
+
+        self._seq_lock = threading.Lock()
+        self._committed = threading.Condition()
+        self._enqueued_seq = 0
+        self._committed_seq = 0
+        self._flush_requested = threading.Event()
+        self._stopping = threading.Event()
+
+        self._stats = {
+            "enqueued": 0,
+            "committed": 0,
+            "failed": 0,
+            "batches": 0,
+            "max_depth": 0,
+            "backpressure_events": 0,
+            "backpressure_wait_ms": 0.0,
+            "last_batch_size": 0,
+            "last_batch_ms": 0.0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="ChatSummaryIngest", daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        """将一条记录放入队列；队列满时阻塞等待写线程腾出空间"""
+        if self._stopping.is_set() or not self._thread.is_alive():
+            # 写线程不可用时直接同步写入，保证不丢消息
+            logger.warning("[ChatSummary Ingest] Writer thread unavailable, writing record synchronously.")
+            with self._seq_lock:
+                self._enqueued_seq += 1
+                seq = self._enqueued_seq
+                self._stats["enqueued"] += 1
+            self._commit([(seq, record)])
+            return
+
+        waited_start = None
+        while True:
+            # 序号分配与入队放在同一把锁内，保证队列中的序号严格递增
+            with self._seq_lock:
+                try:
+                    self._queue.put_nowait((self._enqueued_seq + 1, record))
+                    self._enqueued_seq += 1
+                    self._stats["enqueued"] += 1
+                    depth = self._queue.qsize()
+                    if depth > self._stats["max_depth"]:
+                        self._stats["max_depth"] = depth
+                    break
+                except queue.Full:
+                    pass
+            if waited_start is None:
+                waited_start = time.perf_counter()
+                self._stats["backpressure_events"] += 1
+                logger.debug(f"[ChatSummary Ingest] Queue full ({self._queue.maxsize}), applying backpressure.")
+            self._flush_requested.set()
+            time.sleep(min(0.05, self.put_timeout))
+
+        if waited_start is not None:
+            self._stats["backpressure_wait_ms"] += (time.perf_counter() - waited_start) * 1000
+
+    def flush(self, timeout=10.0):
+        """等待调用之前入队的所有记录提交完成，返回是否在超时前完成"""
+        with self._seq_lock:
+            target = self._enqueued_seq
+        if self._committed_seq >= target:
+            return True
+        self._flush_requested.set()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._committed:
+            while self._committed_seq < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    logger.warning(f"[ChatSummary Ingest] Flush timed out, {target - self._committed_seq} records still pending.")
+                    return False
+                self._committed.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def close(self, timeout=30.0):
+        """停止写线程，并把队列中剩余的记录全部写入"""
+        if self._stopping.is_set():
+            return
+        self.flush(timeout)
+        self._stopping.set()
+        self._flush_requested.set()
+        self._thread.join(timeout)
+        # 写线程退出后若仍有残留 (例如 flush 超时)，在当前线程补写
+        leftovers = []
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftovers:
+            self._commit(leftovers)
+        logger.info(f"[ChatSummary Ingest] Closed. Stats: {self.stats()}")
+
+    def stats(self):
+        """返回队列深度与背压等计数器的快照"""
+        snapshot = dict(self._stats)
+        snapshot["depth"] = self._queue.qsize()
+        snapshot["pending"] = self._enqueued_seq - self._committed_seq
+        snapshot["backpressure_wait_ms"] = round(snapshot["backpressure_wait_ms"], 1)
+        snapshot["last_batch_ms"] = round(snapshot["last_batch_ms"], 2)
+        return snapshot
+
+    def _run(self):
+        """写线程主循环：按行数或等待时间触发批量提交"""
+        logger.info("[ChatSummary Ingest] Writer thread started.")
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_requested.clear()
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self._flush_requested.is_set() or self._stopping.is_set():
+                    # 有读请求在等待，尽快把已入队的记录全部取出
+                    try:
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    except queue.Empty:
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if self._queue.empty():
+                self._flush_requested.clear()
+            self._commit(batch)
+        logger.info("[ChatSummary Ingest] Writer thread stopped.")
+
+    def _commit(self, batch):
+        """提交一批记录；整批失败时逐行重试，隔离出问题的记录"""
+        records = [record for _, record in batch]
+        start = time.perf_counter()
+        try:
+            self._write_batch(records)
+            self._stats["committed"] += len(records)
+        except Exception as e:
+            logger.error(f"[ChatSummary Ingest] Batch write of {len(records)} records failed: {e}. Retrying row by row.")
+            for record in records:
+                try:
+                    self._write_batch([record])
+                    self._stats["committed"] += 1
+                except Exception as row_error:
+                    self._stats["failed"] += 1
+                    logger.error(f"[ChatSummary Ingest] Dropping record after write failure: {row_error} | record={str(record)[:120]}")
+
+        self._stats["batches"] += 1
+        self._stats["last_batch_size"] = len(records)
+        self._stats["last_batch_ms"] = (time.perf_counter() - start) * 1000
+
+        with self._committed:
+            self._committed_seq = max(self._committed_seq, batch[-1][0])
+            self._committed.notify_all()
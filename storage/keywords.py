@@ -0,0 +1,249 @@
+import math
+import re
+from collections import Counter
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+from .log import logger
+from .schema import get_meta, set_meta, is_summarizable
+
+DF_TABLE = "keyword_df"
+DOCS_TABLE = "keyword_docs"
+
+_URL = re.compile(r"https?://\S+|www\.\S+")
+_CJK_RUN = re.compile(r"[一-鿿]+")
+_LATIN_WORD = re.compile(r"[A-Za-z][A-Za-z0-9+#.\-]*[A-Za-z0-9+#]")
+
+# 含有这些字的 n-gram 基本都跨越了词边界或是语气词
+_PARTICLES = set("的了吗呢啊吧呀哦嗯么哈啦嘛哇呗噢诶")
+STOPWORDS = {
+    "我们", "你们", "他们", "她们", "它们", "这个", "那个", "这些", "那些", "什么", "怎么", "为什么", "一个", "一下",
+    "没有", "就是", "还是", "可以", "不是", "现在", "知道", "觉得", "这样", "那样", "因为", "所以", "但是", "然后",
+    "如果", "已经", "自己", "时候", "大家", "有点", "感觉", "应该", "真的", "其实", "不过", "而且", "或者", "一样",
+    "这么", "那么", "怎么样", "是不是", "有没有", "不知道", "一起", "今天", "明天", "昨天", "还有", "只是", "比较",
+    "the", "and", "for", "you", "are", "this", "that", "with", "not", "but", "have", "was", "just",
+}
+
+# 词云默认配色，与图片总结 Prompt 中的分类配色一致
+DEFAULT_PALETTE = ["#00b4d8", "#f25f4c", "#7209b7", "#ff8906", "#3da9fc", "#2cb67d"]
+
+
+class NgramSegmenter:
+    """
+    不依赖第三方库的分词：中文按 2-3 字滑动窗口切分，英文按单词切分。
+
+    重叠的片段 (如 "数据库" 产生的 "数据"、"据库") 在 extract_keywords 中按得分去重。
+    """
+
+    name = "ngram"
+
+    def __init__(self, sizes=(2, 3)):
+        self.sizes = sizes
+
+    def cut(self, text):
+        text = _URL.sub(" ", text)
+        terms = [word.lower() for word in _LATIN_WORD.findall(text)]
+        for run in _CJK_RUN.findall(text):
+            for size in self.sizes:
+                for i in range(len(run) - size + 1):
+                    gram = run[i:i + size]
+                    if not _PARTICLES.intersection(gram):
+                        terms.append(gram)
+        return [term for term in terms if term not in STOPWORDS]
+
+
+class JiebaSegmenter:
+    """基于 jieba 的中文分词，需要安装 jieba (pip install jieba)"""
+
+    name = "jieba"
+
+    def __init__(self):
+        if jieba is None:
+            raise ImportError("jieba 未安装，无法使用 jieba 分词。请运行 'pip install jieba'。")
+
+    def cut(self, text):
+        text = _URL.sub(" ", text)
+        terms = []
+        for word in jieba.lcut(text):
+            word = word.strip().lower()
+            if len(word) < 2 or word in STOPWORDS or _PARTICLES.intersection(word):
+                continue
+            if _CJK_RUN.fullmatch(word) or _LATIN_WORD.fullmatch(word):
+                terms.append(word)
+        return terms
+
+
+SEGMENTERS = {"ngram": NgramSegmenter, "jieba": JiebaSegmenter}
+
+
+def make_segmenter(name="auto"):
+    """auto 时安装了 jieba 则使用 jieba，否则使用 n-gram 分词"""
+    if name == "auto":
+        name = "jieba" if jieba is not None else "ngram"
+    if name not in SEGMENTERS:
+        logger.warning(f"[ChatSummary Keywords] Unknown segmenter '{name}', falling back to ngram.")
+        name = "ngram"
+    return SEGMENTERS[name]()
+
+
+class KeywordIndex:
+    """
+    按会话维护词的文档频率 (一条可总结消息为一篇文档)，用于计算 IDF。
+
+    keyword_df 保存 (会话, 词) 的文档数，keyword_docs 保存会话的文档总数，写入和迁移时在同一事务内
+    增量累加；保留策略删除消息时不回退计数，IDF 只反映词在该会话中的相对稀有程度，少量偏差不影响排序。
+    更换分词器后词表不再可比，启动时清空重新累计。
+
+    n-gram 分词每条消息会产生几十个词，词表随消息数持续增长：会话每新增 PRUNE_EVERY 篇文档检查一次词数，
+    超过 max_terms 时把该会话的 df 和文档总数一起减半 (比值不变，IDF 基本不受影响)，df 归零的词
+    (主要是只出现过一次的片段) 被删除，直到词数不超过上限。每个会话的行数因此不超过 max_terms 加上
+    PRUNE_EVERY 篇文档带来的新词，旧消息的计数也随之衰减。
+
+    Args:
+        segmenter: 分词器实例 (NgramSegmenter / JiebaSegmenter 或任何提供 name 与 cut(text) 的对象)。
+        max_terms: 每个会话最多保留的词数，0 表示不限制。
+    """
+
+    SEGMENTER_KEY = "keyword_segmenter"
+    PRUNE_EVERY = 1000
+
+    def __init__(self, segmenter, max_terms=20000):
+        self.segmenter = segmenter
+        self.max_terms = max(0, int(max_terms or 0))
+        self.indexed_docs = 0
+        self.pruned_terms = 0
+        self.decays = 0
+        # 各会话自上次检查词数以来新增的文档数
+        self._unchecked = Counter()
+
+    def create_tables(self, conn):
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {DF_TABLE}
+                        (session_id INTEGER NOT NULL,
+                         term TEXT NOT NULL,
+                         df INTEGER NOT NULL,
+                         PRIMARY KEY (session_id, term)) WITHOUT ROWID""")
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {DOCS_TABLE}
+                        (session_id INTEGER PRIMARY KEY,
+                         docs INTEGER NOT NULL)""")
+        existing = get_meta(conn, self.SEGMENTER_KEY)
+        if existing != self.segmenter.name:
+            if existing is not None:
+                logger.info(f"[ChatSummary Keywords] Segmenter changed from '{existing}' to '{self.segmenter.name}', "
+                            f"resetting document frequencies.")
+            conn.execute(f"DELETE FROM {DF_TABLE}")
+            conn.execute(f"DELETE FROM {DOCS_TABLE}")
+            set_meta(conn, self.SEGMENTER_KEY, self.segmenter.name)
+
+    def index_rows(self, conn, rows):
+        """写入 / 迁移钩子：rows 为 (session_id, timestamp, msgid, user_id, type_code, is_triggered, content)"""
+        df, docs = Counter(), Counter()
+        for session_id, _, _, _, code, _, content in rows:
+            if not is_summarizable(code, content):
+                continue
+            docs[session_id] += 1
+            for term in set(self.segmenter.cut(content)):
+                df[(session_id, term)] += 1
+        if not docs:
+            return
+        conn.executemany(f"""INSERT INTO {DF_TABLE} (session_id, term, df) VALUES (?,?,?)
+                             ON CONFLICT (session_id, term) DO UPDATE SET df = df + excluded.df""",
+                         [(session_id, term, count) for (session_id, term), count in df.items()])
+        conn.executemany(f"""INSERT INTO {DOCS_TABLE} (session_id, docs) VALUES (?,?)
+                             ON CONFLICT (session_id) DO UPDATE SET docs = docs + excluded.docs""",
+                         list(docs.items()))
+        self.indexed_docs += sum(docs.values())
+        if not self.max_terms:
+            return
+        self._unchecked.update(docs)
+        for session_id, count in list(self._unchecked.items()):
+            if count >= self.PRUNE_EVERY:
+                del self._unchecked[session_id]
+                self.prune(conn, session_id)
+
+    def prune(self, conn, session_id):
+        """会话词数超过 max_terms 时反复将计数减半并删除归零的词，须在写事务内调用"""
+        terms = conn.execute(f"SELECT COUNT(*) FROM {DF_TABLE} WHERE session_id = ?", (session_id,)).fetchone()[0]
+        before = terms
+        while terms > self.max_terms:
+            conn.execute(f"UPDATE {DF_TABLE} SET df = df / 2 WHERE session_id = ?", (session_id,))
+            conn.execute(f"DELETE FROM {DF_TABLE} WHERE session_id = ? AND df = 0", (session_id,))
+            conn.execute(f"UPDATE {DOCS_TABLE} SET docs = MAX(1, docs / 2) WHERE session_id = ?", (session_id,))
+            terms = conn.execute(f"SELECT COUNT(*) FROM {DF_TABLE} WHERE session_id = ?", (session_id,)).fetchone()[0]
+            self.decays += 1
+        if terms < before:
+            self.pruned_terms += before - terms
+            logger.debug(f"[ChatSummary Keywords] Pruned session {session_id} vocabulary from {before} to {terms} terms.")
+
+    def frequencies(self, conn, session_id, terms):
+        """返回 (会话文档总数, {词: 文档数})，未出现过的词不在字典中"""
+        row = conn.execute(f"SELECT docs FROM {DOCS_TABLE} WHERE session_id = ?", (session_id,)).fetchone()
+        result = {}
+        terms = list(terms)
+        for i in range(0, len(terms), 500):
+            chunk = terms[i:i + 500]
+            result.update(conn.execute(f"""SELECT term, df FROM {DF_TABLE}
+                                           WHERE session_id = ? AND term IN ({",".join("?" * len(chunk))})""",
+                                       [session_id] + chunk).fetchall())
+        return (row[0] if row else 0), result
+
+    def stats(self):
+        return {"segmenter": self.segmenter.name, "indexed_docs": self.indexed_docs, "max_terms": self.max_terms,
+                "decays": self.decays, "pruned_terms": self.pruned_terms}
+
+
+def extract_keywords(segmenter, texts, top_n=10, frequencies=None, exclude=()):
+    """
+    对一组消息做 TF-IDF，返回 [(词, 出现次数, 得分), ...]，按得分从高到低。
+
+    frequencies 为 (文档总数, {词: 文档数}) 或返回它的函数 (参数为候选词集合)；为 None 时以这组消息本身计算 IDF。
+    n-gram 分词时只保留至少出现两次的词，并跳过与更高分的词互为子串的片段。
+    """
+    tf, df = Counter(), Counter()
+    documents = 0
+    for text in texts:
+        terms = segmenter.cut(text)
+        if not terms:
+            continue
+        documents += 1
+        tf.update(terms)
+        df.update(set(terms))
+    excluded = {word.lower() for word in exclude if word}
+    min_count = 2 if segmenter.name == "ngram" else 1
+    candidates = {term for term, count in tf.items() if count >= min_count and term not in excluded}
+    if not candidates:
+        return []
+    if frequencies is None:
+        total, known = documents, df
+    else:
+        total, known = frequencies(candidates) if callable(frequencies) else frequencies
+        total = max(total, documents)
+    scored = sorted(((term, tf[term], tf[term] * (math.log((total + 1) / (known.get(term, 0) + 1)) + 1))
+                     for term in candidates), key=lambda item: (-item[2], -len(item[0]), item[0]))
+    keywords = []
+    for term, count, score in scored:
+        if segmenter.name == "ngram" and any(term in chosen or chosen in term for chosen, _, _ in keywords):
+            continue
+        keywords.append((term, count, score))
+        if len(keywords) >= top_n:
+            break
+    return keywords
+
+
+def word_cloud(keywords, min_size=28, max_size=42, palette=None):
+    """把关键词转换为图片模板 .cloud-word 使用的 [{"word", "size", "color"}, ...]，字号按得分线性分级"""
+    if not keywords:
+        return []
+    palette = palette or DEFAULT_PALETTE
+    high, low = keywords[0][2], keywords[-1][2]
+    cloud = []
+    for rank, (term, _, score) in enumerate(keywords):
+        ratio = (score - low) / (high - low) if high > low else 1.0
+        cloud.append({
+            "word": term,
+            "size": int(round(min_size + (max_size - min_size) * ratio)),
+            "color": palette[rank % len(palette)],
+        })
+    return cloud
@@ -0,0 +1,251 @@
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from .log import logger
+from .schema import create_message_table
+
+MAIN_TABLE = "main.chat_messages"
+
+# SQLite 编译期的默认附加数据库上限 (SQLITE_MAX_ATTACHED)
+_SQLITE_MAX_ATTACHED = 10
+
+
+class SingleFileLayout:
+    """默认存储布局：所有消息都在主库的 chat_messages 表中"""
+
+    partitioned = False
+
+    def message_tables(self, conn, start_ts=0, end_ts=None):
+        """返回覆盖时间窗口的消息表列表 (新到旧)"""
+        return [MAIN_TABLE]
+
+    def iter_message_tables(self, conn, start_ts=0, end_ts=None, oldest_first=False):
+        """逐个产出消息表 (默认新到旧)"""
+        yield MAIN_TABLE
+
+    def write_batches(self, records, timestamp_of):
+        """把一批记录拆成可以各自在一个事务内写入的子批次 (单文件布局不需要拆分)"""
+        yield records
+
+    def write_tables(self, conn, timestamps):
+        """为一批时间戳准备写入目标表，返回 {时间戳: 表名}；须在写事务开始前调用"""
+        return {ts: MAIN_TABLE for ts in timestamps}
+
+    def upgrade_shards(self, upgrade):
+        """对每个分片执行表结构升级 (单文件布局没有分片)"""
+
+    def stats(self):
+        return {"partitioned": False}
+
+
+class MonthlyPartitions:
+    """
+    按月分片的存储布局：每个月一个独立的 SQLite 文件，按需 ATTACH 到连接上。
+
+    sessions / users 等小表仍在主库；主库中已有的 chat_messages (启用分片前的数据)
+    作为最旧的一段参与查询。时间范围查询只附加与窗口重叠的分片，按条数的查询从新到旧逐个分片扫描。
+    一个连接上同时附加的分片不超过 max_attached：覆盖整个历史的操作 (保留策略、压缩、统计) 须使用
+    iter_message_tables 逐个附加，message_tables 在窗口重叠的分片过多时抛出 ValueError。
+    归档时先作废所有读连接，再从写连接上分离并移动文件，读写都不需要停机。
+
+    Args:
+        db: ConnectionManager 实例。
+        shard_dir: 分片文件目录。
+        archive_dir: 归档目录，归档后的分片不再参与查询。
+        max_attached: 单个连接同时附加的分片上限 (SQLite 默认最多附加 10 个数据库)。
+    """
+
+    partitioned = True
+    _KEY_PATTERN = re.compile(r"^chat_(\d{6})\.db$")
+
+    def __init__(self, db, shard_dir, archive_dir, max_attached=6):
+        self.db = db
+        self.shard_dir = Path(shard_dir)
+        self.archive_dir = Path(archive_dir)
+        self.max_attached = min(_SQLITE_MAX_ATTACHED, max(2, int(max_attached)))
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._shards = set(self._scan_shards())
+        self.attach_count = 0
+        self.detach_count = 0
+        logger.info(f"[ChatSummary Partition] Monthly partitioning enabled, {len(self._shards)} shards in {self.shard_dir}.")
+
+    @staticmethod
+    def shard_key(timestamp) -> str:
+        """时间戳所属的分片键 (本地时间的 YYYYMM)"""
+        return datetime.fromtimestamp(int(timestamp)).strftime("%Y%m")
+
+    @staticmethod
+    def alias(key) -> str:
+        return f"shard_{key}"
+
+    def shard_path(self, key) -> Path:
+        return self.shard_dir / f"chat_{key}.db"
+
+    def shards(self):
+        """当前在线 (未归档) 的分片键，新到旧"""
+        with self._lock:
+            return sorted(self._shards, reverse=True)
+
+    def _scan_shards(self):
+        for path in self.shard_dir.glob("chat_*.db"):
+            match = self._KEY_PATTERN.match(path.name)
+            if match:
+                yield match.group(1)
+
+    def _window_keys(self, start_ts, end_ts):
+        start_key = self.shard_key(start_ts) if start_ts else "000000"
+        end_key = self.shard_key(end_ts) if end_ts else "999999"
+        return [key for key in self.shards() if start_key <= key <= end_key]
+
+    def message_tables(self, conn, start_ts=0, end_ts=None):
+        """
+        同时附加与 [start_ts, end_ts] 重叠的分片，返回表名列表 (新到旧，主库旧数据在最后)。
+
+        只用于需要在同一个读事务中查询多张表的场景 (迁移期间的快照读)；重叠的分片超过 max_attached 时抛出 ValueError。
+        """
+        keys = self._window_keys(start_ts, end_ts)
+        self._attach(conn, keys)
+        return [f"{self.alias(key)}.chat_messages" for key in keys] + [MAIN_TABLE]
+
+    def iter_message_tables(self, conn, start_ts=0, end_ts=None, oldest_first=False):
+        """
+        逐个附加并产出消息表，默认新到旧 (适合按条数扫描时尽早停止)，oldest_first 时主库旧数据在最前。
+
+        附加新分片时会分离已用过的分片，调用方须在取下一张表之前读完上一张表的结果，且不能处于写事务中。
+        """
+        keys = self._window_keys(start_ts, end_ts)
+        if oldest_first:
+            yield MAIN_TABLE
+            keys.reverse()
+        for key in keys:
+            self._attach(conn, [key])
+            yield f"{self.alias(key)}.chat_messages"
+        if not oldest_first:
+            yield MAIN_TABLE
+
+    def write_batches(self, records, timestamp_of):
+        """
+        把一批记录拆成子批次，每个子批次涉及的分片不超过 max_attached 个 (按月份从旧到新分组)。
+
+        实时消息的一批几乎总在同一个月内，只有导入跨越多个月的历史数据时才会拆分。
+        """
+        by_key = {}
+        for record in records:
+            by_key.setdefault(self.shard_key(timestamp_of(record)), []).append(record)
+        if len(by_key) <= self.max_attached:
+            yield records
+            return
+        keys = sorted(by_key)
+        for index in range(0, len(keys), self.max_attached):
+            yield [record for key in keys[index:index + self.max_attached] for record in by_key[key]]
+
+    def write_tables(self, conn, timestamps):
+        """为一批时间戳创建/附加所需分片，返回 {时间戳: 表名}；须在写事务开始前调用"""
+        keys = {ts: self.shard_key(ts) for ts in timestamps}
+        needed = sorted(set(keys.values()), reverse=True)
+        for key in needed:
+            if key not in self._shards:
+                self._create_shard(conn, key)
+        self._attach(conn, needed)
+        return {ts: f"{self.alias(key)}.chat_messages" for ts, key in keys.items()}
+
+    def _create_shard(self, conn, key):
+        self._attach(conn, [key])
+        conn.execute(f"PRAGMA {self.alias(key)}.auto_vacuum=INCREMENTAL")
+        conn.execute(f"PRAGMA {self.alias(key)}.journal_mode=WAL")
+        create_message_table(conn, self.alias(key))
+        conn.commit()
+        with self._lock:
+            self._shards.add(key)
+        logger.info(f"[ChatSummary Partition] Created shard {self.shard_path(key)}.")
+
+    def upgrade_shards(self, upgrade):
+        """逐个附加在线分片并执行 upgrade(conn, 分片别名)，每个分片一个事务"""
+        for key in self.shards():
+            with self.db.write() as conn:
+                self._attach(conn, [key])
+                upgrade(conn, self.alias(key))
+
+    def _attach(self, conn, keys):
+        """在连接上附加指定分片；超过上限时先分离不需要的旧分片，指定的分片本身超过上限时抛出 ValueError"""
+        if len(keys) > self.max_attached:
+            raise ValueError(f"{len(keys)} shards requested at once, more than max_attached={self.max_attached}; "
+                             f"use iter_message_tables to visit them one at a time")
+        attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+        missing = [key for key in keys if self.alias(key) not in attached]
+        if not missing:
+            return
+        shard_aliases = sorted(name for name in attached if name.startswith("shard_"))
+        keep = {self.alias(key) for key in keys}
+        overflow = len(shard_aliases) + len(missing) - self.max_attached
+        for name in shard_aliases:
+            if overflow <= 0:
+                break
+            if name not in keep:
+                conn.execute(f"DETACH DATABASE {name}")
+                self.detach_count += 1
+                overflow -= 1
+        for key in missing:
+            conn.execute(f"ATTACH DATABASE ? AS {self.alias(key)}", (str(self.shard_path(key)),))
+            self.attach_count += 1
+
+    def archive(self, key) -> Path | None:
+        """将分片从所有连接上分离并移动到归档目录，不允许归档当前月份"""
+        if key == self.shard_key(time.time()):
+            raise ValueError(f"cannot archive the current shard {key}")
+        source = self.shard_path(key)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        target = self.archive_dir / source.name
+        # 持有写锁期间从在线列表移除，避免写线程在移动文件前重新附加该分片
+        with self.db.write() as conn:
+            with self._lock:
+                if key not in self._shards:
+                    return None
+                self._shards.discard(key)
+            # 读连接会在下一次 reader() 时重新打开，不再附加该分片
+            self.db.invalidate_readers()
+            alias = self.alias(key)
+            attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+            if alias not in attached:
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (str(source),))
+            # 把 WAL 中的内容合并回主文件，归档出去的是一个完整的单文件
+            conn.execute(f"PRAGMA {alias}.wal_checkpoint(TRUNCATE)")
+            try:
+                conn.execute(f"PRAGMA {alias}.journal_mode=DELETE")
+            except sqlite3.OperationalError as e:
+                # 仍有读连接未释放该分片时无法切换日志模式，WAL 已清空，不影响归档文件的完整性
+                logger.debug(f"[ChatSummary Partition] Could not switch shard {key} out of WAL: {e}")
+            conn.execute(f"DETACH DATABASE {alias}")
+            self.detach_count += 1
+            shutil.move(str(source), str(target))
+        logger.info(f"[ChatSummary Partition] Archived shard {key} to {target}.")
+        return target
+
+    def archive_older_than(self, months) -> list:
+        """归档早于最近 months 个月的所有分片"""
+        now = datetime.now()
+        index = now.year * 12 + now.month - 1 - int(months)
+        cutoff_key = f"{index // 12:04d}{index % 12 + 1:02d}"
+        archived = []
+        for key in self.shards():
+            if key < cutoff_key:
+                try:
+                    if self.archive(key):
+                        archived.append(key)
+                except Exception as e:
+                    logger.error(f"[ChatSummary Partition] Failed to archive shard {key}: {e}", exc_info=True)
+        return archived
+
+    def stats(self):
+        return {
+            "partitioned": True,
+            "shards": len(self._shards),
+            "attach_count": self.attach_count,
+            "detach_count": self.detach_count,
+        }
@@ -0,0 +1,56 @@
+
+from .log import logger
+from .schema import SUMMARIZABLE_INDEX
+
+# 比任何时间戳 / msgid 都大的哨兵值，作为第一页的键集游标
+_MAX_KEY = 2 ** 63 - 1
+
+
+def iter_summarizable(conn, tables, session_id, start_timestamp=0, limit=None, page_size=500, fetch_size=100,
+                      end_timestamp=None):
+    """
+    从新到旧逐页读取会话中可总结的消息，
+    产出 (msgid, 用户名, content, timestamp, is_triggered, line_prefix, fmt_version)。
+
+    通过 is_summarizable 部分索引只读取符合条件的行；每页以上一页最后一条的
+    (timestamp, msgid) 为游标继续，limit 为 None 时读完整个时间窗口，不做截断。
+    content 为存储值，压缩内容需由调用方解压。
+
+    Args:
+        conn: 数据库连接 (分片须已附加，或 tables 为惰性附加的迭代器)。
+        tables: 消息表名，按新到旧排列。
+        session_id: 会话的整数 id。
+        start_timestamp: 只读取晚于该时间戳的消息。
+        limit: 最多读取的条数，None 表示不限制。
+        page_size: 每次查询 (一页) 的行数。
+        fetch_size: 每次 fetchmany 从游标取出的行数，内存中最多保留这么多行。
+        end_timestamp: 只读取不晚于该时间戳的消息，None 表示不限制。
+    """
+    remaining = limit
+    first_ts = _MAX_KEY if end_timestamp is None else end_timestamp
+    for table in tables:
+        cursor_ts, cursor_msgid = first_ts, _MAX_KEY
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            cursor = conn.execute(f"""SELECT m.msgid, u.name, m.content, m.timestamp, m.is_triggered, m.line_prefix, m.fmt_version
+                                      FROM {table} AS m INDEXED BY {SUMMARIZABLE_INDEX}
+                                      LEFT JOIN users u ON u.id = m.user_id
+                                      WHERE m.session_id = ? AND m.is_summarizable = 1 AND m.timestamp > ?
+                                        AND (m.timestamp, m.msgid) < (?, ?)
+                                      ORDER BY m.timestamp DESC, m.msgid DESC LIMIT ?""",
+                                  (session_id, start_timestamp, cursor_ts, cursor_msgid, size))
+            fetched, last = 0, None
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                fetched += len(rows)
+                last = rows[-1]
+                yield from rows
+            if remaining is not None:
+                remaining -= fetched
+            if fetched < size:
+                break
+            cursor_ts, cursor_msgid = last[3], last[0]
+        if remaining is not None and remaining <= 0:
+            return
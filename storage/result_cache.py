@@ -0,0 +1,123 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .connection import ConnectionManager
+
+RESULT_TABLE = "summary_results"
+
+
+def result_key(prompt, **params):
+    """(最终 Prompt, 模型, 请求参数) 的 SHA-256"""
+    digest = hashlib.sha256(prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    总结结果的两级缓存：进程内 LRU + SQLite 文件。
+
+    SQLite 层在重启后仍然有效，同一台机器上的多个 bot 进程把 path 指向同一个文件即可共享 (WAL 模式下并发读写)。
+    两级都按写入时间计算 TTL；内存层超过 max_entries 时淘汰最久未使用的条目，
+    文件层每写入 prune_interval 次清理一次过期条目和超出 max_persistent_entries 的最旧条目。
+
+    Args:
+        path: SQLite 文件路径，为 None 时只使用内存层。
+        ttl: 结果有效期 (秒)。
+        max_entries: 内存层条目上限。
+        max_persistent_entries: 文件层条目上限。
+        prune_interval: 文件层清理间隔 (写入次数)。
+    """
+
+    def __init__(self, path=None, ttl=3600, max_entries=128, max_persistent_entries=1000, prune_interval=50):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.max_persistent_entries = max(1, max_persistent_entries)
+        self.prune_interval = max(1, prune_interval)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.db = None
+        if path is not None:
+            self.db = ConnectionManager(path, mmap_size=0, cache_size_kb=2048)
+            with self.db.write() as conn:
+                conn.execute(f"""CREATE TABLE IF NOT EXISTS {RESULT_TABLE}
+                                (key TEXT PRIMARY KEY,
+                                 result TEXT NOT NULL,
+                                 created_at REAL NOT NULL,
+                                 expires_at REAL NOT NULL)""")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{RESULT_TABLE}_created ON {RESULT_TABLE} (created_at)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self._entries[key]
+        if self.db is not None:
+            row = self.db.reader().execute(f"SELECT result, expires_at FROM {RESULT_TABLE} WHERE key = ? AND expires_at > ?",
+                                           (key, now)).fetchone()
+            if row is not None:
+                with self._lock:
+                    self.persistent_hits += 1
+                    self._remember(key, row[1], row[0])
+                return row[0]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, result)
+            self.stores += 1
+            self._puts += 1
+            prune = self._puts % self.prune_interval == 0
+        if self.db is not None:
+            with self.db.write() as conn:
+                conn.execute(f"INSERT OR REPLACE INTO {RESULT_TABLE} (key, result, created_at, expires_at) VALUES (?,?,?,?)",
+                             (key, result, now, expires_at))
+                if prune:
+                    self._prune(conn, now)
+
+    def _remember(self, key, expires_at, result):
+        self._entries[key] = (expires_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune(self, conn, now):
+        conn.execute(f"DELETE FROM {RESULT_TABLE} WHERE expires_at <= ?", (now,))
+        excess = conn.execute(f"SELECT COUNT(*) FROM {RESULT_TABLE}").fetchone()[0] - self.max_persistent_entries
+        if excess > 0:
+            conn.execute(f"""DELETE FROM {RESULT_TABLE} WHERE key IN
+                             (SELECT key FROM {RESULT_TABLE} ORDER BY created_at LIMIT ?)""", (excess,))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.persistent_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.persistent_hits) / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "memory_entries": len(self._entries),
+            }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
@@ -0,0 +1,136 @@
+import time
+
+from .log import logger
+
+# 比任何 msgid 都大的哨兵值，用于构造 "早于某时间戳的全部记录" 的键区间上界
+_MAX_MSGID = 2 ** 63 - 1
+
+
+class RetentionPolicy:
+    """
+    聊天记录保留策略：全局与按会话的最大保留天数 / 最大条数。
+
+    删除按小批量进行，每批一个短写事务，批次之间让出写锁，写线程不会被长时间阻塞；
+    删除完成后执行 PRAGMA incremental_vacuum 分段归还空闲页。
+
+    Args:
+        db: ConnectionManager 实例。
+        layout: 存储布局 (SingleFileLayout / MonthlyPartitions)。
+        max_age_days: 全局最大保留天数，0 表示不限制。
+        max_rows: 每个会话最多保留的条数，0 表示不限制。
+        session_policies: {会话 ID: {"max_age_days": n, "max_rows": n}}，覆盖全局设置。
+        batch_size: 每个删除事务的最大行数。
+        pause_ms: 批次之间的间隔。
+        vacuum_pages: 每次 incremental_vacuum 归还的页数。
+    """
+
+    def __init__(self, db, layout, max_age_days=0, max_rows=0, session_policies=None,
+                 batch_size=500, pause_ms=20, vacuum_pages=1000):
+        self.db = db
+        self.layout = layout
+        self.max_age_days = int(max_age_days or 0)
+        self.max_rows = int(max_rows or 0)
+        self.session_policies = session_policies or {}
+        self.batch_size = max(1, int(batch_size))
+        self.pause_sec = max(0, int(pause_ms)) / 1000
+        self.vacuum_pages = max(1, int(vacuum_pages))
+        # 删除钩子：在同一事务内接收 (conn, session_id, [(timestamp, msgid), ...])，用于同步清理派生数据
+        self.delete_hooks = []
+        self.last_run = {}
+
+    def policy_for(self, session_name):
+        """返回会话生效的 (max_age_days, max_rows)"""
+        override = self.session_policies.get(session_name, {})
+        return (int(override.get("max_age_days", self.max_age_days) or 0),
+                int(override.get("max_rows", self.max_rows) or 0))
+
+    def run(self, now=None):
+        """执行一轮保留策略，返回并记录本轮指标"""
+        now = int(now or time.time())
+        start = time.perf_counter()
+        metrics = {"rows_pruned": 0, "sessions_pruned": 0, "pages_freed": 0, "batches": 0, "seconds": 0.0}
+
+        sessions = self.db.reader().execute("SELECT id, name FROM sessions").fetchall()
+        for session_id, name in sessions:
+            max_age_days, max_rows = self.policy_for(name)
+            pruned = 0
+            if max_age_days > 0:
+                pruned += self._prune_before(session_id, (now - max_age_days * 86400 - 1, _MAX_MSGID), metrics)
+            if max_rows > 0:
+                boundary = self._row_limit_boundary(session_id, max_rows)
+                if boundary is not None:
+                    pruned += self._prune_before(session_id, boundary, metrics)
+            if pruned:
+                metrics["sessions_pruned"] += 1
+                metrics["rows_pruned"] += pruned
+                logger.debug(f"[ChatSummary Retention] Pruned {pruned} rows from session {name}.")
+
+        if metrics["rows_pruned"]:
+            metrics["pages_freed"] = self._incremental_vacuum()
+        metrics["seconds"] = round(time.perf_counter() - start, 2)
+        self.last_run = metrics
+        logger.info(f"[ChatSummary Retention] Run finished: {metrics}")
+        return metrics
+
+    def _row_limit_boundary(self, session_id, max_rows):
+        """找出需要删除的最新一条记录的键 (保留最新 max_rows 条)，无需删除时返回 None"""
+        conn = self.db.reader()
+        remaining = max_rows
+        for table in self.layout.iter_message_tables(conn):
+            count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE session_id=?", (session_id,)).fetchone()[0]
+            if count > remaining:
+                return conn.execute(f"""SELECT timestamp, msgid FROM {table} WHERE session_id=?
+                                        ORDER BY timestamp DESC, msgid DESC LIMIT 1 OFFSET ?""",
+                                    (session_id, remaining)).fetchone()
+            remaining -= count
+        return None
+
+    def _prune_before(self, session_id, boundary, metrics):
+        """分批删除会话中 (timestamp, msgid) <= boundary 的记录"""
+        deleted = 0
+        while True:
+            with self.db.write() as conn:
+                keys, table = [], None
+                # 从旧到新处理，旧分片删空后自然跳过
+                for table in self.layout.iter_message_tables(conn, 0, boundary[0], oldest_first=True):
+                    keys = conn.execute(f"""SELECT timestamp, msgid FROM {table}
+                                            WHERE session_id=? AND (timestamp, msgid) <= (?, ?)
+                                            ORDER BY timestamp, msgid LIMIT ?""",
+                                        (session_id, boundary[0], boundary[1], self.batch_size)).fetchall()
+                    if keys:
+                        break
+                if not keys:
+                    return deleted
+                conn.executemany(f"DELETE FROM {table} WHERE session_id=? AND timestamp=? AND msgid=?",
+                                 [(session_id, ts, msgid) for ts, msgid in keys])
+                for hook in self.delete_hooks:
+                    hook(conn, session_id, keys)
+            deleted += len(keys)
+            metrics["batches"] += 1
+            if self.pause_sec:
+                time.sleep(self.pause_sec)
+
+    def _incremental_vacuum(self):
+        """对主库和已附加的分片分段执行 incremental_vacuum，返回归还的页数"""
+        freed = 0
+        with self.db.write() as conn:
+            databases = [row[1] for row in conn.execute("PRAGMA database_list").fetchall() if row[1] != "temp"]
+        for name in databases:
+            with self.db.write() as conn:
+                mode = conn.execute(f"PRAGMA {name}.auto_vacuum").fetchone()[0]
+            if mode != 2:
+                logger.debug(f"[ChatSummary Retention] auto_vacuum is not INCREMENTAL for {name}, skipping vacuum (run VACUUM once to convert).")
+                continue
+            while True:
+                with self.db.write() as conn:
+                    before = conn.execute(f"PRAGMA {name}.freelist_count").fetchone()[0]
+                    if before == 0:
+                        break
+                    conn.execute(f"PRAGMA {name}.incremental_vacuum({self.vacuum_pages})").fetchall()
+                    after = conn.execute(f"PRAGMA {name}.freelist_count").fetchone()[0]
+                freed += before - after
+                if after >= before:
+                    break
+                if self.pause_sec:
+                    time.sleep(self.pause_sec)
+        return freed
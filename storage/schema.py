@@ -0,0 +1,282 @@
+import threading
+import time
+
+from .log import logger
+
+SCHEMA_VERSION = 2
+
+# 消息类型的小整数编码 (与 ContextType 名称对应)，未知类型统一记为 0
+TYPE_CODES = {
+    "TEXT": 1,
+    "VOICE": 2,
+    "IMAGE": 3,
+    "FILE": 4,
+    "VIDEO": 5,
+    "SHARING": 6,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+LEGACY_TABLE = "chat_records"
+SUMMARIZABLE_INDEX = "idx_chat_messages_summarizable"
+
+
+def type_code(msg_type) -> int:
+    """将 ContextType (或其字符串形式) 转换为类型编码"""
+    name = str(msg_type).split(".")[-1]
+    return TYPE_CODES.get(name, 0)
+
+
+def type_name(code) -> str:
+    """将类型编码还原为 ContextType 名称"""
+    return TYPE_NAMES.get(code, "UNKNOWN")
+
+
+def is_summarizable(code, content) -> int:
+    """消息是否参与总结：文本类型、内容非空且不以 # 开头"""
+    if code != TYPE_CODES["TEXT"] or not content:
+        return 0
+    stripped = content.strip()
+    return int(bool(stripped) and not stripped.startswith("#"))
+
+
+def create_schema(conn, decode=None):
+    """创建 v2 表结构：会话与用户名驻留为整数，消息按 (会话, 时间, msgid) 聚簇存储"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_meta
+                    (key TEXT PRIMARY KEY,
+                     value TEXT) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sessions
+                    (id INTEGER PRIMARY KEY,
+                     name TEXT NOT NULL UNIQUE)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS users
+                    (id INTEGER PRIMARY KEY,
+                     name TEXT NOT NULL UNIQUE)""")
+    create_message_table(conn, decode=decode)
+    conn.execute("INSERT OR IGNORE INTO schema_meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+
+
+def create_message_table(conn, db_name="main", decode=None):
+    """
+    在指定数据库 (主库或附加的分片库) 中创建 chat_messages 表，已有的表升级到当前结构。
+
+    decode: 升级时用于解压已压缩内容的函数 (conn, session_id, content) -> str。
+    """
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS {db_name}.chat_messages
+                    (session_id INTEGER NOT NULL,
+                     timestamp INTEGER NOT NULL,
+                     msgid INTEGER NOT NULL,
+                     user_id INTEGER,
+                     type_code INTEGER NOT NULL DEFAULT 1,
+                     is_triggered INTEGER NOT NULL DEFAULT 0,
+                     content TEXT,
+                     is_summarizable INTEGER NOT NULL DEFAULT 1,
+                     line_prefix TEXT,
+                     fmt_version INTEGER NOT NULL DEFAULT 0,
+                     PRIMARY KEY (session_id, timestamp, msgid)) WITHOUT ROWID""")
+    # (会话, msgid) 唯一，保持旧表 INSERT OR REPLACE 的去重语义
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {db_name}.idx_chat_messages_session_msgid ON chat_messages (session_id, msgid)")
+    _add_summarizable_column(conn, db_name, decode)
+    _add_line_prefix_columns(conn, db_name)
+    # 只包含可总结消息的部分索引：按条数总结时恰好读取 N 条，不再多取后在 Python 中过滤
+    conn.execute(f"""CREATE INDEX IF NOT EXISTS {db_name}.{SUMMARIZABLE_INDEX}
+                     ON chat_messages (session_id, timestamp, msgid) WHERE is_summarizable = 1""")
+
+
+def _add_summarizable_column(conn, db_name, decode):
+    """为旧结构的消息表补充 is_summarizable 列并计算已有消息的标记"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA {db_name}.table_info(chat_messages)").fetchall()}
+    if "is_summarizable" in columns:
+        return
+    start = time.perf_counter()
+    conn.execute(f"ALTER TABLE {db_name}.chat_messages ADD COLUMN is_summarizable INTEGER NOT NULL DEFAULT 1")
+    conn.create_function("chat_is_summarizable", 2, is_summarizable, deterministic=True)
+    conn.execute(f"""UPDATE {db_name}.chat_messages SET is_summarizable = 0
+                     WHERE typeof(content) != 'blob' AND chat_is_summarizable(type_code, content) = 0""")
+    # 已压缩的内容需要解压后判断
+    if decode is not None:
+        excluded = [(sid, ts, msgid) for sid, ts, msgid, code, content in
+                    conn.execute(f"""SELECT session_id, timestamp, msgid, type_code, content FROM {db_name}.chat_messages
+                                     WHERE typeof(content) = 'blob'""")
+                    if not is_summarizable(code, decode(conn, sid, content))]
+        conn.executemany(f"UPDATE {db_name}.chat_messages SET is_summarizable = 0 WHERE session_id=? AND timestamp=? AND msgid=?",
+                         excluded)
+    logger.info(f"[ChatSummary Schema] Added is_summarizable to {db_name}.chat_messages in {time.perf_counter() - start:.1f}s.")
+
+
+def _add_line_prefix_columns(conn, db_name):
+    """
+    为旧结构的消息表补充预格式化列。
+
+    已有消息的 fmt_version 为 0，读取时按当前格式生成并回写，不在升级时全表重写。
+    """
+    columns = {row[1] for row in conn.execute(f"PRAGMA {db_name}.table_info(chat_messages)").fetchall()}
+    if "line_prefix" not in columns:
+        conn.execute(f"ALTER TABLE {db_name}.chat_messages ADD COLUMN line_prefix TEXT")
+    if "fmt_version" not in columns:
+        conn.execute(f"ALTER TABLE {db_name}.chat_messages ADD COLUMN fmt_version INTEGER NOT NULL DEFAULT 0")
+
+
+def get_meta(conn, key, default=None):
+    """读取 schema_meta 中的值"""
+    row = conn.execute("SELECT value FROM schema_meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(conn, key, value):
+    """写入 schema_meta 中的值"""
+    conn.execute("INSERT OR REPLACE INTO schema_meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def table_exists(conn, name, schema="main") -> bool:
+    """检查表是否存在"""
+    row = conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+    return row is not None
+
+
+class NameCache:
+    """
+    sessions / users 表的名称驻留缓存。
+
+    写连接通过 intern() 获取或创建 id；读连接通过 lookup() 只查询、不创建。
+    写事务回滚时需调用 invalidate()，避免缓存中残留未提交的 id。
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._ids = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def intern(self, conn, name) -> int:
+        """返回名称对应的 id，不存在时插入 (必须在写连接上调用)"""
+        cached = self._ids.get(name)
+        if cached is not None:
+            return cached
+        row = conn.execute(f"SELECT id FROM {self.table} WHERE name=?", (name,)).fetchone()
+        if row is None:
+            row_id = conn.execute(f"INSERT INTO {self.table} (name) VALUES (?)", (name,)).lastrowid
+        else:
+            row_id = row[0]
+        self._remember(name, row_id)
+        return row_id
+
+    def lookup(self, conn, name):
+        """只查询名称对应的 id，不存在时返回 None"""
+        cached = self._ids.get(name)
+        if cached is not None:
+            return cached
+        row = conn.execute(f"SELECT id FROM {self.table} WHERE name=?", (name,)).fetchone()
+        if row is None:
+            return None
+        self._remember(name, row[0])
+        return row[0]
+
+    def name_of(self, conn, row_id):
+        """根据 id 查询名称"""
+        if row_id is None:
+            return None
+        cached = self._names.get(row_id)
+        if cached is not None:
+            return cached
+        row = conn.execute(f"SELECT name FROM {self.table} WHERE id=?", (row_id,)).fetchone()
+        if row is None:
+            return None
+        self._remember(row[0], row_id)
+        return row[0]
+
+    def invalidate(self):
+        """清空缓存 (写事务回滚后调用)"""
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+
+    def _remember(self, name, row_id):
+        with self._lock:
+            self._ids[name] = row_id
+            self._names[row_id] = name
+
+
+class LegacyMigration:
+    """
+    将旧版 chat_records 表在线迁移到 v2 表结构。
+
+    按 rowid 顺序小批量复制，每批一个短事务，迁移进度保存在 schema_meta 中，
+    进程重启后从上次的位置继续。迁移期间读路径通过 pending_cursor() 合并尚未迁移的旧记录。
+    """
+
+    CURSOR_KEY = "legacy_migration_cursor"
+
+    def __init__(self, db, sessions: NameCache, users: NameCache, batch_size=2000, pause_sec=0.05):
+        self.db = db
+        self.sessions = sessions
+        self.users = users
+        self.batch_size = int(batch_size)
+        self.pause_sec = pause_sec
+        self.migrated_rows = 0
+        # 插入钩子：在同一事务内接收迁移的 v2 行，用于同步维护派生数据 (如全文索引)
+        self.insert_hooks = []
+        self._thread = None
+
+    def pending_cursor(self, conn):
+        """旧表仍存在时返回已迁移到的 rowid，否则返回 None"""
+        if not table_exists(conn, LEGACY_TABLE):
+            return None
+        return int(get_meta(conn, self.CURSOR_KEY, 0))
+
+    def start(self):
+        """在后台线程中执行迁移 (旧表不存在时直接返回)"""
+        with self.db.write() as conn:
+            if not table_exists(conn, LEGACY_TABLE):
+                return
+            total = conn.execute(f"SELECT COUNT(*) FROM {LEGACY_TABLE} WHERE rowid > ?",
+                                 (int(get_meta(conn, self.CURSOR_KEY, 0)),)).fetchone()[0]
+        logger.info(f"[ChatSummary Migration] Migrating {total} legacy rows from {LEGACY_TABLE} to chat_messages in background.")
+        self._thread = threading.Thread(target=self._run, name="ChatSummaryMigration", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            while self.step():
+                time.sleep(self.pause_sec)
+            logger.info(f"[ChatSummary Migration] Finished: {self.migrated_rows} rows migrated in {time.perf_counter() - start:.1f}s.")
+        except Exception as e:
+            self.sessions.invalidate()
+            self.users.invalidate()
+            logger.error(f"[ChatSummary Migration] Migration stopped, will resume on next start: {e}", exc_info=True)
+
+    def step(self) -> bool:
+        """迁移一批记录，返回是否还有剩余"""
+        with self.db.write() as conn:
+            if not table_exists(conn, LEGACY_TABLE):
+                return False
+            cursor = int(get_meta(conn, self.CURSOR_KEY, 0))
+            rows = conn.execute(f"""SELECT rowid, sessionid, msgid, user, content, type, timestamp, is_triggered
+                                    FROM {LEGACY_TABLE} WHERE rowid > ? ORDER BY rowid LIMIT ?""",
+                                (cursor, self.batch_size)).fetchall()
+            if not rows:
+                conn.execute(f"DROP TABLE {LEGACY_TABLE}")
+                conn.execute(f"DELETE FROM schema_meta WHERE key=?", (self.CURSOR_KEY,))
+                set_meta(conn, "schema_version", SCHEMA_VERSION)
+                return False
+
+            converted = []
+            for _, session, msgid, user, content, msg_type, timestamp, is_triggered in rows:
+                converted.append((
+                    self.sessions.intern(conn, str(session)),
+                    int(timestamp or 0),
+                    int(msgid),
+                    self.users.intern(conn, str(user)) if user is not None else None,
+                    type_code(msg_type),
+                    int(is_triggered or 0),
+                    content,
+                ))
+            # 迁移期间写入的新记录优先，旧记录冲突时忽略
+            conn.executemany("""INSERT OR IGNORE INTO chat_messages
+                                (session_id, timestamp, msgid, user_id, type_code, is_triggered, content, is_summarizable)
+                                VALUES (?,?,?,?,?,?,?,?)""",
+                             [row + (is_summarizable(row[4], row[6]),) for row in converted])
+            for hook in self.insert_hooks:
+                hook(conn, converted)
+            set_meta(conn, self.CURSOR_KEY, rows[-1][0])
+        self.migrated_rows += len(rows)
+        return True
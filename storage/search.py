@@ -0,0 +1,328 @@
+import sqlite3
+import threading
+import time
+
+from .log import logger
+from .schema import TYPE_CODES, get_meta, set_meta
+
+FTS_TABLE = "chat_fts"
+KEYS_TABLE = "chat_fts_keys"
+TEXT_CODE = TYPE_CODES["TEXT"]
+
+# trigram 分词器要求每个检索词至少 3 个字符：2 个字符的词 (如中文人名) 改为匹配 grams 列中的二元组，
+# 单个字符的词在会话范围内做子串匹配
+_TRIGRAM_MIN_LENGTH = 3
+# grams 列中每个二元组后的结束符，使二元组本身构成一个 trigram；检索 "张三" 即匹配 "张三\x1f"
+_GRAM_END = "\x1f"
+# 索引表结构版本，变化时与更换分词器一样删除重建
+INDEX_VERSION = 3
+# 无内容 (contentless) 表支持按 rowid 删除所需的 SQLite 版本 (contentless_delete=1)
+_CONTENTLESS_VERSION = (3, 43, 0)
+# chat_fts_keys 中保存的消息开头字符数，用于在 SQL 中排除插件命令
+_HEAD_LENGTH = 16
+
+
+class SearchIndex:
+    """
+    聊天记录全文索引 (SQLite FTS5)。
+
+    chat_fts 索引消息原文 (body)、原文的二元组 (grams，仅 trigram 分词器) 和会话标记 (scope)，
+    检索时会话条件也在 MATCH 中，只读取该会话的倒排列表。SQLite 3.43 及以上时 chat_fts 为无内容表，
+    只保存倒排索引，不重复保存原文 (否则冷数据压缩节省的空间会被索引中的明文抵消)；结果片段由消息表中
+    解压后的原文生成。更早的版本无法从无内容表中按 rowid 删除，仍使用保存原文的普通 FTS5 表，
+    升级 SQLite 后自动重建。chat_fts_keys 记录 (会话, msgid) 到索引行的映射以及时间、发送人和消息开头，
+    写入、迁移、保留策略删除时在同一事务内增量维护。默认使用 trigram 分词器，
+    中文无需分词即可做子串检索；tokenizer 可配置为任意 FTS5 分词器定义 (例如自行注册的中文分词器)。
+    启用前已有的消息由后台线程按主键顺序分批补建索引，进度保存在 schema_meta 中。
+
+    Args:
+        db: ConnectionManager 实例。
+        codec: ContentCodec 实例，补建索引时解压冷数据。
+        layout: 存储布局 (SingleFileLayout / MonthlyPartitions)。
+        tokenizer: FTS5 tokenize 参数，默认 "trigram"，不可用时回退到 unicode61。
+        backfill_batch: 补建索引时每个事务处理的行数。
+        pause_sec: 补建批次之间的间隔。
+    """
+
+    BACKFILL_KEY = "fts_backfill:"
+    TOKENIZER_KEY = "fts_tokenizer"
+    VERSION_KEY = "fts_index_version"
+
+    def __init__(self, db, codec, layout, tokenizer="trigram", backfill_batch=1000, pause_sec=0.05):
+        self.db = db
+        self.codec = codec
+        self.layout = layout
+        self.tokenizer = tokenizer
+        self.backfill_batch = max(1, int(backfill_batch))
+        self.pause_sec = pause_sec
+        self.indexed_rows = 0
+        self.backfilled_rows = 0
+        self.searches = 0
+        self.search_ms_total = 0.0
+        self.contentless = None
+        self._thread = None
+
+    @property
+    def trigram(self) -> bool:
+        return self.tokenizer.split()[0].lower() == "trigram"
+
+    def create_tables(self, conn):
+        """创建索引表；分词器与已有索引不一致时删除重建 (随后由后台补建)"""
+        existing = get_meta(conn, self.TOKENIZER_KEY)
+        if existing is not None and existing != self.tokenizer:
+            logger.info(f"[ChatSummary Search] Tokenizer changed from '{existing}' to '{self.tokenizer}', rebuilding index.")
+            existing = None
+        elif existing is not None and int(get_meta(conn, self.VERSION_KEY, 1)) != INDEX_VERSION:
+            logger.info(f"[ChatSummary Search] Index layout changed to v{INDEX_VERSION}, rebuilding index.")
+            existing = None
+        elif existing is not None and _contentless_supported() and not _is_contentless(conn):
+            logger.info("[ChatSummary Search] SQLite now supports contentless deletes, rebuilding index without stored text.")
+            existing = None
+        if existing is None:
+            drop_search_index(conn)
+            try:
+                self._create_fts(conn, self.tokenizer)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"[ChatSummary Search] Tokenizer '{self.tokenizer}' unavailable ({e}), falling back to unicode61.")
+                self.tokenizer = "unicode61"
+                self._create_fts(conn, self.tokenizer)
+            set_meta(conn, self.TOKENIZER_KEY, self.tokenizer)
+            set_meta(conn, self.VERSION_KEY, INDEX_VERSION)
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {KEYS_TABLE}
+                        (session_id INTEGER NOT NULL,
+                         msgid INTEGER NOT NULL,
+                         fts_rowid INTEGER NOT NULL,
+                         timestamp INTEGER NOT NULL,
+                         user_id INTEGER,
+                         head TEXT NOT NULL,
+                         PRIMARY KEY (session_id, msgid)) WITHOUT ROWID""")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {KEYS_TABLE}_rowid ON {KEYS_TABLE} (fts_rowid)")
+        self.contentless = _is_contentless(conn)
+
+    @staticmethod
+    def _create_fts(conn, tokenizer):
+        quoted = tokenizer.replace("'", "''")
+        options = ", content='', contentless_delete=1" if _contentless_supported() else ""
+        conn.execute(f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5
+                        (body, grams, scope, tokenize='{quoted}'{options})""")
+
+    def index_rows(self, conn, rows, replace=True):
+        """
+        在当前写事务内索引一批消息。
+
+        rows: (session_id, timestamp, msgid, user_id, type_code, is_triggered, content) 元组，
+        content 须为解压后的文本；replace=False 时跳过已索引的消息 (迁移与补建使用)。
+        """
+        trigram = self.trigram
+        for session_id, timestamp, msgid, user_id, code, _, content in rows:
+            if code != TEXT_CODE or not content:
+                continue
+            existing = conn.execute(f"SELECT fts_rowid FROM {KEYS_TABLE} WHERE session_id=? AND msgid=?",
+                                    (session_id, msgid)).fetchone()
+            if existing is not None:
+                if not replace:
+                    continue
+                conn.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid=?", (existing[0],))
+            fts_rowid = conn.execute(f"INSERT INTO {FTS_TABLE} (body, grams, scope) VALUES (?,?,?)",
+                                     (content, _bigrams(content) if trigram else "", _scope(session_id))).lastrowid
+            conn.execute(f"""INSERT OR REPLACE INTO {KEYS_TABLE} (session_id, msgid, fts_rowid, timestamp, user_id, head)
+                             VALUES (?,?,?,?,?,?)""",
+                         (session_id, msgid, fts_rowid, timestamp, user_id, content[:_HEAD_LENGTH]))
+            self.indexed_rows += 1
+
+    def delete_keys(self, conn, session_id, keys):
+        """删除钩子：移除 [(timestamp, msgid), ...] 对应的索引行 (由保留策略在删除事务内调用)"""
+        msgids = [(session_id, msgid) for _, msgid in keys]
+        conn.executemany(f"""DELETE FROM {FTS_TABLE} WHERE rowid =
+                             (SELECT fts_rowid FROM {KEYS_TABLE} WHERE session_id=? AND msgid=?)""", msgids)
+        conn.executemany(f"DELETE FROM {KEYS_TABLE} WHERE session_id=? AND msgid=?", msgids)
+
+    def search(self, conn, session_id, query, limit=10, start_timestamp=0, exclude_prefixes=()):
+        """
+        在会话内检索，返回 (总匹配数, [(timestamp, user_id, 片段), ...])。
+
+        会话条件和检索词都通过 MATCH 走索引，结果按 bm25 相关度排序；只有单个字符的检索词时按时间倒序。
+        exclude_prefixes 中的前缀 (插件命令，按前 16 个字符比较) 开头的消息不参与结果。
+        片段由消息表中的原文生成，所在分片已归档的消息只显示时间和发送人。
+        """
+        start = time.perf_counter()
+        terms = [term for term in query.split() if term]
+        if not terms:
+            return 0, []
+        if self.trigram:
+            match_terms = [term for term in terms if len(term) >= _TRIGRAM_MIN_LENGTH]
+            gram_terms = [term for term in terms if len(term) == 2]
+            substring_terms = [term for term in terms if len(term) < 2]
+        else:
+            match_terms, gram_terms, substring_terms = terms, [], []
+
+        expression = [f"scope:{_phrase(_scope(session_id))}"]
+        expression += [f"body:{_phrase(term)}" for term in match_terms]
+        expression += [f"grams:{_phrase(term.lower() + _GRAM_END)}" for term in gram_terms]
+        where = [f"{FTS_TABLE} MATCH ?", "k.timestamp > ?"]
+        params = [" AND ".join(expression), int(start_timestamp)]
+        for prefix in exclude_prefixes:
+            where.append("substr(k.head, 1, ?) != ?")
+            params.extend((len(prefix[:_HEAD_LENGTH]), prefix[:_HEAD_LENGTH]))
+        from_sql = (f"{FTS_TABLE} JOIN {KEYS_TABLE} AS k ON k.fts_rowid = {FTS_TABLE}.rowid "
+                    f"WHERE {' AND '.join(where)}")
+        # 会话标记出现在该会话的每一行中，不参与相关度计算 (权重 0)
+        order = f"bm25({FTS_TABLE}, 1.0, 1.0, 0.0), k.timestamp DESC" if match_terms or gram_terms else "k.timestamp DESC"
+        select = f"SELECT k.timestamp, k.msgid, k.user_id FROM {from_sql} ORDER BY {order}"
+
+        if not substring_terms:
+            total = conn.execute(f"SELECT COUNT(*) FROM {from_sql}", params).fetchone()[0]
+            rows = conn.execute(select + " LIMIT ?", params + [limit]).fetchall()
+            bodies = self._load_bodies(conn, session_id, rows)
+            results = [(timestamp, user_id, _snippet(bodies.get((timestamp, msgid)), terms))
+                       for timestamp, msgid, user_id in rows]
+        else:
+            # 单个字符的检索词不在索引中，逐批解压候选消息做子串比对 (先取出全部候选键，解压时可能需要附加分片)
+            candidates = conn.execute(select, params).fetchall()
+            total, results = 0, []
+            for index in range(0, len(candidates), self.backfill_batch):
+                page = candidates[index:index + self.backfill_batch]
+                bodies = self._load_bodies(conn, session_id, page)
+                for timestamp, msgid, user_id in page:
+                    body = bodies.get((timestamp, msgid))
+                    if body is None or not all(term.lower() in body.lower() for term in substring_terms):
+                        continue
+                    total += 1
+                    if len(results) < limit:
+                        results.append((timestamp, user_id, _snippet(body, substring_terms + terms)))
+        self.searches += 1
+        self.search_ms_total += (time.perf_counter() - start) * 1000
+        return total, results
+
+    def _load_bodies(self, conn, session_id, rows):
+        """从消息表读取并解压 [(timestamp, msgid, ...), ...] 的原文，返回 {(timestamp, msgid): 原文}"""
+        bodies = {}
+        tables_by_key = {}
+        for row in rows:
+            timestamp, msgid = row[0], row[1]
+            shard = self.layout.shard_key(timestamp) if self.layout.partitioned else None
+            tables = tables_by_key.get(shard)
+            if tables is None:
+                tables = tables_by_key[shard] = self.layout.message_tables(conn, timestamp, timestamp)
+            for table in tables:
+                found = conn.execute(f"SELECT content FROM {table} WHERE session_id=? AND timestamp=? AND msgid=?",
+                                     (session_id, timestamp, msgid)).fetchone()
+                if found is not None:
+                    bodies[(timestamp, msgid)] = self.codec.decode(conn, session_id, found[0]) or ""
+                    break
+        return bodies
+
+    def start_backfill(self):
+        """在后台线程中为启用索引前的消息补建索引 (已全部完成时线程立即结束)"""
+        self._thread = threading.Thread(target=self._run_backfill, name="ChatSummarySearchBackfill", daemon=True)
+        self._thread.start()
+
+    def _run_backfill(self):
+        start = time.perf_counter()
+        try:
+            while self.backfill_step():
+                time.sleep(self.pause_sec)
+            if self.backfilled_rows:
+                logger.info(f"[ChatSummary Search] Backfill finished: {self.backfilled_rows} rows indexed in {time.perf_counter() - start:.1f}s.")
+        except Exception as e:
+            logger.error(f"[ChatSummary Search] Backfill stopped, will resume on next start: {e}", exc_info=True)
+
+    def backfill_step(self) -> bool:
+        """为下一批未索引的消息建立索引，返回是否还有剩余"""
+        with self.db.write() as conn:
+            for table in self.layout.iter_message_tables(conn):
+                key = self.BACKFILL_KEY + table
+                cursor = get_meta(conn, key, "0,0,0")
+                if cursor == "done":
+                    continue
+                session_id, timestamp, msgid = (int(value) for value in cursor.split(","))
+                rows = conn.execute(f"""SELECT session_id, timestamp, msgid, user_id, type_code, is_triggered, content
+                                        FROM {table} WHERE (session_id, timestamp, msgid) > (?, ?, ?)
+                                        ORDER BY session_id, timestamp, msgid LIMIT ?""",
+                                    (session_id, timestamp, msgid, self.backfill_batch)).fetchall()
+                if not rows:
+                    set_meta(conn, key, "done")
+                    # 附加下一个分片前结束事务 (分片布局会分离已读完的分片，不能在事务中进行)
+                    conn.commit()
+                    continue
+                decoded = [row[:6] + (self.codec.decode(conn, row[0], row[6]),) for row in rows]
+                self.index_rows(conn, decoded, replace=False)
+                last = rows[-1]
+                set_meta(conn, key, f"{last[0]},{last[1]},{last[2]}")
+                self.backfilled_rows += len(rows)
+                return True
+        return False
+
+    def stats(self):
+        return {
+            "tokenizer": self.tokenizer,
+            "contentless": self.contentless,
+            "indexed_rows": self.indexed_rows,
+            "backfilled_rows": self.backfilled_rows,
+            "searches": self.searches,
+            "avg_search_ms": round(self.search_ms_total / self.searches, 2) if self.searches else 0.0,
+        }
+
+
+def drop_search_index(conn):
+    """关闭全文检索时删除索引表，重新启用时会完整重建"""
+    conn.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    conn.execute(f"DROP TABLE IF EXISTS {KEYS_TABLE}")
+    conn.execute("DELETE FROM schema_meta WHERE key LIKE ? OR key IN (?, ?)",
+                 (SearchIndex.BACKFILL_KEY + "%", SearchIndex.TOKENIZER_KEY, SearchIndex.VERSION_KEY))
+
+
+def search_index_bytes(conn):
+    """全文索引 (FTS5 影子表与 chat_fts_keys) 中保存的数据量 (字节，不含页内开销)，未建立索引时返回 0"""
+    total = 0
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ? ESCAPE '\\'",
+                          (FTS_TABLE + "\\_%",)).fetchall()
+    for (table,) in tables:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if columns:
+            sizes = " + ".join(f"COALESCE(LENGTH(CAST({column} AS BLOB)), 0)" for column in columns)
+            total += conn.execute(f"SELECT COALESCE(SUM({sizes}), 0) FROM {table}").fetchone()[0]
+    return total
+
+
+def _contentless_supported():
+    return sqlite3.sqlite_version_info >= _CONTENTLESS_VERSION
+
+
+def _is_contentless(conn):
+    """已有的 chat_fts 是否为无内容表"""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (FTS_TABLE,)).fetchone()
+    return row is not None and "content=''" in row[0]
+
+
+def _scope(session_id):
+    """会话标记，前后加 s 使其至少 3 个字符，且 s1s 不是 s12s 的子串"""
+    return f"s{session_id}s"
+
+
+def _phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _bigrams(content):
+    """原文 (小写) 中相邻两个非空白字符组成的二元组，去重后各自加上结束符拼接"""
+    grams = []
+    for word in content.lower().split():
+        grams.extend(word[index:index + 2] + _GRAM_END for index in range(len(word) - 1))
+    return "".join(dict.fromkeys(grams))
+
+
+def _snippet(body, terms, width=24):
+    """截取最先出现的检索词附近的文本并高亮；原文不可读 (分片已归档) 时返回提示"""
+    if body is None:
+        return "(所在分片已归档)"
+    lowered = body.lower()
+    positions = [(lowered.find(term.lower()), term) for term in terms]
+    positions = [(position, term) for position, term in positions if position >= 0]
+    if not positions:
+        return body[:width * 2] + ("…" if len(body) > width * 2 else "")
+    position, term = min(positions)
+    begin = max(0, position - width)
+    end = min(len(body), position + len(term) + width)
+    return (("…" if begin > 0 else "") + body[begin:position] + "【" + body[position:position + len(term)] + "】"
+            + body[position + len(term):end] + ("…" if end < len(body) else ""))
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+SUMMARY_TABLE = "summary_buckets"
+
+
+class BucketSummaryStore:
+    """
+    按固定时间桶保存的分段要点，键为 (会话, 桶起点, 模型, Prompt 版本)，保存在主库的 summary_buckets 表中。
+
+    只保存已结束的桶，之后的总结请求直接复用、不再重新生成；保留策略删除消息时，
+    在同一事务内删除覆盖这些消息的桶 (见 delete_keys)。
+
+    Args:
+        db: ConnectionManager。
+        session_names: 会话名到 id 的 NameCache。
+    """
+
+    def __init__(self, db, session_names):
+        self.db = db
+        self.session_names = session_names
+        self.hits = 0
+        self.stored = 0
+
+    def create_tables(self, conn):
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE}
+                        (session_id INTEGER NOT NULL,
+                         bucket INTEGER NOT NULL,
+                         model TEXT NOT NULL,
+                         prompt_version TEXT NOT NULL,
+                         bucket_end INTEGER NOT NULL,
+                         message_count INTEGER NOT NULL,
+                         input_tokens INTEGER NOT NULL,
+                         summary TEXT NOT NULL,
+                         created_at INTEGER NOT NULL,
+                         PRIMARY KEY (session_id, bucket, model, prompt_version)) WITHOUT ROWID""")
+
+    def get_many(self, session_id, buckets, model, prompt_version):
+        """返回 {桶起点: (条数, 输入 token 数, 要点)}，没有保存的桶不在字典中"""
+        buckets = list(buckets)
+        if not buckets:
+            return {}
+        conn = self.db.reader()
+        sid = self.session_names.lookup(conn, str(session_id))
+        if sid is None:
+            return {}
+        rows = conn.execute(f"""SELECT bucket, message_count, input_tokens, summary FROM {SUMMARY_TABLE}
+                                WHERE session_id = ? AND model = ? AND prompt_version = ?
+                                  AND bucket >= ? AND bucket <= ?""",
+                            (sid, model, prompt_version, min(buckets), max(buckets))).fetchall()
+        wanted = set(buckets)
+        found = {bucket: (count, tokens, summary) for bucket, count, tokens, summary in rows if bucket in wanted}
+        self.hits += len(found)
+        return found
+
+    def put(self, session_id, bucket, bucket_end, model, prompt_version, message_count, input_tokens, summary):
+        with self.db.write() as conn:
+            sid = self.session_names.lookup(conn, str(session_id))
+            if sid is None:
+                return
+            conn.execute(f"""INSERT OR REPLACE INTO {SUMMARY_TABLE}
+                             (session_id, bucket, model, prompt_version, bucket_end, message_count, input_tokens, summary, created_at)
+                             VALUES (?,?,?,?,?,?,?,?,?)""",
+                         (sid, bucket, model, prompt_version, bucket_end, message_count, input_tokens, summary, int(time.time())))
+        self.stored += 1
+
+    def delete_keys(self, conn, session_id, keys):
+        """保留策略的删除钩子：keys 为 [(timestamp, msgid), ...]，删除与这些消息时间范围重叠的桶"""
+        if not keys:
+            return
+        timestamps = [ts for ts, _ in keys]
+        conn.execute(f"DELETE FROM {SUMMARY_TABLE} WHERE session_id = ? AND bucket <= ? AND bucket_end > ?",
+                     (session_id, max(timestamps), min(timestamps)))
+
+    def stats(self):
+        return {"hits": self.hits, "stored": self.stored}
+
+
+class MemoryBucketSummaryStore:
+    """
+    BucketSummaryStore 的内存实现，用于 memory / duckdb 存储后端 (重启后需重新生成)。
+
+    按最近使用淘汰，最多保留 max_entries 个桶的要点。
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def get_many(self, session_id, buckets, model, prompt_version):
+        with self._lock:
+            found = {}
+            for bucket in buckets:
+                key = (str(session_id), bucket, model, prompt_version)
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    found[bucket] = entry
+            self.hits += len(found)
+            return found
+
+    def put(self, session_id, bucket, bucket_end, model, prompt_version, message_count, input_tokens, summary):
+        with self._lock:
+            key = (str(session_id), bucket, model, prompt_version)
+            self._entries[key] = (message_count, input_tokens, summary)
+            self._entries.move_to_end(key)
+            self.stored += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "stored": self.stored, "entries": len(self._entries), "evicted": self.evicted}
@@ -0,0 +1,326 @@
+"""
+聊天记录的批量导出 / 导入：在主机之间迁移历史消息或加载测试数据，无需停机复制 chat.db。
+
+导出按主键顺序分页读取 (包括分片和尚未迁移完的旧版 chat_records 表)，写入按行数切分的
+JSONL (可 gzip) 或 Parquet 文件；导入逐行读取文件，按大批量事务写入。两个方向的内存占用
+都只与批大小有关，与数据总量无关。在插件目录下运行 (机器人运行时也可以执行)：
+
+    python -m storage.transfer export --db chat.db --out backup/ --session xxx@chatroom --since 2024-01-01
+    python -m storage.transfer import --db chat.db backup/
+"""
+import argparse
+import gzip
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import schema
+from .backends.sqlite import SQLiteMessageStore
+from .compression import ContentCodec
+from .connection import ConnectionManager
+from .partition import SingleFileLayout, MonthlyPartitions
+from .search import SearchIndex
+
+_MAX_KEY = 2 ** 63 - 1
+
+
+def parse_time(value):
+    """解析 Unix 时间戳或本地时间 "YYYY-MM-DD[ HH:MM[:SS]]"，空值返回 None"""
+    if value is None:
+        return None
+    if str(value).isdigit():
+        return int(value)
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"invalid time: {value}")
+
+
+def open_store(db_path, shard_dir=None, read_only=False):
+    """
+    打开数据库；shard_dir 不为空时按月分片布局读写。
+
+    read_only 时 (导出) 只读打开，不建表、不升级、不启动迁移；否则 (导入) 必要时创建数据库并升级表结构。
+    """
+    db = ConnectionManager(db_path, read_only=read_only)
+    layout = SingleFileLayout()
+    if shard_dir:
+        shard_dir = Path(shard_dir)
+        layout = MonthlyPartitions(db, shard_dir=shard_dir, archive_dir=shard_dir / "archive")
+    # 导入的记录不带 line_prefix (fmt_version 为 0)，插件第一次读取时按当前格式生成，因此这里不需要格式化函数
+    store = SQLiteMessageStore(db, layout, ContentCodec(), format_prefix=None)
+    if not read_only:
+        store.initialize()
+    return store
+
+
+class ChunkWriter:
+    """按行数切分输出文件：prefix-00001.jsonl[.gz] / prefix-00001.parquet ..."""
+
+    def __init__(self, out_dir, prefix="chat", fmt="jsonl", chunk_rows=100000, compress=False, row_group_size=10000):
+        if fmt == "parquet" and pyarrow is None:
+            raise ImportError("pyarrow 未安装，无法导出 Parquet。请运行 'pip install pyarrow' 或使用 --format jsonl。")
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.fmt = fmt
+        self.chunk_rows = max(1, int(chunk_rows))
+        self.compress = compress
+        self.row_group_size = row_group_size
+        self.files = []
+        self.rows = 0
+        self._file = None
+        self._file_rows = 0
+        self._buffer = []
+
+    def _open(self):
+        suffix = ".parquet" if self.fmt == "parquet" else (".jsonl.gz" if self.compress else ".jsonl")
+        path = self.out_dir / f"{self.prefix}-{len(self.files) + 1:05d}{suffix}"
+        self.files.append(path)
+        if self.fmt == "parquet":
+            self._file = pyarrow.parquet.ParquetWriter(str(path), _ARROW_SCHEMA, compression="zstd")
+        elif self.compress:
+            self._file = gzip.open(path, "wt", encoding="utf-8")
+        else:
+            self._file = open(path, "w", encoding="utf-8")
+        self._file_rows = 0
+
+    def write(self, record: dict):
+        if self._file is None:
+            self._open()
+        if self.fmt == "parquet":
+            self._buffer.append(record)
+            if len(self._buffer) >= self.row_group_size:
+                self._flush_row_group()
+        else:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.rows += 1
+        self._file_rows += 1
+        if self._file_rows >= self.chunk_rows:
+            self._close_file()
+
+    def _flush_row_group(self):
+        if self._buffer:
+            self._file.write_table(pyarrow.Table.from_pylist(self._buffer, schema=_ARROW_SCHEMA))
+            self._buffer = []
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        if self.fmt == "parquet":
+            self._flush_row_group()
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        self._close_file()
+
+
+_ARROW_SCHEMA = pyarrow.schema([
+    ("session", pyarrow.string()),
+    ("msgid", pyarrow.int64()),
+    ("user", pyarrow.string()),
+    ("content", pyarrow.string()),
+    ("type", pyarrow.string()),
+    ("timestamp", pyarrow.int64()),
+    ("is_triggered", pyarrow.int64()),
+]) if pyarrow is not None else None
+
+
+def iter_export(store, session=None, since=None, until=None, page_size=5000):
+    """
+    按 (会话, 时间, msgid) 主键顺序逐页产出记录字典，内容已解压。
+
+    不限定会话时跨会话顺序扫描；旧版 chat_records 表中尚未迁移的记录最先产出。
+    """
+    conn = store.db.reader()
+    start = since if since is not None else 0
+    end = until if until is not None else _MAX_KEY
+    # 旧版表中尚未迁移的记录先产出：导入时后写入的 v2 记录覆盖同一 msgid 的旧记录，与迁移时新记录优先一致
+    legacy_cursor = _legacy_cursor(conn)
+    if legacy_cursor is not None:
+        yield from _iter_legacy(conn, legacy_cursor, session, start, end, page_size)
+    if not schema.table_exists(conn, "chat_messages"):
+        # 插件升级后尚未启动过的旧版数据库，只有 chat_records
+        return
+
+    sid = None
+    if session is not None:
+        sid = store.session_names.lookup(conn, str(session))
+        if sid is None:
+            return
+    for table in store.layout.iter_message_tables(conn, start, until):
+        # 会话过滤时键集游标从该会话开始，只扫描该会话的主键范围
+        cursor = (sid if sid is not None else -_MAX_KEY, start - 1, _MAX_KEY)
+        while True:
+            rows = conn.execute(f"""SELECT m.session_id, m.timestamp, m.msgid, s.name, u.name, m.content, m.type_code, m.is_triggered
+                                    FROM {table} AS m
+                                    JOIN sessions s ON s.id = m.session_id
+                                    LEFT JOIN users u ON u.id = m.user_id
+                                    WHERE (m.session_id, m.timestamp, m.msgid) > (?, ?, ?)
+                                      AND m.session_id <= ? AND m.timestamp >= ? AND m.timestamp <= ?
+                                    ORDER BY m.session_id, m.timestamp, m.msgid LIMIT ?""",
+                                cursor + (sid if sid is not None else _MAX_KEY, start, end, page_size)).fetchall()
+            for row_sid, ts, msgid, session_name, user, content, code, trig in rows:
+                yield {"session": session_name, "msgid": msgid, "user": user,
+                       "content": store.codec.decode(conn, row_sid, content),
+                       "type": schema.type_name(code), "timestamp": ts, "is_triggered": trig}
+            if len(rows) < page_size:
+                break
+            cursor = tuple(rows[-1][:3])
+
+
+def _legacy_cursor(conn):
+    """旧版 chat_records 表中已迁移到的 rowid，没有旧表时返回 None (只读，不依赖 initialize())"""
+    if not schema.table_exists(conn, schema.LEGACY_TABLE):
+        return None
+    if not schema.table_exists(conn, "schema_meta"):
+        return 0
+    return int(schema.get_meta(conn, schema.LegacyMigration.CURSOR_KEY, 0))
+
+
+def _iter_legacy(conn, legacy_cursor, session, start, end, page_size):
+    """按 rowid 顺序逐页产出旧版 chat_records 表中 rowid 大于迁移进度的记录"""
+    where, params ="rowid > ? AND timestamp >= ? AND timestamp <= ?", [legacy_cursor, start, end]
+    if session is not None:
+        where += " AND sessionid = ?"
+        params.append(str(session))
+    while True:
+        rows = conn.execute(f"""SELECT rowid, sessionid, msgid, user, content, type, timestamp, is_triggered
+                                FROM {schema.LEGACY_TABLE} WHERE {where} ORDER BY rowid LIMIT ?""",
+                            params + [page_size]).fetchall()
+        for _, session_name, msgid, user, content, msg_type, ts, trig in rows:
+            yield {"session": session_name, "msgid": int(msgid), "user": user, "content": content,
+                   "type": str(msg_type).split(".")[-1], "timestamp": int(ts or 0), "is_triggered": int(trig or 0)}
+        if len(rows) < page_size:
+            break
+        params[0] = rows[-1][0]
+
+
+def iter_files(paths):
+    """逐行读取 JSONL (.jsonl / .jsonl.gz) 或 Parquet 文件，目录按文件名顺序展开"""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.iterdir() if p.name.endswith((".jsonl", ".jsonl.gz", ".parquet"))))
+        else:
+            files.append(path)
+    for path in files:
+        if path.name.endswith(".parquet"):
+            if pyarrow is None:
+                raise ImportError("pyarrow 未安装，无法读取 Parquet。请运行 'pip install pyarrow'。")
+            for batch in pyarrow.parquet.ParquetFile(str(path)).iter_batches(batch_size=10000):
+                yield from batch.to_pylist()
+            continue
+        opener = gzip.open if path.name.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def import_records(store, records, session=None, since=None, until=None, batch_size=5000, report_every=10):
+    """
+    将记录字典按 batch_size 条一个事务写入，返回 (写入行数, 跳过行数, 秒数)。
+
+    (会话, msgid) 已存在的记录被替换，重复导入同一份文件是幂等的。
+    """
+    start = time.perf_counter()
+    written = skipped = batches = 0
+    batch = []
+
+    def flush():
+        nonlocal written, batches
+        store.append(batch)
+        written += len(batch)
+        batches += 1
+        batch.clear()
+        if batches % report_every == 0:
+            elapsed = time.perf_counter() - start
+            print(f"imported {written} rows ({written / elapsed:.0f} rows/s)")
+
+    for record in records:
+        try:
+            row = (str(record["session"]), int(record["msgid"]), str(record.get("user") or ""),
+                   str(record.get("content") or ""), str(record.get("type") or "TEXT"),
+                   int(record["timestamp"]), int(record.get("is_triggered") or 0), None)
+        except (KeyError, TypeError, ValueError):
+            skipped += 1
+            continue
+        if (session is not None and row[0] != session) or (since is not None and row[5] < since) \
+                or (until is not None and row[5] > until):
+            skipped += 1
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return written, skipped, time.perf_counter() - start
+
+
+def _attach_search_index(store):
+    """目标库已有全文索引时，导入的记录在同一事务内同步建立索引"""
+    with store.db.write() as conn:
+        tokenizer = schema.get_meta(conn, SearchIndex.TOKENIZER_KEY)
+    if tokenizer is not None:
+        store.write_hooks.append(SearchIndex(store.db, store.codec, store.layout, tokenizer=tokenizer).index_rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk export / import chat history")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("export", "import"):
+        command = sub.add_parser(name)
+        command.add_argument("--db", default="chat.db", help="path to chat.db")
+        command.add_argument("--shard-dir", help="monthly shard directory when partitioning is enabled")
+        command.add_argument("--session", help="only this session id")
+        command.add_argument("--since", type=parse_time, help="unix time or local 'YYYY-MM-DD[ HH:MM]' (inclusive)")
+        command.add_argument("--until", type=parse_time, help="unix time or local 'YYYY-MM-DD[ HH:MM]' (inclusive)")
+    export = sub.choices["export"]
+    export.add_argument("--out", required=True, help="output directory")
+    export.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    export.add_argument("--chunk-rows", type=int, default=100000, help="rows per output file")
+    export.add_argument("--gzip", action="store_true", help="gzip JSONL chunks")
+    export.add_argument("--page-size", type=int, default=5000)
+    imp = sub.choices["import"]
+    imp.add_argument("inputs", nargs="+", help="JSONL / Parquet files or directories")
+    imp.add_argument("--batch-size", type=int, default=5000, help="rows per transaction")
+    args = parser.parse_args(argv)
+
+    if args.command == "export" and not Path(args.db).is_file():
+        parser.error(f"database not found: {args.db}")
+    store = open_store(args.db, args.shard_dir, read_only=args.command == "export")
+    try:
+        if args.command == "export":
+            writer = ChunkWriter(args.out, fmt=args.format, chunk_rows=args.chunk_rows, compress=args.gzip)
+            start = time.perf_counter()
+            try:
+                for record in iter_export(store, args.session, args.since, args.until, args.page_size):
+                    writer.write(record)
+            finally:
+                writer.close()
+            elapsed = time.perf_counter() - start
+            print(f"exported {writer.rows} rows to {len(writer.files)} files in {elapsed:.1f}s "
+                  f"({writer.rows / elapsed if elapsed else 0:.0f} rows/s)")
+        else:
+            _attach_search_index(store)
+            written, skipped, elapsed = import_records(store, iter_files(args.inputs), args.session,
+                                                       args.since, args.until, args.batch_size)
+            print(f"imported {written} rows ({skipped} skipped) in {elapsed:.1f}s "
+                  f"({written / elapsed if elapsed else 0:.0f} rows/s)")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+llm.streaming 的测试：启动本地 SSE 桩服务，不访问外部接口。
+
+在插件目录下运行：
+
+    python -m unittest discover -s tests
+
+或使用 pytest (插件目录本身是一个包，--rootdir 避免 pytest 导入插件入口 __init__.py)：
+
+    python -m pytest --rootdir tests tests
+"""
+import json
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from llm.routing import ProviderRouter
+from llm.streaming import ParagraphSender, StreamError, StreamingJSONObject, read_chat_stream
+
+FAILED = "总结失败："
+
+REPORT = {
+    "metadata": {"total_messages": 3, "time_range": "08:00-09:00"},
+    "hot_topics": [{"name": "流式, \"解析\" {x}", "keywords": ["a", "b\\c"], "weight": [1, [2, 3]]}],
+    "summary": "逗号, 括号 } ] 和转义 \\\" 都在字符串里",
+}
+REPORT_TEXT = "```json\n" + json.dumps(REPORT, ensure_ascii=False, indent=2) + "\n```\n以上是总结。"
+
+
+def _delta(piece):
+    event = {"choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}}]}
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def _chunks(pieces, usage=None, zhipu=False):
+    """OpenAI 兼容接口的事件序列；智谱接口不发送 [DONE]"""
+    events = [": keep-alive\n\n"] + [_delta(piece) for piece in pieces]
+    last = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    if usage:
+        last["usage"] = {"prompt_tokens": 10, "completion_tokens": usage, "total_tokens": 10 + usage}
+    events.append(f"data: {json.dumps(last)}\n\n")
+    if not zhipu:
+        events.append("data: [DONE]\n\n")
+    return events
+
+
+# 路径 -> 事件序列；事件为 bytes 时原样发送 (可以在 UTF-8 字符中间切开)，ABORT 表示不发送结束块直接断开连接
+ABORT = object()
+EVENTS = {
+    "/openai": _chunks(["第一段", "内容。\n\n", "第二段", "内容。"]),
+    "/zhipu": _chunks(["你好", "，世界"], usage=7, zhipu=True),
+    "/zhipu-no-usage": _chunks(["你好", "，", "世界"], zhipu=True),
+    "/json": _chunks([REPORT_TEXT[i:i + 7] for i in range(0, len(REPORT_TEXT), 7)]),
+    "/split": [piece for event in _chunks(["多行", "数据"]) + ["data: 不会读到\n\n"]
+               for encoded in [event.encode("utf-8")]
+               for piece in (encoded[i:i + 3] for i in range(0, len(encoded), 3))],
+    "/multiline": ['data: {"choices": [{"delta":\ndata:  {"content": "跨行"}}]}\n\n', "data: [DONE]\n\n"],
+    "/error": ['data: {"error": {"message": "quota exceeded"}}\n\n'],
+    "/error-after-output": [_delta("前半段"), _delta("，继续"),
+                            'data: {"error": {"message": "upstream overloaded"}}\n\n', _delta("不会读到")],
+    "/malformed": [_delta("前半段"), "data: {not json\n\n"],
+    "/dropped": [_delta("前半段"), ABORT],
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.005
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for event in EVENTS[self.path]:
+                if event is ABORT:
+                    self.close_connection = True
+                    return
+                data = event if isinstance(event, bytes) else event.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+                time.sleep(self.delay)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, path):
+        return requests.post(self.base + path, json={}, stream=True, timeout=5)
+
+
+class ReadChatStreamTest(_StubServerTest):
+    def test_openai_compatible_stream(self):
+        started = time.perf_counter()
+        sent = []
+        sender = ParagraphSender(sent.append, min_chars=5)
+        result = read_chat_stream(self.post("/openai"), sender.feed, started)
+        self.assertEqual(result.text, "第一段内容。\n\n第二段内容。")
+        self.assertEqual(sent, ["第一段内容。"])
+        self.assertEqual(sender.remainder(), "第二段内容。")
+        self.assertTrue(0 < result.ttft_ms < result.total_ms)
+        self.assertEqual((result.chunks, result.tokens, result.usage_reported), (4, 4, False))
+        self.assertEqual(result.finish_reason, "stop")
+        self.assertFalse(result.stopped_early)
+
+    def test_zhipu_stream_ends_without_done(self):
+        result = read_chat_stream(self.post("/zhipu"))
+        self.assertEqual(result.text, "你好，世界")
+        self.assertEqual(result.finish_reason, "stop")
+        self.assertTrue(result.usage_reported)
+        self.assertEqual(result.tokens, 7)
+
+    def test_zhipu_stream_without_usage_counts_chunks(self):
+        result = read_chat_stream(self.post("/zhipu-no-usage"))
+        self.assertEqual(result.text, "你好，世界")
+        self.assertFalse(result.usage_reported)
+        self.assertEqual(result.tokens, 3)
+
+    def test_events_split_across_network_chunks(self):
+        # 每 3 个字节一个分块，事件和多字节字符都被切开；[DONE] 之后的事件不读取
+        result = read_chat_stream(self.post("/split"))
+        self.assertEqual(result.text, "多行数据")
+        self.assertEqual(result.finish_reason, "stop")
+
+    def test_multiline_data_field(self):
+        self.assertEqual(read_chat_stream(self.post("/multiline")).text, "跨行")
+
+    def test_on_delta_stops_reading(self):
+        seen = []
+        result = read_chat_stream(self.post("/openai"), lambda text: seen.append(text) or len(seen) == 2)
+        self.assertTrue(result.stopped_early)
+        self.assertEqual(result.text, "第一段内容。\n\n")
+        self.assertEqual(seen, ["第一段", "内容。\n\n"])
+        self.assertIsNone(result.finish_reason)
+
+
+class MidStreamErrorTest(_StubServerTest):
+    def test_error_event(self):
+        with self.assertRaisesRegex(StreamError, "quota exceeded"):
+            read_chat_stream(self.post("/error"))
+
+    def test_error_event_after_partial_output(self):
+        seen = []
+        with self.assertRaisesRegex(StreamError, "upstream overloaded"):
+            read_chat_stream(self.post("/error-after-output"), seen.append)
+        self.assertEqual(seen, ["前半段", "，继续"])
+
+    def test_malformed_event(self):
+        with self.assertRaisesRegex(StreamError, "无法解析"):
+            read_chat_stream(self.post("/malformed"))
+
+    def test_connection_dropped(self):
+        with self.assertRaises(requests.exceptions.RequestException):
+            read_chat_stream(self.post("/dropped"))
+
+    def _router(self, executor=None):
+        """与 ChatSummary._call_provider 一致：流中途出错时返回以 "总结失败：" 开头的文本"""
+        paths = {"primary": "/error-after-output", "backup": "/openai"}
+
+        def call(provider, prompt, on_delta):
+            try:
+                return read_chat_stream(self.post(paths[provider]), on_delta).text
+            except (StreamError, requests.exceptions.RequestException) as e:
+                return f"{FAILED}{e}"
+
+        return ProviderRouter(list(paths), call, lambda text: text.startswith(FAILED),
+                              executor=executor, failover=True, streaming=True)
+
+    def test_mid_stream_error_fails_over(self):
+        for executor in (None, ThreadPoolExecutor(2)):
+            with self.subTest(hedging=executor is not None):
+                router = self._router(executor)
+                self.assertEqual(router.call("primary", "prompt"), ("第一段内容。\n\n第二段内容。", "backup"))
+                self.assertEqual(router.stats()["providers"]["primary"]["failures"], 1)
+                if executor is not None:
+                    executor.shutdown()
+
+    def test_no_failover_after_output_reached_the_caller(self):
+        seen = []
+        text, provider = self._router().call("primary", "prompt", seen.append)
+        self.assertEqual(provider, "primary")
+        self.assertTrue(text.startswith(FAILED) and "upstream overloaded" in text, text)
+        self.assertEqual(seen, ["前半段", "，继续"])
+
+
+class StreamingJSONObjectTest(_StubServerTest):
+    def feed_all(self, pieces):
+        parser = StreamingJSONObject()
+        done = False
+        for piece in pieces:
+            done = parser.feed(piece)
+            if done:
+                break
+        return parser, done
+
+    def test_every_two_chunk_split(self):
+        for cut in range(len(REPORT_TEXT) + 1):
+            parser, done = self.feed_all([REPORT_TEXT[:cut], REPORT_TEXT[cut:]])
+            self.assertTrue(done, cut)
+            self.assertFalse(parser.failed, cut)
+            self.assertEqual(parser.result(), REPORT, cut)
+
+    def test_single_character_chunks(self):
+        parser, done = self.feed_all(REPORT_TEXT)
+        self.assertTrue(done)
+        self.assertEqual(parser.result(), REPORT)
+        # 顶层对象闭合时立即完成，不需要读取结尾的代码块标记和说明文字
+        self.assertTrue(REPORT_TEXT.startswith(parser.text))
+        self.assertTrue(parser.text.endswith("}"))
+
+    def test_members_parsed_before_the_object_closes(self):
+        text = json.dumps({"first": [1, {"a": "}"}], "second": "x"}, ensure_ascii=False)
+        cut = text.index('"second"')
+        parser, done = self.feed_all([text[:cut], text[cut:-1]])
+        self.assertFalse(done)
+        self.assertEqual(parser.result(), {"first": [1, {"a": "}"}]})
+        self.assertTrue(parser.feed("}"))
+        self.assertEqual(parser.result(), {"first": [1, {"a": "}"}], "second": "x"})
+
+    def test_without_code_fence(self):
+        parser, done = self.feed_all(["{\"a\"", ": 1}"])
+        self.assertTrue(done)
+        self.assertEqual(parser.result(), {"a": 1})
+
+    def test_non_json_output(self):
+        parser, done = self.feed_all(["抱歉，", "我无法生成 JSON。"])
+        self.assertFalse(done)
+        self.assertTrue(parser.failed)
+
+    def test_text_before_the_object(self):
+        parser, done = self.feed_all(["以下是结果：", "{\"a\": 1}"])
+        self.assertFalse(done)
+        self.assertTrue(parser.failed)
+
+    def test_invalid_member(self):
+        parser, done = self.feed_all(["{\"a\": 1, \"b\": tru", "e_, \"c\": 2}"])
+        self.assertFalse(done)
+        self.assertTrue(parser.failed)
+
+    def test_parsed_from_stream(self):
+        parser = StreamingJSONObject()
+        result = read_chat_stream(self.post("/json"), parser.feed)
+        self.assertTrue(parser.done)
+        self.assertTrue(result.stopped_early)
+        self.assertEqual(parser.result(), REPORT)
+        self.assertLess(len(result.text), len(REPORT_TEXT))
+
+
+if __name__ == "__main__":
+    unittest.main()